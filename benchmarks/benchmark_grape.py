@@ -0,0 +1,192 @@
+"""
+Scaling benchmark of the GRAPE workflow on synthetic screens.
+
+Times every stage (get_foldchange_matrix, get_mean_foldchange, mode_center, make_predictor_matrix,
+do_regression, get_zscore) and the end-to-end run() across size tiers, reports the empirical
+scaling exponent of each stage and checks that the interactions planted in the synthetic screens
+are recovered, by the normal null and by the empirical null of --resamples resampled regressions.
+Exits with status 1 if recovery falls below --min-recall in any tier, or if the empirical recall
+is more than --max-recall-gap below the normal recall.
+
+Usage:
+    python benchmarks/benchmark_grape.py [--tiers small medium large] [--repeat 3] [--resamples 200]
+                                         [--json PATH]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from grape.cli import add_optional_arguments
+from grape.core.analysis import analyze
+from grape.core.foldchange_generator import get_foldchange_matrix, get_mean_foldchange, mode_center
+from grape.core.regression import make_predictor_matrix, do_regression
+from grape.core.run import run
+from grape.core.zscore_generator import get_zscore
+from grape.utils.synthetic import make_synthetic_screen
+
+
+TIERS = {'small': 60, 'medium': 200, 'large': 500, 'xlarge': 1000}
+"""Number of target genes of each size tier (all gene pairs are in the library)"""
+
+STAGES = ['get_foldchange_matrix', 'get_mean_foldchange', 'mode_center',
+          'make_predictor_matrix', 'do_regression', 'get_zscore', 'run']
+
+FDR = 0.05
+"""FDR threshold at which a planted interaction counts as recovered"""
+
+EMPIRICAL = '_emp'
+"""Suffix of the p-value columns of the empirical null"""
+
+
+def time_call(func: Callable, repeat: int) -> float:
+    """Best wall time of `repeat` calls of func()."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def run_arguments(paths: Dict[str, str], screen, output_directory: str) -> argparse.Namespace:
+    """Arguments of run() with the command-line defaults."""
+    parser = argparse.ArgumentParser()
+    add_optional_arguments(parser)
+    args = parser.parse_args([])
+    args.input_filepath = paths['reads']
+    args.output_directory = output_directory
+    args.control_columns = screen.control_columns
+    args.target_columns = screen.target_columns
+    args.target_gene_file = paths['targets']
+    return args
+
+def recovery(pairs, screen, suffix: str = '') -> Dict[str, float]:
+    """
+    Recall of the planted interactions and false discovery proportion at FDR, from the
+    Padj_synth/Padj_supp columns with `suffix` (e.g. EMPIRICAL).
+    """
+    synth = pairs['Padj_synth' + suffix] < FDR
+    supp = pairs['Padj_supp' + suffix] < FDR
+    planted = screen.interactions.reindex(pairs.index).fillna(0.)
+    hits = (synth & (planted < 0)) | (supp & (planted > 0))
+    called = synth | supp
+    return {f'planted{suffix}': int((planted != 0).sum()), f'recovered{suffix}': int(hits.sum()),
+            f'recall{suffix}': float(hits.sum() / max(1, (planted != 0).sum())),
+            f'false_discovery{suffix}': float((called & (planted == 0)).sum() /
+                                              max(1, called.sum()))}
+
+def benchmark_tier(name: str, n_genes: int, repeat: int, seed: int, resamples: int) -> Dict:
+    screen = make_synthetic_screen(n_genes=n_genes, seed=seed)
+    reads = screen.reads
+    record = {'tier': name, 'n_genes': n_genes, 'n_constructs': len(reads), 'seconds': {}}
+    seconds = record['seconds']
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        fc = get_foldchange_matrix(reads, screen.control_columns)
+        mean_fc = get_mean_foldchange(fc, screen.target_columns)
+        centred = mode_center(mean_fc.copy())
+        predictor, obs = make_predictor_matrix(centred, screen.target_genes)
+        pairs, _, _ = do_regression(predictor, obs)
+
+    seconds['get_foldchange_matrix'] = time_call(
+        lambda: get_foldchange_matrix(reads, screen.control_columns), repeat)
+    seconds['get_mean_foldchange'] = time_call(
+        lambda: get_mean_foldchange(fc, screen.target_columns), repeat)
+    # mode_center works in place
+    seconds['mode_center'] = time_call(lambda: mode_center(mean_fc.copy()), repeat)
+    seconds['make_predictor_matrix'] = time_call(
+        lambda: make_predictor_matrix(centred, screen.target_genes), repeat)
+    seconds['do_regression'] = time_call(lambda: do_regression(predictor, obs), repeat)
+    seconds['get_zscore'] = time_call(lambda: get_zscore(pairs), repeat)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = screen.write(tmpdir)
+        args = run_arguments(paths, screen, os.path.join(tmpdir, 'out'))
+        os.makedirs(args.output_directory)
+        seconds['run'] = time_call(lambda: run(args), repeat)
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        result = analyze(reads, screen.control_columns, screen.target_genes,
+                         target_columns=screen.target_columns, resamples=resamples,
+                         seed=seed)
+    record.update(recovery(result.pairs, screen))
+    if resamples:
+        record.update(recovery(result.pairs, screen, EMPIRICAL))
+    return record
+
+def scaling_exponents(records: List[Dict]) -> Dict[str, float]:
+    """Slope of log(seconds) against log(number of constructs) for every stage."""
+    if len(records) < 2:
+        return {}
+    size = np.log([r['n_constructs'] for r in records])
+    return {stage: float(np.polyfit(size, np.log([r['seconds'][stage] for r in records]), 1)[0])
+            for stage in STAGES}
+
+def print_report(records: List[Dict], exponents: Dict[str, float]):
+    header = f"{'stage':<24}" + ''.join(f"{r['tier']:>12}" for r in records)
+    if exponents:
+        header += f"{'exponent':>10}"
+    print(header)
+    print(f"{'constructs':<24}" + ''.join(f"{r['n_constructs']:>12}" for r in records))
+    for stage in STAGES:
+        line = f'{stage:<24}' + ''.join(f"{r['seconds'][stage]:>11.4f}s" for r in records)
+        if exponents:
+            line += f'{exponents[stage]:>10.2f}'
+        print(line)
+    print()
+    for r in records:
+        print(f"[{r['tier']}] recovered {r['recovered']}/{r['planted']} planted interactions "
+              f"(recall {r['recall']:.2f}), false discovery proportion {r['false_discovery']:.3f}")
+        if f'recall{EMPIRICAL}' in r:
+            print(f"[{r['tier']}] empirical null: recovered {r['recovered_emp']}/{r['planted_emp']} "
+                  f"(recall {r['recall_emp']:.2f}), false discovery proportion "
+                  f"{r['false_discovery_emp']:.3f}")
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark GRAPE on synthetic screens')
+    parser.add_argument('--tiers', nargs='+', choices=list(TIERS), default=['small', 'medium'],
+                        help='Size tiers to run')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed calls per stage (best is kept)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic screens')
+    parser.add_argument('--min-recall', type=float, default=0.9, help='Minimum fraction of ' \
+                        'planted interactions recovered at 5%% FDR')
+    parser.add_argument('--resamples', type=int, default=200, help='Resampled regressions of ' \
+                        'the empirical null (0 skips its recovery check)')
+    parser.add_argument('--max-recall-gap', type=float, default=0.1, help='Maximum recall of ' \
+                        'the normal null minus recall of the empirical null')
+    parser.add_argument('--json', type=str, default=None, help='Write the report to a JSON file')
+    args = parser.parse_args(argv)
+
+    records = [benchmark_tier(name, TIERS[name], args.repeat, args.seed, args.resamples)
+               for name in args.tiers]
+    exponents = scaling_exponents(records)
+    print_report(records, exponents)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as outfile:
+            json.dump({'tiers': records, 'scaling_exponents': exponents}, outfile, indent=2)
+
+    failed = [r['tier'] for r in records if r['recall'] < args.min_recall]
+    if failed:
+        print(f"[ERROR] Planted interactions not recovered in tier(s): {', '.join(failed)}")
+        return 1
+    failed = [r['tier'] for r in records if f'recall{EMPIRICAL}' in r and
+              r['recall'] - r[f'recall{EMPIRICAL}'] > args.max_recall_gap]
+    if failed:
+        print(f"[ERROR] Empirical null recovers fewer planted interactions than the normal null "
+              f"in tier(s): {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
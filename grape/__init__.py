@@ -1,17 +1,36 @@
-from .core.load_input import load_genelist, load_readcount_matrix
-from .core.foldchange_generator import get_foldchange_matrix, get_mean_foldchange, mode_center, mode_center_vs_reference_genes
-from .core.regression import make_predictor_matrix, do_regression, dynamic_range_filter
-from .core.zscore_generator import get_zscore
+from importlib import import_module
 
-__all__ = [
-    "load_genelist",
-    "load_readcount_matrix",
-    "get_foldchange_matrix",
-    "get_mean_foldchange",
-    "mode_center",
-    "mode_center_vs_reference_genes",
-    "make_predictor_matrix",
-    "do_regression",
-    "dynamic_range_filter",
-    "get_zscore",
-]
\ No newline at end of file
+# the public API is imported on first access (PEP 562), so that the command line and
+# grape.utils load without pandas, scipy or scikit-learn
+_LAZY_IMPORTS = {
+    "analyze": "grape.core.analysis",
+    "GrapeResult": "grape.core.analysis",
+    "load_genelist": "grape.core.load_input",
+    "load_readcount_matrix": "grape.core.load_input",
+    "get_foldchange_matrix": "grape.core.foldchange_generator",
+    "get_mean_foldchange": "grape.core.foldchange_generator",
+    "mode_center": "grape.core.foldchange_generator",
+    "mode_center_vs_reference_genes": "grape.core.foldchange_generator",
+    "PairIndex": "grape.core.pair_index",
+    "make_predictor_matrix": "grape.core.regression",
+    "do_regression": "grape.core.regression",
+    "do_multi_regression": "grape.core.regression",
+    "dynamic_range_filter": "grape.core.regression",
+    "get_zscore": "grape.core.zscore_generator",
+    "get_multi_zscore": "grape.core.zscore_generator",
+    "gi_matrix": "grape.core.gi_matrix",
+    "load_gi_matrix": "grape.core.gi_matrix",
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+
+def __getattr__(name):
+    if name in _LAZY_IMPORTS:
+        value = getattr(import_module(_LAZY_IMPORTS[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module 'grape' has no attribute '{name}'")
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
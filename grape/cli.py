@@ -1,15 +1,123 @@
 import argparse
 import sys
+from typing import List
 
-from grape.core.run import run
 from grape.utils.defaults import *
 from grape.utils.version import __version__
 
 
+def add_optional_arguments(optional_group: argparse._ArgumentGroup, per_screen: bool = True):
+    """Add the analysis options shared by single runs and batch runs."""
+    if per_screen:
+        optional_group.add_argument('-p', '--output-prefix', type=str, required=False, 
+                                    help='Prefix for output files', default=DEFAULT_OUTPUT_PREFIX)
+    optional_group.add_argument('--min-reads', type=int, required=False, help='Minimum read count ' \
+                                'of a construct, summed over the control columns; constructs ' \
+                                'below it are removed before computing fold changes',
+                                default=DEFAULT_MIN_READS)
+    optional_group.add_argument('--pseudocount', type=int, required=False, help='Pseudocount to avoid' \
+                                'devision by zero', default=DEFAULT_PSEUDOCOUNT)
+    optional_group.add_argument('--float32', action='store_true', help='Compute and average fold ' \
+                                'changes in float32 to halve their memory', default=DEFAULT_FLOAT32)
+    optional_group.add_argument('--streaming', action='store_true', help='Compute mean fold ' \
+                                'changes in two passes over the read count file instead of ' \
+                                'loading it, for count tables larger than memory', 
+                                default=DEFAULT_STREAMING)
+    optional_group.add_argument('--chunk-size', type=int, help='Rows of the read count file ' \
+                                'processed at once with --streaming', default=DEFAULT_CHUNK_SIZE)
+    if per_screen:
+        optional_group.add_argument('--target-columns', required=False, help='Space-delimited ' \
+                                    'list of target column names to average', nargs='+', 
+                                    default=DEFAULT_TARGET_COLUMNS)
+    optional_group.add_argument('--no-mean-replicates', action='store_true', help='Disable averaging' \
+                                'across replicate columns', default=DEFAULT_NO_MEAN_REPLICATES)
+    optional_group.add_argument('--no-groupby-targets', action='store_true', help='Disable grouping ' \
+                                'by target gene', default=DEFAULT_NO_GROUPBY_TARGETS)
+    optional_group.add_argument('--nonessential-gene-file', type=str, help='Path to nonessential/' \
+                                'reference gene list', default=DEFAULT_NONESSENTIAL_GENE_FILE)
+    optional_group.add_argument('--query-gene-file', type=str, required=False, help='Path to query ' \
+                                'gene list', default=DEFAULT_QUERY_GENE_FILE)
+    optional_group.add_argument('--genepair-del', type=str, required=False, help = 'Delimiter used ' \
+                                'to separate gene pairs in index names.', default=DEFAULT_GENEPAIR_DEL)
+    optional_group.add_argument('--sparse', action='store_true', help='Use a sparse predictor ' \
+                                'matrix and sparse least-squares solver', default=DEFAULT_SPARSE)
+    optional_group.add_argument('--mode-method', type=str, choices=MODE_METHODS, help='Mode ' \
+                                'estimator for mode-centering: Gaussian KDE on a fixed grid from ' \
+                                '-5 to 4 (kde), or binned FFT KDE over the range of the data (fft)', 
+                                default=DEFAULT_MODE_METHOD)
+    optional_group.add_argument('--regression-backend', type=str, choices=REGRESSION_BACKENDS, 
+                                help='Least-squares backend of the dense regression: ' \
+                                'scikit-learn (sklearn) or NumPy/SciPy only (numpy)', 
+                                default=DEFAULT_REGRESSION_BACKEND)
+    optional_group.add_argument('--block-solve', action='store_true', help='Split the regression ' \
+                                'into the connected components of the gene-pair graph and solve ' \
+                                'them in parallel (--threads)', default=DEFAULT_BLOCK_SOLVE)
+    optional_group.add_argument('--fit-intercept', action='store_true', help = 'Whether to fit the ' \
+                                'intercept in regression', default=DEFAULT_FIT_INTERCEPT)
+    optional_group.add_argument('--incremental-filter', action='store_true', help='Refit after the ' \
+                                'dynamic range filter by downdating the first regression instead ' \
+                                'of rebuilding it', default=DEFAULT_INCREMENTAL_FILTER)
+    optional_group.add_argument('--iterate-filter', action='store_true', help='Repeat the dynamic ' \
+                                'range filter until no more pairs are removed', 
+                                default=DEFAULT_ITERATE_FILTER)
+    optional_group.add_argument('--half-window-size', type=int, help='Half window size for local ' \
+                                'variance', default=DEFAULT_HALF_WINDOW_SIZE)
+    optional_group.add_argument('--window-step', type=int, help='Distance between local variance ' \
+                                'windows (1 gives every pair its own centred window). Defaults to ' \
+                                'half window size / 5', default=DEFAULT_WINDOW_STEP)
+    optional_group.add_argument('--monotone-filter', action='store_true', help='Apply monotonic ' \
+                                'filter to local std devs', default=DEFAULT_MONOTONE_FILTER)
+    optional_group.add_argument('--diagnostics', action='store_true', help='Add the leverage, ' \
+                                'leave-one-out residual and Cook\'s distance of every construct ' \
+                                'to the pairs and singles outputs', default=DEFAULT_DIAGNOSTICS)
+    optional_group.add_argument('--resamples', type=int, help='Number of resampled regressions for ' \
+                                'empirical p-values and FDR (0 disables resampling)', 
+                                default=DEFAULT_RESAMPLES)
+    optional_group.add_argument('--resample-method', type=str, choices=RESAMPLE_METHODS, 
+                                help='Shuffle the regression residuals across constructs ' \
+                                '(permutation) or draw them with replacement (bootstrap)', 
+                                default=DEFAULT_RESAMPLE_METHOD)
+    optional_group.add_argument('--seed', type=int, help='Random seed for resampling', 
+                                default=DEFAULT_SEED)
+    optional_group.add_argument('--threads', type=int, help='Number of threads for resampling ' \
+                                'and --block-solve. ' \
+                                'Defaults to the number of CPUs', default=DEFAULT_THREADS)
+    optional_group.add_argument('--library', type=str, help='Guide library built by grape ' \
+                                'build-library; its stored factorization is reused if it matches ' \
+                                'the screen', default=DEFAULT_LIBRARY)
+    optional_group.add_argument('--cache-dir', type=str, help='Directory for caching pipeline ' \
+                                'stage outputs between runs', default=DEFAULT_CACHE_DIR)
+    optional_group.add_argument('--cache-size', type=int, help='Maximum size of the stage cache ' \
+                                'in megabytes (least recently used entries are evicted first)', 
+                                default=DEFAULT_CACHE_SIZE)
+    optional_group.add_argument('--profile', type=str, nargs='?', const='', help='Write the ' \
+                                'time, memory and size of every stage to a JSON file (default ' \
+                                'grape_profile_<prefix>.json in the output directory)', 
+                                default=DEFAULT_PROFILE)
+    optional_group.add_argument('--output-format', type=str, choices=OUTPUT_FORMATS, help='Format ' \
+                                'of the output tables. txt is rounded for reading; parquet, ' \
+                                'feather and npz keep full precision', default=DEFAULT_OUTPUT_FORMAT)
+    optional_group.add_argument('--gi-matrix', type=str, choices=GI_MATRIX_LAYOUTS, help='Also ' \
+                                'write GI_Zscore, GI_raw and dLFC as symmetric gene x gene ' \
+                                'matrices: one sparse CSR .npz, or dense memory-mappable .npy ' \
+                                'files', default=DEFAULT_GI_MATRIX)
+
+class _MainHelpFormatter(argparse.ArgumentDefaultsHelpFormatter,
+                         argparse.RawDescriptionHelpFormatter):
+    """Help of the main parser: argument defaults, and the subcommand list kept as written."""
+
 def __main__():
     """Parse command-line arguments."""
-    parser = argparse.ArgumentParser(description="Run GRAPE",
-                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    # a single run takes no subcommand, so subcommands are dispatched on the first argument
+    # rather than with argparse subparsers
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[sys.argv[1]][0](sys.argv[2:])
+
+    epilog = 'subcommands (grape <subcommand> -h for their arguments):\n' + \
+             '\n'.join(f'  {name:<15} {description}'
+                       for name, (_, description) in SUBCOMMANDS.items())
+    parser = argparse.ArgumentParser(description="Run GRAPE", epilog=epilog,
+                                     formatter_class=_MainHelpFormatter)
     parser.add_argument('--version', help='print version and exit', action='version',
                         version=f'%(prog)s {__version__}')
     
@@ -24,34 +132,171 @@ def __main__():
                                 'target gene list file (do not include control genes)')
     
     optional_group = parser.add_argument_group('Optional Arguments')
-    optional_group.add_argument('-p', '--output-prefix', type=str, required=False, help='Prefix for ' \
-                                'output files', default=DEFAULT_OUTPUT_PREFIX)
-    optional_group.add_argument('--min-reads', type=int, required=False, help='Minimum read count ' \
-                                'threshold for filtering samples', default=DEFAULT_MIN_READS)
-    optional_group.add_argument('--pseudocount', type=int, required=False, help='Pseudocount to avoid' \
-                                'devision by zero', default=DEFAULT_PSEUDOCOUNT)
-    optional_group.add_argument('--target-columns', required=False, help='Space-delimited list of ' \
-                                'target column names to average', nargs='+', 
-                                default=DEFAULT_TARGET_COLUMNS)
-    optional_group.add_argument('--no-mean-replicates', action='store_true', help='Disable averaging' \
-                                'across replicate columns', default=DEFAULT_NO_MEAN_REPLICATES)
-    optional_group.add_argument('--no-groupby-targets', action='store_true', help='Disable grouping ' \
-                                'by target gene', default=DEFAULT_NO_GROUPBY_TARGETS)
-    optional_group.add_argument('--nonessential-gene-file', type=str, help='Path to nonessential/' \
-                                'reference gene list', default=DEFAULT_NONESSENTIAL_GENE_FILE)
+    add_optional_arguments(optional_group)
+
+    arguments = parser.parse_args()
+    # imported after parsing, so --help and --version do not load the analysis stack
+    from grape.core.run import run
+    run(arguments)
+
+def batch_main(argv: List[str]) -> int:
+    """Parse command-line arguments of `grape batch` and run every screen of the manifest."""
+    parser = argparse.ArgumentParser(prog='grape batch', description="Run GRAPE on every screen " \
+                                     "listed in a manifest",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    required_group = parser.add_argument_group('Required Arguments')
+    required_group.add_argument('-m', '--manifest', type=str, required=True, help='TSV or JSON ' \
+                                'file listing input_filepath, control_columns, target_columns and ' \
+                                'output_prefix of each screen')
+    required_group.add_argument('-o', '--output-directory', type=str, required=True, help='Output ' \
+                                'directory path for screens that do not set their own')
+    required_group.add_argument('-t', '--target-gene-file', type=str, required=True, help='Path to ' \
+                                'target gene list file (do not include control genes)')
+
+    optional_group = parser.add_argument_group('Optional Arguments')
+    optional_group.add_argument('-c', '--control-columns', required=False, help='Control columns ' \
+                                'for screens that do not list their own', nargs='+', 
+                                default=DEFAULT_CONTROL_COLUMNS)
+    optional_group.add_argument('--workers', type=int, help='Number of worker processes. ' \
+                                'Defaults to the number of CPUs', default=DEFAULT_WORKERS)
+    add_optional_arguments(optional_group, per_screen=False)
+
+    arguments = parser.parse_args(argv)
+    from grape.core.batch import run_batch
+    results = run_batch(arguments)
+    return int((results['status'] != 'ok').any())
+
+def library_main(argv: List[str]) -> int:
+    """Parse command-line arguments of `grape build-library` and save the library."""
+    parser = argparse.ArgumentParser(prog='grape build-library', description="Precompute the " \
+                                     "regression design of a guide library for reuse by screens " \
+                                     "of that library (--library)",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    required_group = parser.add_argument_group('Required Arguments')
+    required_group.add_argument('-i', '--input-filepath', type=str, required=True, 
+                                help="Read count file of the library (only the construct and " \
+                                "target columns are read)")
+    required_group.add_argument('-t', '--target-gene-file', type=str, required=True, help='Path to ' \
+                                'target gene list file (do not include control genes)')
+    required_group.add_argument('-o', '--output', type=str, required=True, help='Path of the ' \
+                                'library file (.npz)')
+
+    optional_group = parser.add_argument_group('Optional Arguments')
     optional_group.add_argument('--query-gene-file', type=str, required=False, help='Path to query ' \
                                 'gene list', default=DEFAULT_QUERY_GENE_FILE)
+    optional_group.add_argument('--no-groupby-targets', action='store_true', help='Build the ' \
+                                'library of constructs instead of targets', 
+                                default=DEFAULT_NO_GROUPBY_TARGETS)
     optional_group.add_argument('--genepair-del', type=str, required=False, help = 'Delimiter used ' \
                                 'to separate gene pairs in index names.', default=DEFAULT_GENEPAIR_DEL)
     optional_group.add_argument('--fit-intercept', action='store_true', help = 'Whether to fit the ' \
                                 'intercept in regression', default=DEFAULT_FIT_INTERCEPT)
-    optional_group.add_argument('--half-window-size', type=int, help='Half window size for local ' \
-                                'variance', default=DEFAULT_HALF_WINDOW_SIZE)
-    optional_group.add_argument('--monotone-filter', action='store_true', help='Apply monotonic ' \
-                                'filter to local std devs', default=DEFAULT_MONOTONE_FILTER)
 
-    arguments = parser.parse_args()
-    run(arguments)
+    arguments = parser.parse_args(argv)
+    from grape.core.library import build_library
+    build_library(arguments)
+    return 0
+
+def sweep_main(argv: List[str]) -> int:
+    """Parse command-line arguments of `grape sweep` and run every setting of the grid."""
+    parser = argparse.ArgumentParser(prog='grape sweep', description="Run GRAPE for every " \
+                                     "combination of a grid of settings, computing the stages " \
+                                     "shared by settings once",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    required_group = parser.add_argument_group('Required Arguments')
+    required_group.add_argument('-i', '--input-filepath', type=str, required = True, 
+                                help="Input read count file path")
+    required_group.add_argument('-o', '--output-directory', type=str, required = True, help="Output " \
+                                "directory path")
+    required_group.add_argument('-c', '--control-columns', required=True, help='space-delimited list' \
+                                'of ints or strings of control columns (T0)', nargs='+')
+    required_group.add_argument('-t', '--target-gene-file', type=str, required=True, help='Path to ' \
+                                'target gene list file (do not include control genes)')
+    required_group.add_argument('-g', '--grid', required=True, nargs='+', help='Swept ' \
+                                'parameters as OPTION=VALUE,VALUE,... (e.g. half-window-size=' \
+                                '100,500 monotone-filter=false,true); "none" unsets an option')
+
+    optional_group = parser.add_argument_group('Optional Arguments')
+    optional_group.add_argument('--workers', type=int, help='Number of settings run ' \
+                                'concurrently. Defaults to the number of CPUs', 
+                                default=DEFAULT_WORKERS)
+    optional_group.add_argument('--fdr', type=float, help='FDR at which pairs are counted as ' \
+                                'synthetic or suppressor in the summary', default=DEFAULT_FDR)
+    add_optional_arguments(optional_group)
+
+    arguments = parser.parse_args(argv)
+    grid = _parse_grid(parser, arguments.grid)
+    del arguments.grid
+    from grape.core.sweep import run_sweep
+    summary = run_sweep(arguments, grid)
+    return int((summary['status'] != 'ok').any())
+
+def serve_main(argv: List[str]) -> int:
+    """Parse command-line arguments of `grape serve` and run the service."""
+    parser = argparse.ArgumentParser(prog='grape serve', description="Run GRAPE as a local " \
+                                     "service that accepts analysis jobs as JSON lines on a " \
+                                     "Unix socket or a localhost port",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--socket', type=str, help='Path of the Unix socket to listen on ' \
+                        '(instead of --host and --port)', default=DEFAULT_SERVE_SOCKET)
+    parser.add_argument('--host', type=str, help='Host to listen on', default=DEFAULT_SERVE_HOST)
+    parser.add_argument('--port', type=int, help='TCP port to listen on', 
+                        default=DEFAULT_SERVE_PORT)
+    parser.add_argument('--workers', type=int, help='Number of jobs run concurrently. Defaults ' \
+                        'to the number of CPUs', default=DEFAULT_WORKERS)
+    parser.add_argument('--max-warm', type=int, help='Number of gene lists, libraries and pair ' \
+                        'indices kept in memory across jobs', default=DEFAULT_MAX_WARM)
+
+    arguments = parser.parse_args(argv)
+    from grape.core.serve import serve
+    serve(arguments)
+    return 0
+
+def _parse_grid(parser: argparse.ArgumentParser, items: List[str]) -> dict:
+    """Values of every swept option of `grape sweep`, converted as on the command line."""
+    actions = {action.dest: action for action in parser._actions}
+    fixed = {'help', 'grid', 'workers', 'fdr', 'input_filepath', 'output_directory', 
+             'output_prefix', 'profile'}
+    grid = {}
+    for item in items:
+        name, _, values = item.partition('=')
+        dest = name.strip().lstrip('-').replace('-', '_')
+        action = actions.get(dest)
+        if not values or action is None or dest in fixed or action.nargs not in (None, 0):
+            parser.error(f"invalid grid parameter '{item}', expected OPTION=VALUE,VALUE,... for " \
+                         "a single-valued option")
+
+        parsed = []
+        for value in values.split(','):
+            value = value.strip()
+            if value.lower() == 'none':
+                parsed.append(None)
+            elif isinstance(action, argparse._StoreTrueAction):
+                if value.lower() not in ('true', 'false', '1', '0', 'yes', 'no'):
+                    parser.error(f"invalid value '{value}' of the flag {name} in the grid")
+                parsed.append(value.lower() in ('true', '1', 'yes'))
+            else:
+                try:
+                    parsed.append(action.type(value) if action.type else value)
+                except ValueError:
+                    parser.error(f"invalid value '{value}' of {name} in the grid")
+                if action.choices is not None and parsed[-1] not in action.choices:
+                    parser.error(f"invalid value '{value}' of {name} in the grid, expected one " \
+                                 f"of {', '.join(map(str, action.choices))}")
+        grid[dest] = parsed
+    return grid
+
+
+SUBCOMMANDS = {
+    'batch': (batch_main, 'Run GRAPE on every screen listed in a manifest'),
+    'build-library': (library_main, 'Precompute the regression design of a guide library'),
+    'sweep': (sweep_main, 'Run GRAPE for every combination of a grid of settings'),
+    'serve': (serve_main, 'Run GRAPE as a local service that accepts jobs over a socket'),
+}
+"""Subcommands of grape: entry point and description"""
 
 
 if __name__ == '__main__':
@@ -0,0 +1,419 @@
+"""
+This file holds the GRAPE analysis workflow as an in-memory API
+"""
+
+
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from grape.core.load_input import load_readcount_matrix
+from grape.core.foldchange_generator import *
+from grape.core.gi_matrix import gi_matrix_paths, write_gi_matrix
+from grape.core.library import GuideLibrary
+from grape.core.pair_index import PairIndex
+from grape.core.solver import GramSolver
+from grape.core.regression import *
+from grape.core.resampling import get_empirical_pvalues
+from grape.core.streaming import STREAM_CHUNK_SIZE, stream_mean_foldchange
+from grape.core.zscore_generator import *
+from grape.core.write_output import output_paths, write_outputs
+from grape.utils.cache import LRUCache, StageCache
+from grape.utils.profiler import StageProfiler
+
+
+PAIR_INDEX_CACHE_SIZE: int = 4
+"""Number of pair indices (libraries) kept in the state shared across analyses"""
+
+
+class GrapeResult:
+    """
+    Result of a GRAPE analysis.
+
+    With no_mean_replicates, `pairs`, `singles` and `model` are dicts keyed by fold-change column.
+
+    Attributes:
+        pairs : pd.DataFrame
+            Regression results, GI Z-scores, p-values and FDRs of gene pairs (get_zscore() output)
+        singles : pd.DataFrame
+            Observed and expected fold changes of single genes
+        modecenter_fc : pd.DataFrame
+            Mode-centered fold changes used as regression input
+        model : Dict
+            Regression metadata: Rsq, Intercept and Params
+        genepair_del : str
+            Delimiter of the gene-pair labels
+        pair_index : PairIndex, optional
+            Parsed labels of the regression, reused by the GI matrix export
+    """
+
+    def __init__(self, pairs: Union[pd.DataFrame, Dict[str, pd.DataFrame]],
+                 singles: Union[pd.DataFrame, Dict[str, pd.DataFrame]],
+                 modecenter_fc: pd.DataFrame, model: Dict, genepair_del: str = '_',
+                 pair_index: Optional[PairIndex] = None):
+        self.pairs = pairs
+        self.singles = singles
+        self.modecenter_fc = modecenter_fc
+        self.model = model
+        self.genepair_del = genepair_del
+        self.pair_index = pair_index
+
+    @property
+    def columns(self) -> Optional[List[str]]:
+        """
+        Fold-change columns analysed separately (no_mean_replicates), or None.
+        """
+        return list(self.pairs) if isinstance(self.pairs, dict) else None
+
+    def save(self, output_directory: str, output_prefix: Optional[str] = None,
+             output_format: str = 'txt', gi_matrix: Optional[str] = None):
+        """
+        Write grape_pairs, grape_singles and modecenter_meanfc files, one set per fold-change
+        column with no_mean_replicates (the column name is appended to the prefix). With
+        gi_matrix ('sparse' or 'dense'), also write the gene x gene matrices of GI_Zscore, GI_raw
+        and dLFC (see write_gi_matrix()).
+        """
+        if self.columns is None:
+            outputs = [(self.pairs, self.singles, self.modecenter_fc, output_prefix)]
+        else:
+            outputs = [(self.pairs[col], self.singles[col], self.modecenter_fc[[col]], prefix)
+                       for col, prefix in zip(self.columns, self._column_prefixes(output_prefix))]
+
+        for pairs, singles, modecenter_fc, prefix in outputs:
+            write_outputs(pairs, singles, modecenter_fc, output_directory, prefix, output_format)
+            if gi_matrix is not None:
+                write_gi_matrix(pairs, singles.index, output_directory, prefix, gi_matrix,
+                                self.genepair_del, self.pair_index)
+
+    def output_paths(self, output_directory: str, output_prefix: Optional[str] = None,
+                     output_format: str = 'txt', gi_matrix: Optional[str] = None) -> List[str]:
+        """
+        Paths of the files written by save().
+        """
+        prefixes = [output_prefix] if self.columns is None else \
+                   self._column_prefixes(output_prefix)
+        paths = []
+        for prefix in prefixes:
+            paths += output_paths(output_directory, prefix, output_format)
+            if gi_matrix is not None:
+                paths += gi_matrix_paths(output_directory, prefix, gi_matrix)
+        return paths
+
+    def _column_prefixes(self, output_prefix: Optional[str]) -> List[str]:
+        return [f"{output_prefix.rstrip('_')}_{col}" if output_prefix else str(col)
+                for col in self.columns]
+
+
+def analyze(reads: Union[pd.DataFrame, str], control_columns: Iterable,
+            target_genes: Iterable[str], target_columns: Optional[Iterable[str]] = None,
+            min_reads: int = 0, pseudocount: int = 1, float32: bool = False,
+            streaming: bool = False, chunk_size: int = STREAM_CHUNK_SIZE,
+            no_mean_replicates: bool = False,
+            no_groupby_targets: bool = False, nonessential_genes: Optional[Iterable[str]] = None,
+            query_genes: Optional[Iterable[str]] = None, genepair_del: str = '_',
+            sparse: bool = False, mode_method: str = 'kde', regression_backend: str = 'sklearn',
+            block_solve: bool = False, fit_intercept: bool = False,
+            incremental_filter: bool = False, iterate_filter: bool = False,
+            half_window_size: int = 500, window_step: Optional[int] = None,
+            monotone_filter: bool = False, diagnostics: bool = False, resamples: int = 0,
+            resample_method: str = 'permutation', seed: Optional[int] = None,
+            threads: Optional[int] = None, library: Optional[Union[GuideLibrary, str]] = None,
+            cache: Optional[StageCache] = None, shared: Optional[Dict] = None,
+            profiler: Optional[StageProfiler] = None) -> GrapeResult:
+    """
+    Run the GRAPE analysis in memory: fold changes, mode-centering, regression, dynamic range
+    filter and GI Z-scores. Nothing is written to disk (except stage outputs, if `cache` is
+    enabled).
+
+    Parameters:
+        reads: pd.DataFrame or str
+            Read count matrix (index is unique ID, first column is target), or the path to a read
+            count file
+        control_columns: Iterable
+            Control column labels or positions (T0)
+        target_genes: Iterable[str]
+            Target genes (do not include control genes)
+        target_columns: Iterable[str], optional
+            Target columns to average. If None, all non-control columns are used.
+        min_reads, pseudocount: int
+            See get_foldchange_matrix()
+        float32: bool
+            Compute and average fold changes in float32 instead of float64. Default False.
+        streaming: bool
+            Compute the mean fold changes in two passes over the read count file, `chunk_size`
+            rows at a time, instead of loading it (see stream_mean_foldchange()). Requires a file
+            path. Default False.
+        no_mean_replicates: bool
+            Analyse every fold-change column separately instead of averaging replicates.
+            Default False.
+        no_groupby_targets: bool
+            Disable grouping by target gene. Default False.
+        nonessential_genes: Iterable[str], optional
+            Reference genes for mode-centering. If None, the mode of the full fold-change
+            distribution is used.
+        query_genes: Iterable[str], optional
+            Genes added to the target genes
+        genepair_del: str
+            Delimiter used to separate gene pairs in index names. Default "_".
+        sparse: bool
+            Use a sparse predictor matrix and solver. Default False.
+        mode_method: str
+            Mode estimator of mode_center(), 'kde' or 'fft'. Default 'kde'.
+        regression_backend: str
+            Least-squares backend of a dense regression, 'sklearn' or 'numpy'. Default 'sklearn'.
+        block_solve: bool
+            Solve the connected components of the regression independently, in `threads` 
+            threads (no effect with fit_intercept). Default False.
+        fit_intercept: bool
+            Whether to fit an intercept in the regression. Default False.
+        incremental_filter: bool
+            Refit after the dynamic range filter by downdating the first regression. Default False.
+        iterate_filter: bool
+            Repeat the dynamic range filter until no more pairs are removed. Default False.
+        half_window_size, window_step, monotone_filter:
+            See get_zscore()
+        diagnostics: bool
+            Add the closed-form leave-one-out diagnostics of the final regression (leverage,
+            loo_resid and cooks_d, see influence_diagnostics()) to the pairs and singles.
+            Default False.
+        resamples, resample_method, seed, threads:
+            See get_empirical_pvalues(). No resampling if resamples is 0 (default).
+        library: GuideLibrary or str, optional
+            Precomputed regression design of the guide library (see build_library()), or the path
+            to a saved one. If it matches the screen, the predictor matrix and its factorization
+            are loaded instead of being built, and the filter downdates the stored factorization.
+            A library built for another construct set or target gene list is ignored.
+        cache: StageCache, optional
+            Cache of stage outputs. Default is no caching.
+        shared: Dict, optional
+            State reused across calls on the same library (the pair indices of the last
+            PAIR_INDEX_CACHE_SIZE libraries)
+        profiler: StageProfiler, optional
+            Records time, memory and output size of every stage. Default is no profiling.
+
+    Returns:
+        GrapeResult
+    """
+    cache = StageCache() if cache is None else cache
+    profiler = StageProfiler(enabled=False) if profiler is None else profiler
+    profile = profiler.profile
+    shared = {} if shared is None else shared
+    control_columns = list(control_columns)
+    target_columns = list(target_columns) if target_columns is not None else None
+    noness = list(nonessential_genes) if nonessential_genes is not None else None
+    # blocks are solved from the sparse design, so the predictor matrix is never densified
+    sparse = sparse or block_solve
+    if isinstance(library, str):
+        library = GuideLibrary.load(library)
+
+    # 01: load input read count file. When the samples are known by name, only the control and
+    # target columns are read.
+    usecols = None
+    if isinstance(reads, pd.DataFrame):
+        reads_digest = cache.frame_digest(reads)
+        load_reads = lambda: reads
+    else:
+        if target_columns and not no_mean_replicates:
+            try:
+                list(map(int, control_columns))
+            except ValueError:
+                usecols = control_columns + target_columns
+        reads_digest = cache.file_digest(reads)
+        load_reads = lambda: profile('load', load_readcount_matrix, reads, columns=usecols,
+                                     compact_dtypes=True)
+
+    # 02: generate fold change input. Streaming goes from the file to the mean fold changes
+    # without materializing the read counts or the construct-level fold changes.
+    if streaming and isinstance(reads, pd.DataFrame):
+        raise ValueError('streaming requires the path of a read count file')
+    fc_dtype = np.float32 if float32 else np.float64
+    raw_fc = cache.stage('foldchange', [reads_digest, usecols, control_columns, min_reads,
+                                        pseudocount, float32],
+                         lambda: profile('foldchange', get_foldchange_matrix, load_reads(),
+                                         control_columns, min_reads, pseudocount, fc_dtype))
+    if streaming:
+        fc = cache.stage('mean_foldchange', [reads_digest, usecols, control_columns, min_reads,
+                                             pseudocount, float32, target_columns,
+                                             no_mean_replicates, no_groupby_targets],
+                         lambda: profile('mean_foldchange', stream_mean_foldchange, reads,
+                                         control_columns, target_columns, no_mean_replicates,
+                                         no_groupby_targets, min_reads, pseudocount, fc_dtype,
+                                         chunk_size, usecols))
+    else:
+        fc = cache.stage('mean_foldchange', [raw_fc.key, target_columns, no_mean_replicates,
+                                             no_groupby_targets],
+                         lambda: profile('mean_foldchange', get_mean_foldchange, raw_fc(),
+                                         target_columns, no_mean_replicates, no_groupby_targets))
+    if noness is None:
+        modecenter_meanfc = cache.stage('mode_center', [fc.key, mode_method],
+                                        lambda: profile('mode_center', mode_center, 
+                                                        fc().copy(), mode_method))
+        # mode_center() centres in place (here a copy, as the mean fold changes may be shared
+        # with other analyses), so the filter starts from the centred values
+        filter_base = modecenter_meanfc
+    else:
+        modecenter_meanfc = cache.stage('mode_center', [fc.key, noness],
+                                        lambda: profile('mode_center',
+                                                        mode_center_vs_reference_genes, fc(),
+                                                        noness))
+        filter_base = fc
+
+    # 03: target gene list
+    target_gene_list = list(target_genes)
+    if query_genes is not None:
+        target_gene_list = list(set(target_gene_list + list(query_genes)))
+
+    # 04: run regression. Without averaging, every replicate column is a response of one shared
+    # regression.
+    regress = do_multi_regression if no_mean_replicates else do_regression
+    fitted = {}
+    def regression_inputs():
+        if not fitted:
+            labels = modecenter_meanfc().index
+            if library is not None:
+                if library.matches(labels, target_gene_list, genepair_del, fit_intercept):
+                    fitted['pair_index'] = library.pair_index
+                    fitted['predictor'] = library.predictor_matrix()
+                    fitted['obs'] = modecenter_meanfc().loc[library.rows.values]
+                    fitted['solver'] = profile('predictor', library.solver)
+                    print('[INFO] regression matrix rows: {:5d}, cols: {:3d} (library)'.format(
+                        *fitted['predictor'].shape))
+                    return fitted
+                print('[INFO] Library does not match the constructs or target genes of the '
+                      'screen; rebuilding the regression.')
+            # pair indices of the last few libraries are kept, keyed cheaply and verified
+            pair_indices = shared.setdefault('pair_indices', LRUCache(PAIR_INDEX_CACHE_SIZE))
+            index_key = (genepair_del, len(labels), str(labels[0]) if len(labels) else None,
+                         str(labels[-1]) if len(labels) else None)
+            pair_index = pair_indices.get(index_key)
+            if pair_index is None or not pair_index.labels.equals(labels):
+                pair_index = pair_indices[index_key] = profile('pair_index', PairIndex, 
+                                                               labels.values, genepair_del)
+            fitted['pair_index'] = pair_index
+            fitted['predictor'], fitted['obs'] = profile(
+                'predictor', make_predictor_matrix, modecenter_meanfc(), target_gene_list, 
+                genepair_del, sparse, pair_index)
+            fitted['solver'] = profile('predictor', make_solver, fitted['predictor'], 
+                                       fit_intercept, block_solve, threads) \
+                               if incremental_filter else None
+        return fitted
+
+    regression = cache.stage('regression', [modecenter_meanfc.key, sorted(target_gene_list),
+                                            genepair_del, fit_intercept, sparse,
+                                            incremental_filter, regression_backend, block_solve,
+                                            library.fingerprint if library else None],
+                             lambda: profile('regression', regress, 
+                                             regression_inputs()['predictor'], fitted['obs'],
+                                             fit_intercept, genepair_del, fitted['pair_index'],
+                                             fitted['solver'], regression_backend, block_solve,
+                                             threads))
+
+    # 05: apply dynamic range filter and re-run regression
+    def filter_regression():
+        inputs = regression_inputs()
+        return _filter_regression(regression()[0], filter_base(), noness, target_gene_list,
+                                  inputs['pair_index'], inputs['predictor'], inputs['solver'],
+                                  genepair_del, sparse, fit_intercept, mode_method,
+                                  iterate_filter, profiler, regression_backend, block_solve,
+                                  threads, diagnostics)
+
+    filtered_regression = cache.stage(
+        'filtered_regression', [regression.key, incremental_filter, iterate_filter, diagnostics],
+        filter_regression)
+    pairs, singles, model = filtered_regression()
+    modecenter_meanfc = modecenter_meanfc()
+
+    # 06: calculate GI Zscore, of all columns at once without averaging
+    empirical = lambda zscore_df, singles_df: profile(
+        'resampling', get_empirical_pvalues, zscore_df, singles_df, resamples, resample_method, 
+        fit_intercept, seed, threads, genepair_del, fitted.get('pair_index'))
+    if no_mean_replicates:
+        for col in model:
+            print(f"[INFO] Regression R² ({col}): {model[col]['Rsq']:.3f}, "
+                  f"Intercept: {model[col]['Intercept']}")
+
+        pairs_localZ = profile('zscore', get_multi_zscore, pairs, half_window_size, 
+                               monotone_filter, window_step)
+        if resamples:
+            for col in pairs_localZ:
+                pairs_localZ[col] = empirical(pairs_localZ[col], singles[col])
+        if diagnostics:
+            singles = {col: singles[col].join(model[col]['Diagnostics']) for col in singles}
+            pairs_localZ = {col: pairs_localZ[col].join(model[col]['Diagnostics']) 
+                            for col in pairs_localZ}
+    else:
+        print(
+            f"[INFO] Regression R²: {model['Rsq']:.3f}, Intercept: {model['Intercept']}")
+
+        pairs_localZ = profile('zscore', get_zscore, pairs, half_window_size, monotone_filter, 
+                               window_step)
+        if resamples:
+            pairs_localZ = empirical(pairs_localZ, singles)
+        if diagnostics:
+            singles = singles.join(model['Diagnostics'])
+            pairs_localZ = pairs_localZ.join(model['Diagnostics'])
+
+    return GrapeResult(pairs_localZ, singles, modecenter_meanfc, model, genepair_del,
+                       fitted.get('pair_index'))
+
+
+def _filter_regression(pairs: Union[pd.DataFrame, Dict[str, pd.DataFrame]], fc: pd.DataFrame,
+                       noness: Optional[List[str]], target_gene_list: List[str],
+                       pair_index: PairIndex, predictor: pd.DataFrame,
+                       solver: Optional[GramSolver], genepair_del: str, sparse: bool,
+                       fit_intercept: bool, mode_method: str, iterate_filter: bool,
+                       profiler: Optional[StageProfiler] = None,
+                       regression_backend: str = 'sklearn', block_solve: bool = False,
+                       n_jobs: Optional[int] = None, diagnostics: bool = False) -> Tuple:
+    """
+    Apply the dynamic range filter to the first regression and re-run the regression, either by
+    rebuilding it or, with a solver, by downdating its factorization. With iterate_filter the
+    filter is repeated until no more pairs are removed. If `pairs` is keyed by fold-change column
+    (do_multi_regression() output), so are the outputs. With diagnostics, the final regression
+    also returns its influence_diagnostics().
+    """
+    profiler = StageProfiler(enabled=False) if profiler is None else profiler
+    multi = isinstance(pairs, dict)
+    regress = do_multi_regression if multi else do_regression
+    fc_filt = fc
+    n_filter = 0
+    while True:
+        if multi:
+            # responses share the design matrix: remove pairs out of range in any column
+            remove_me = pd.concat([dynamic_range_filter(x) for x in pairs.values()])
+            remove_me = remove_me[~remove_me.index.duplicated()]
+        else:
+            remove_me = dynamic_range_filter(pairs)
+        print(f'[INFO] Dynamic range filter removed {len(remove_me)} gene pairs.')
+        if n_filter > 0 and len(remove_me) == 0:
+            break
+
+        def apply_filter(fc_filt, predictor, solver):
+            fc_filt = fc_filt.drop(remove_me.index.values, axis=0, errors='ignore')
+
+            if noness is None:
+                modecenter_meanfc_filt = mode_center(fc_filt, mode_method)
+            else:
+                modecenter_meanfc_filt = mode_center_vs_reference_genes(fc_filt, noness)
+
+            if solver is None:
+                predictor, obs = make_predictor_matrix(modecenter_meanfc_filt, target_gene_list,
+                                                       genepair_del, sparse, pair_index)
+            else:
+                # downdate the first factorization instead of rebuilding the regression
+                removed = predictor.index.isin(remove_me.index.values)
+                solver = solver.remove_rows(np.where(removed)[0])
+                predictor = predictor.iloc[np.where(~removed)[0]]
+                obs = modecenter_meanfc_filt.loc[predictor.index.values]
+            return predictor, obs, solver, fc_filt
+
+        predictor, obs, solver, fc_filt = profiler.profile('filter', apply_filter, fc_filt,
+                                                           predictor, solver)
+        pairs, singles, model = profiler.profile('regression_filtered', regress, predictor, obs,
+                                                 fit_intercept, genepair_del, pair_index, solver,
+                                                 regression_backend, block_solve, n_jobs,
+                                                 diagnostics)
+
+        n_filter += 1
+        if not iterate_filter:
+            break
+
+    return pairs, singles, model
@@ -0,0 +1,169 @@
+"""
+This file runs GRAPE on many screens of the same library in a process pool
+"""
+
+import json
+import os
+import time
+import traceback
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from grape.core.load_input import load_genelist
+from grape.core.run import run
+
+
+MANIFEST_FIELDS = ('input_filepath', 'control_columns', 'target_columns', 'output_prefix',
+                   'output_directory')
+"""Per-screen fields of a batch manifest"""
+
+LIST_FIELDS = ('control_columns', 'target_columns')
+
+BATCH_SUMMARY: str = 'batch_summary.txt'
+"""File in the batch output directory reporting the status of every screen"""
+
+# state shared by all screens run in a worker process
+_SHARED: Dict = {}
+
+
+def load_manifest(filepath: str, control_columns: Optional[List[str]] = None) -> List[Dict]:
+    """
+    Load a batch manifest.
+
+    A manifest is either a tab-delimited file with one screen per row, or a JSON list of objects
+    (optionally under a "screens" key). Fields are input_filepath, control_columns,
+    target_columns, output_prefix and output_directory; hyphens may be used instead of
+    underscores. In TSV manifests, column lists are space- or comma-separated.
+
+    Parameters:
+        filepath: str
+            The path to the manifest
+        control_columns: List[str], optional
+            Control columns of screens that do not list their own
+
+    Returns:
+        List of screens, each a dict of manifest fields
+    """
+    with open(filepath, 'r', encoding='utf-8') as infile:
+        content = infile.read()
+
+    if filepath.lower().endswith('.json') or content.lstrip()[:1] in ('[', '{'):
+        screens = json.loads(content)
+        if isinstance(screens, dict):
+            screens = screens['screens']
+    else:
+        table = pd.read_csv(filepath, sep='\t', dtype=str, keep_default_na=False)
+        screens = [{k: v for k, v in row.items() if v != ''} for row in table.to_dict('records')]
+
+    parsed = []
+    for i, screen in enumerate(screens):
+        screen = {str(k).strip().replace('-', '_'): v for k, v in screen.items()}
+        unknown = set(screen) - set(MANIFEST_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown manifest field(s) in screen {i + 1}: "
+                             f"{', '.join(sorted(unknown))}")
+        if 'input_filepath' not in screen:
+            raise ValueError(f'Screen {i + 1} of the manifest has no input_filepath')
+
+        for field in LIST_FIELDS:
+            if isinstance(screen.get(field), str):
+                screen[field] = screen[field].replace(',', ' ').split()
+        screen.setdefault('control_columns', control_columns)
+        if not screen['control_columns']:
+            raise ValueError(f'Screen {i + 1} of the manifest has no control_columns')
+        screen.setdefault('target_columns', None)
+        screen.setdefault('output_prefix',
+                          os.path.splitext(os.path.basename(screen['input_filepath']))[0])
+        parsed.append(screen)
+
+    outputs = [(x.get('output_directory'), x['output_prefix']) for x in parsed]
+    duplicates = {x[1] for x in outputs if outputs.count(x) > 1}
+    if duplicates:
+        raise ValueError(f"Screens would overwrite each other's outputs, set distinct "
+                         f"output_prefix values: {', '.join(sorted(duplicates))}")
+
+    return parsed
+
+def run_batch(args: Namespace) -> pd.DataFrame:
+    """
+    Run every screen of a manifest. Screens run concurrently in `args.workers` processes which
+    share the parsed gene lists and the pair index of the library. A failing screen is reported
+    and does not stop the others.
+
+    Parameters:
+        args: Namespace
+            Arguments of `grape batch`: the analysis options of a single run plus manifest and
+            workers
+
+    Returns:
+        results: pd.DataFrame
+            One row per screen with its status ('ok' or 'failed'), run time and error message.
+            Also saved to batch_summary.txt in the output directory.
+    """
+    screens = load_manifest(args.manifest, args.control_columns)
+    gene_lists = {path: load_genelist(path) for path in
+                  (args.target_gene_file, args.query_gene_file, args.nonessential_gene_file)
+                  if path is not None}
+
+    jobs = []
+    for screen in screens:
+        screen_args = Namespace(**vars(args))
+        del screen_args.manifest, screen_args.workers
+        for field, value in screen.items():
+            setattr(screen_args, field, value)
+        if screen_args.output_directory is None:
+            screen_args.output_directory = args.output_directory
+        os.makedirs(screen_args.output_directory, exist_ok=True)
+        jobs.append(screen_args)
+    os.makedirs(args.output_directory, exist_ok=True)
+
+    workers = min(args.workers or os.cpu_count() or 1, len(jobs))
+    print(f'[INFO] Running {len(jobs)} screens with {workers} workers.')
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(gene_lists,)) as pool:
+        futures = {pool.submit(_run_screen, job): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            job = jobs[i]
+            try:
+                status, seconds, error = future.result()
+            except Exception as e:
+                # the worker process died
+                status, seconds, error = 'failed', float('nan'), f'{type(e).__name__}: {e}'
+
+            if status == 'ok':
+                print(f'[INFO] Screen {job.output_prefix} finished in {seconds:.1f} s.')
+            else:
+                print(f'[ERROR] Screen {job.output_prefix} failed: {error}')
+            results.append({'job': i, 'screen': job.output_prefix, 'input_filepath': job.input_filepath,
+                            'output_directory': job.output_directory, 'status': status,
+                            'seconds': round(seconds, 3), 'error': error})
+
+    # in manifest order; screens may share a prefix in different output directories
+    results = sorted(results, key=lambda row: row['job'])
+    results = pd.DataFrame(results, columns=['screen', 'input_filepath', 'output_directory',
+                                             'status', 'seconds', 'error'])
+    summary_path = os.path.join(args.output_directory, BATCH_SUMMARY)
+    results.to_csv(summary_path, sep='\t', index=False)
+
+    n_ok = (results['status'] == 'ok').sum()
+    print(f'[INFO] Batch complete: {n_ok} of {len(results)} screens succeeded. '
+          f'Summary saved to {summary_path}.')
+    return results
+
+def _init_worker(gene_lists: Dict[str, List[str]]):
+    _SHARED['gene_lists'] = gene_lists
+
+def _run_screen(args: Namespace):
+    start = time.time()
+    try:
+        run(args, _SHARED)
+    except Exception as e:
+        traceback.print_exc()
+        return 'failed', time.time() - start, f'{type(e).__name__}: {e}'
+    return 'ok', time.time() - start, ''
@@ -8,10 +8,25 @@ from typing import List, Union, Optional
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
+from scipy import signal
+
+from grape.utils.defaults import MODE_METHODS
+
+
+MODE_GRID_START: float = -5.
+MODE_GRID_STEP: float = 9 / 900
+"""Origin and spacing of the grid the mode is located on (that of np.linspace(-5, 4, 901))"""
+
+MODE_KERNEL_TRUNCATE: float = 5.
+"""Kernel support of the FFT estimator, in bandwidths"""
+
+MODE_MAX_GRID_POINTS: int = 2**20
+"""Maximum grid size of the FFT estimator; the grid spacing is widened beyond it"""
 
 
 def get_foldchange_matrix(reads_df: pd.DataFrame, control_columns: Union[List[str], List[int]], 
-						  min_reads: int = 0, pseudocount: int = 1) -> pd.DataFrame:
+						  min_reads: int = 0, pseudocount: int = 1, 
+						  dtype: Union[str, np.dtype] = np.float64) -> pd.DataFrame:
 	"""
     Given a dataframe of raw read counts,
     1. filter for T0 min read counts.
@@ -24,10 +39,15 @@ def get_foldchange_matrix(reads_df: pd.DataFrame, control_columns: Union[List[st
         control_columns : List[str] or List[int]
             Either a list of control sample labels (column names) or a list of their column indices
         min_reads : int, optional
-            Minimum read count threshold for filtering samples #TODO(Juihsuan) add later. Default is 0.
+            Minimum read count of a construct, summed over the control columns. Constructs below 
+			it are removed before the library sizes and fold changes are computed; targets left 
+			with no constructs drop out of the output. Default is 0 (no filter).
         pseudocount : int, optional
             Small value added to read counts to avoid division by zero and log transformations of 
 			zero. Default is 1.
+        dtype : str or np.dtype, optional
+            Float dtype of the fold changes. np.float32 halves the memory of wide count tables; 
+            library sizes are always summed in float64. Default is np.float64.
 
     Returns:
         pd.DataFrame
@@ -46,16 +66,65 @@ def get_foldchange_matrix(reads_df: pd.DataFrame, control_columns: Union[List[st
 	target_column_labels = [x for x in reads_df.columns.values if x not in control_column_labels]
 	# target_column_labels[0] should still be the target gene
 
-	ctrl_sum = reads_df[control_column_labels].sum(axis=1)
-	fc_df = pd.DataFrame(index=reads_df.index.values, columns=target_column_labels, data=0.)
-	fc_df[target_column_labels[0]] = reads_df[target_column_labels[0]] 
-	for col_name in target_column_labels[1:]:
-		fc_df[col_name] = np.log2(((reads_df[col_name].values + pseudocount)/
-							        sum(reads_df[col_name].values)) /
-		                           ((ctrl_sum + pseudocount) / sum(ctrl_sum)))
+	# counts may be stored in compact integer dtypes: library sizes are summed in float64, and the
+	# ratios of all target columns are computed at once on one block of `dtype`
+	ctrl_sum = reads_df[control_column_labels].to_numpy(np.float64).sum(axis=1)
+	sample_labels = target_column_labels[1:]
+	fc = reads_df[sample_labels].to_numpy(dtype, copy=True)
+	index = reads_df.index.values
+	targets = reads_df[target_column_labels[0]].values
+
+	# min read filter: one mask over the control totals, applied to the arrays
+	keep = min_reads_mask(ctrl_sum, min_reads)
+	if keep is not None:
+		if not keep.any():
+			raise ValueError(f'--min-reads {min_reads} removes all constructs (max control count '
+							 f'{ctrl_sum.max(initial=0):g})')
+		report_min_reads(len(keep), keep.sum(), len(pd.unique(targets)), 
+						 len(pd.unique(targets[keep])), min_reads)
+		ctrl_sum, fc, index, targets = ctrl_sum[keep], fc[keep], index[keep], targets[keep]
+
+	ctrl_norm = ((ctrl_sum + pseudocount) / ctrl_sum.sum()).astype(dtype, copy=False)
+	library_size = fc.sum(axis=0, dtype=np.float64).astype(dtype)
+	fc += pseudocount
+	fc /= library_size
+	fc /= ctrl_norm[:, None]
+	np.log2(fc, out=fc)
+
+	fc_df = pd.DataFrame(fc, index=index, columns=sample_labels)
+	fc_df.insert(0, target_column_labels[0], targets)
 
 	return fc_df
 
+def min_reads_mask(ctrl_sum: np.ndarray, min_reads: int = 0) -> Optional[np.ndarray]:
+	"""
+	Constructs passing the min read filter: those with at least `min_reads` control reads.
+
+	Parameters:
+        ctrl_sum : np.ndarray
+            Read count of every construct summed over the control columns
+        min_reads : int
+            Minimum read count threshold
+
+	Returns:
+        np.ndarray or None
+            Boolean mask of the constructs kept, or None if every construct passes
+	"""
+	if min_reads <= 0:
+		return None
+	keep = ctrl_sum >= min_reads
+	return None if keep.all() else keep
+
+def report_min_reads(n_constructs: int, n_kept: int, n_targets: int, n_targets_kept: int,
+					 min_reads: int):
+	"""
+	Print the number of constructs removed by the min read filter and the number of targets 
+	(genes or gene pairs) left with no construct, which drop out of the regression.
+	"""
+	print(f'[INFO] Removed {n_constructs - n_kept} of {n_constructs} constructs with fewer than '
+		  f'{min_reads} control reads; {n_targets - n_targets_kept} of {n_targets} targets have '
+		  f'no construct left.')
+
 def get_mean_foldchange(fc_df: pd.DataFrame, target_columns: Optional[List[str]] = None, 
 						no_mean_replicates: bool = False, no_groupby_targets: bool = False) -> pd.DataFrame:
 	"""
@@ -82,49 +151,112 @@ def get_mean_foldchange(fc_df: pd.DataFrame, target_columns: Optional[List[str]]
 		# use target columns
 		target_columns = target_columns
 	else:
-		# use all columns
-		target_columns = fc_df.columns.values
+		# use all columns except the target gene
+		target_columns = fc_df.columns.values[1:]
 
 	if no_mean_replicates:
 		outcols = fc_df.columns.values
 	else:
 		outcols = [fc_df.columns.values[0], 'meanFC']
 
-	mean_fc_df = pd.DataFrame(index = fc_df.index.values, columns=outcols, data=0.)
-	mean_fc_df[outcols[0]] = fc_df[outcols[0]]
-
+	# fold changes keep their dtype (e.g. float32) through the mean and the groupby
 	if no_mean_replicates:
-		mean_fc_df[outcols[1:]] = fc_df[fc_df.columns.values[1:]]
+		mean_fc_df = fc_df.set_axis(fc_df.index.values, axis=0, copy=True)
 	else:
-		mean_fc_df[outcols[1]] = fc_df[target_columns].mean(1)
+		mean_fc_df = pd.DataFrame({outcols[0]: fc_df[outcols[0]].values, 
+								   outcols[1]: fc_df[target_columns].mean(1).values}, 
+								  index=fc_df.index.values)
 
 	if not no_groupby_targets:
-		mean_fc_df = mean_fc_df.groupby(outcols[0]).mean()
+		mean_fc_df = mean_fc_df.groupby(outcols[0], observed=True).mean()
+		if isinstance(mean_fc_df.index, pd.CategoricalIndex):
+			# categorical target-gene column from load_readcount_matrix(compact_dtypes=True)
+			mean_fc_df.index = mean_fc_df.index.astype(object)
 
 	return mean_fc_df
 
-def mode_center(mean_fc_df: pd.DataFrame) -> pd.DataFrame:
+def mode_center(mean_fc_df: pd.DataFrame, method: str = 'kde') -> pd.DataFrame:
 	"""
 	Assumes a fold change df where the index is the target gene(s). Normalize fold-change 
-	mode to zero across entire distribution.
+	mode to zero across entire distribution. Every fold-change column (e.g. each replicate kept
+	by no_mean_replicates) is centred on its own mode.
 	
 	Parameters:
         mean_fc_df: pd.DataFrame
             DataFrame containing fold-change values, where the index represents target genes
+        method: str
+            'kde' evaluates a Gaussian KDE of the fold changes on a fixed grid from -5 to 4 in 
+            steps of 0.01. 'fft' uses kde_mode_fft(), which covers the range of the data on the 
+            same grid spacing and costs O(n) instead of O(n x grid). Default is 'kde'.
 			
 	Returns:
         pd.DataFrame
             Mode-centered fold-change values
     """
+	if method not in MODE_METHODS:
+		raise ValueError(f"Unknown mode method '{method}', expected one of {', '.join(MODE_METHODS)}")
+
 	xx = np.linspace(-5, 4, 901)
-	fc_col = mean_fc_df.columns[-1]
-	kx = stats.gaussian_kde(mean_fc_df[fc_col].astype(float))
-	mode_x = xx[np.argmax(kx.evaluate(xx))]
+	for fc_col in mean_fc_df.select_dtypes('number').columns:
+		if method == 'fft':
+			mode_x = kde_mode_fft(mean_fc_df[fc_col].values.astype(float))
+		else:
+			kx = stats.gaussian_kde(mean_fc_df[fc_col].astype(float))
+			mode_x = xx[np.argmax(kx.evaluate(xx))]
 
-	mean_fc_df[fc_col] = mean_fc_df[fc_col] - mode_x
+		mean_fc_df[fc_col] = mean_fc_df[fc_col] - mode_x
 
 	return mean_fc_df
 
+def kde_mode_fft(values: np.ndarray, refine: int = 2) -> float:
+	"""
+	Mode of the Gaussian KDE of `values` (Scott's bandwidth, as scipy's gaussian_kde), located on 
+	the grid -5 + i * 0.01 used by mode_center() but extended over the range of the data.
+
+	The values are linearly binned onto the grid and the binned counts are convolved with the
+	Gaussian kernel by FFT. The `refine` grid points on either side of the binned maximum are then
+	evaluated with the exact KDE, so the result matches the exact grid maximum.
+
+	Parameters:
+        values: np.ndarray
+            Fold-change values
+        refine: int
+            Number of neighbouring grid points on each side evaluated exactly. Default is 2.
+
+	Returns:
+        float
+            Grid point with the highest density
+	"""
+	values = np.asarray(values, dtype=float)
+	kde = stats.gaussian_kde(values)
+	bandwidth = float(np.sqrt(kde.covariance[0, 0]))
+
+	# grid aligned with np.linspace(-5, 4, 901), covering the data and the kernel tails
+	step = MODE_GRID_STEP
+	lower = values.min() - MODE_KERNEL_TRUNCATE * bandwidth
+	upper = values.max() + MODE_KERNEL_TRUNCATE * bandwidth
+	if (upper - lower) / step > MODE_MAX_GRID_POINTS:
+		step *= np.ceil((upper - lower) / step / MODE_MAX_GRID_POINTS)
+	first = int(np.floor((lower - MODE_GRID_START) / step))
+	last = int(np.ceil((upper - MODE_GRID_START) / step))
+	grid = np.arange(first, last + 1).astype(float) * step + MODE_GRID_START
+
+	# linear binning
+	position = (values - grid[0]) / step
+	left = np.clip(np.floor(position).astype(np.int64), 0, len(grid) - 2)
+	weight = position - left
+	counts = np.bincount(left, weights=1. - weight, minlength=len(grid)) + \
+			 np.bincount(left + 1, weights=weight, minlength=len(grid))
+
+	half_width = int(np.ceil(MODE_KERNEL_TRUNCATE * bandwidth / step))
+	offsets = np.arange(-half_width, half_width + 1) * step
+	kernel = np.exp(-0.5 * (offsets / bandwidth)**2)
+	density = signal.fftconvolve(counts, kernel, mode='same')
+
+	best = int(np.argmax(density))
+	candidates = grid[max(best - refine, 0) : best + refine + 1]
+	return candidates[np.argmax(kde.evaluate(candidates))]
+
 def mode_center_vs_reference_genes(mean_fc_df: pd.DataFrame, noness_genes: List[str]) \
 	-> pd.DataFrame:
 	"""
@@ -141,7 +273,7 @@ def mode_center_vs_reference_genes(mean_fc_df: pd.DataFrame, noness_genes: List[
         pd.DataFrame
             Fold-change values normalized relative to the median of reference genes
     """
-	nonidx = [x for x in mean_fc_df.index.values if x in noness_genes]
+	nonidx = mean_fc_df.index.isin(noness_genes)
 	modecenter_fc_df = mean_fc_df - mean_fc_df.loc[nonidx].median()
 
 	return modecenter_fc_df
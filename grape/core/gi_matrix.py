@@ -0,0 +1,155 @@
+"""
+This file builds symmetric gene x gene genetic interaction matrices from the GRAPE pair scores
+"""
+
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from grape.core.pair_index import PairIndex
+from grape.utils.defaults import GI_MATRIX_LAYOUTS
+
+
+GI_MATRIX_VALUES: Tuple[str, ...] = ('GI_Zscore', 'GI_raw', 'dLFC')
+"""Pair scores exported as gene x gene matrices"""
+
+
+def gi_matrix(pairs: pd.DataFrame, genes: Iterable[str], genepair_del: str = '_',
+			  pair_index: Optional[PairIndex] = None,
+			  values: Iterable[str] = GI_MATRIX_VALUES) -> Dict[str, sp.csr_matrix]:
+	"""
+	Symmetric gene x gene matrices of pair scores. The scores of pair A_B are stored at (A, B) and
+	(B, A); if both orientations A_B and B_A were screened, their scores are averaged. Labels
+	naming more than two genes, or a gene missing from `genes`, are left out.
+
+	All matrices share one CSR structure (indptr and indices), so only their data differ.
+
+	Parameters:
+        pairs : pd.DataFrame
+            Pair scores, indexed by gene-pair label (e.g. get_zscore() output)
+        genes : Iterable[str]
+            Gene order of the rows and columns, typically the index of the singles output
+        genepair_del : str
+            Delimiter used to separate gene pairs in index names. Default is "_".
+        pair_index : PairIndex, optional
+            Parsed labels covering the index of `pairs`. Built from it if not provided.
+        values : Iterable[str]
+            Columns of `pairs` to export. Default is GI_MATRIX_VALUES.
+
+	Returns:
+        Dict[str, sp.csr_matrix]
+            Matrix of every value, with rows and columns in the order of `genes`
+	"""
+	genes = pd.Index(genes)
+	if pair_index is None:
+		pair_index = PairIndex(pairs.index.values, genepair_del)
+	positions = pair_index.positions(pairs.index.values)
+
+	# gene codes of the pair index onto matrix rows (-1 if not in `genes`)
+	gene_row = genes.get_indexer(pair_index.genes)
+	g1 = gene_row[pair_index.g1[positions]]
+	g2 = gene_row[np.maximum(pair_index.g2[positions], 0)]
+	keep = np.flatnonzero((pair_index.n_genes[positions] == 2) & (g1 >= 0) & (g2 >= 0))
+	row = np.concatenate([g1[keep], g2[keep]])
+	col = np.concatenate([g2[keep], g1[keep]])
+
+	# CSR structure from the sorted distinct (row, col) entries; duplicate entries (both
+	# orientations of a pair) are averaged
+	n = len(genes)
+	entries, entry = np.unique(row.astype(np.int64) * n + col, return_inverse=True)
+	counts = np.bincount(entry, minlength=len(entries))
+	indices = (entries % n).astype(np.int32)
+	indptr = np.searchsorted(entries // n, np.arange(n + 1)).astype(np.int32)
+
+	matrices = {}
+	for value in values:
+		data = np.tile(pairs[value].values[keep].astype(float), 2)
+		matrices[value] = sp.csr_matrix((np.bincount(entry, weights=data, 
+													 minlength=len(entries)) / counts,
+										 indices, indptr), shape=(n, n))
+	return matrices
+
+def gi_matrix_paths(output_directory: str, output_prefix: Optional[str] = None,
+					layout: str = 'sparse', values: Iterable[str] = GI_MATRIX_VALUES) -> List[str]:
+	"""
+	Paths of the files written by write_gi_matrix(): grape_gi_matrix.npz (sparse), or the gene
+	order grape_gi_genes.txt and one grape_gi_<value>.npy per value (dense).
+	"""
+	output_path = output_directory.rstrip('/') + '/'
+	prefix = f"_{output_prefix.rstrip('_')}" if output_prefix else ""
+	if layout == 'sparse':
+		return [output_path + f'grape_gi_matrix{prefix}.npz']
+	return [output_path + f'grape_gi_genes{prefix}.txt'] + \
+		   [output_path + f'grape_gi_{value}{prefix}.npy' for value in values]
+
+def write_gi_matrix(pairs: pd.DataFrame, genes: Iterable[str], output_directory: str,
+					output_prefix: Optional[str] = None, layout: str = 'sparse',
+					genepair_del: str = '_', pair_index: Optional[PairIndex] = None,
+					values: Iterable[str] = GI_MATRIX_VALUES):
+	"""
+	Save the gi_matrix() of every value.
+
+	Parameters:
+        pairs, genes, genepair_del, pair_index, values :
+            See gi_matrix()
+        output_directory : str
+            Output directory path
+        output_prefix : str, optional
+            Prefix appended to the output file names
+        layout : str
+            'sparse' writes one grape_gi_matrix.npz holding the gene order (`genes`), the shared
+            CSR structure (`indptr`, `indices`, `shape`) and the data of every value. 'dense'
+            writes every value as a gene x gene .npy array (NaN for pairs not screened), which
+            np.load(path, mmap_mode='r') maps without reading, and the gene order as
+            grape_gi_genes.txt, one gene per line.
+	"""
+	if layout not in GI_MATRIX_LAYOUTS:
+		raise ValueError(f"Unknown GI matrix layout '{layout}', expected one of "
+						 f"{', '.join(GI_MATRIX_LAYOUTS)}")
+
+	values = list(values)
+	genes = pd.Index(genes)
+	matrices = gi_matrix(pairs, genes, genepair_del, pair_index, values)
+	paths = gi_matrix_paths(output_directory, output_prefix, layout, values)
+
+	if layout == 'sparse':
+		structure = matrices[values[0]] if values else sp.csr_matrix((len(genes), len(genes)))
+		np.savez(paths[0], genes=genes.values.astype(str), indptr=structure.indptr,
+				 indices=structure.indices, shape=np.asarray(structure.shape),
+				 **{value: matrices[value].data for value in values})
+		return
+
+	with open(paths[0], 'w', encoding='utf-8') as outfile:
+		outfile.writelines(f'{gene}\n' for gene in genes)
+	for value, path in zip(values, paths[1:]):
+		matrix = matrices[value]
+		dense = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64,
+										  shape=matrix.shape)
+		dense[:] = np.nan
+		rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+		dense[rows, matrix.indices] = matrix.data
+		dense.flush()
+		del dense
+
+def load_gi_matrix(path: str, value: str = 'GI_Zscore') -> Tuple[sp.csr_matrix, pd.Index]:
+	"""
+	Load a matrix saved by write_gi_matrix(layout='sparse').
+
+	Parameters:
+        path : str
+            Path to grape_gi_matrix.npz
+        value : str
+            Value to load. Default is 'GI_Zscore'.
+
+	Returns:
+        Tuple[sp.csr_matrix, pd.Index]
+            - Symmetric gene x gene matrix
+            - Gene order of its rows and columns
+	"""
+	with np.load(path) as stored:
+		matrix = sp.csr_matrix((stored[value], stored['indices'], stored['indptr']),
+							   shape=tuple(stored['shape']))
+		return matrix, pd.Index(stored['genes'].astype(object))
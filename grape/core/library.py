@@ -0,0 +1,176 @@
+"""
+This file precomputes the regression design of a guide library for reuse across screens
+"""
+
+import hashlib
+from argparse import Namespace
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from grape.core.load_input import load_genelist, load_readcount_matrix
+from grape.core.pair_index import PairIndex
+from grape.core.regression import make_predictor_matrix
+from grape.core.solver import CholeskyFactor, GramSolver
+
+
+LIBRARY_FORMAT_VERSION: int = 1
+"""Version of the saved library layout; artifacts of other versions are rebuilt"""
+
+
+def library_fingerprint(labels: Iterable[str], target_genes: Iterable[str],
+                        genepair_del: str = '_', fit_intercept: bool = False) -> str:
+    """
+    Hash of everything the regression design depends on: the set of regression labels (targets
+    or constructs), the target gene list, the gene-pair delimiter and the intercept.
+    """
+    digest = hashlib.sha256()
+    digest.update(f'{LIBRARY_FORMAT_VERSION}|{genepair_del}|{fit_intercept}'.encode('utf-8'))
+    for values in (labels, target_genes):
+        digest.update(b'\0'.join(x.encode('utf-8') for x in np.unique(np.asarray(
+            list(values), dtype=str))))
+        digest.update(b'\1')
+    return digest.hexdigest()
+
+
+class GuideLibrary:
+    """
+    Regression design of a guide library: predictor structure, pair index and the Cholesky
+    factorization of the Gram matrix. Screens of the same library load it instead of building
+    and factorizing the predictor matrix, and only solve against the stored factor.
+
+    Attributes:
+        fingerprint : str
+            library_fingerprint() of the labels and target genes the library was built from
+        rows : pd.Index
+            Labels of the predictor matrix rows (arrays whose genes are all target genes)
+        genes : pd.Index
+            Genes of the predictor matrix columns
+        design : sp.csr_matrix
+            Binary predictor matrix (rows x genes)
+        pair_index : PairIndex
+            Parsed labels of the library
+        factor : CholeskyFactor, optional
+            Factorization of the Gram matrix (None if it is singular)
+    """
+
+    def __init__(self, fingerprint: str, pair_index: PairIndex, rows: pd.Index, genes: pd.Index,
+                 design: sp.csr_matrix, fit_intercept: bool, factor: Optional[CholeskyFactor]):
+        self.fingerprint = fingerprint
+        self.pair_index = pair_index
+        self.rows = rows
+        self.genes = genes
+        self.design = design
+        self.fit_intercept = fit_intercept
+        self.factor = factor
+
+    @classmethod
+    def build(cls, labels: Iterable[str], target_genes: Iterable[str], genepair_del: str = '_',
+              fit_intercept: bool = False) -> 'GuideLibrary':
+        """
+        Build the predictor matrix of `labels` (the index of the mean fold changes, i.e. the
+        targets of the read count file) and factorize its Gram matrix.
+        """
+        labels = pd.Index(labels)
+        target_genes = list(target_genes)
+        pair_index = PairIndex(labels.values, genepair_del)
+        predictor, _ = make_predictor_matrix(pd.DataFrame(index=labels.values), target_genes,
+                                             genepair_del, sparse=True, pair_index=pair_index)
+        design = sp.csr_matrix(predictor.sparse.to_coo(), dtype=float)
+        gram_design = sp.hstack([design, np.ones((design.shape[0], 1))], format='csr') \
+                      if fit_intercept else design
+        factor = CholeskyFactor.from_gram(gram_design.T @ gram_design)
+        if factor is None:
+            print('[INFO] Gram matrix of the library is singular; screens will use the '
+                  'iterative solver.')
+        return cls(library_fingerprint(labels, target_genes, genepair_del, fit_intercept),
+                   pair_index, pd.Index(predictor.index.values),
+                   pd.Index(predictor.columns.values), design, fit_intercept, factor)
+
+    @property
+    def genepair_del(self) -> str:
+        return self.pair_index.genepair_del
+
+    def matches(self, labels: Iterable[str], target_genes: Iterable[str],
+                genepair_del: str = '_', fit_intercept: bool = False) -> bool:
+        """
+        Whether the library was built for these labels, target genes and regression settings.
+        """
+        return self.fingerprint == library_fingerprint(labels, target_genes, genepair_del,
+                                                       fit_intercept)
+
+    def predictor_matrix(self) -> pd.DataFrame:
+        """
+        The stored predictor matrix, as returned by make_predictor_matrix(sparse=True).
+        """
+        return pd.DataFrame.sparse.from_spmatrix(self.design, index=self.rows.values,
+                                                 columns=self.genes.values)
+
+    def solver(self) -> GramSolver:
+        """
+        Least-squares solver of the predictor matrix from the stored factorization.
+        """
+        if self.factor is None:
+            return GramSolver(self.design, self.fit_intercept)
+        return GramSolver.from_factor(self.design, self.factor, self.fit_intercept)
+
+    def save(self, path: str):
+        """
+        Save the library as an .npz archive.
+        """
+        pair_index = self.pair_index
+        with open(path, 'wb') as outfile:
+            np.savez(outfile, version=LIBRARY_FORMAT_VERSION, fingerprint=self.fingerprint,
+                     labels=pair_index.labels.values.astype(str),
+                     pair_genes=pair_index.genes.values.astype(str), pair_codes=pair_index.codes,
+                     pair_indptr=pair_index.indptr, genepair_del=pair_index.genepair_del,
+                     rows=self.rows.values.astype(str), genes=self.genes.values.astype(str),
+                     indptr=self.design.indptr, indices=self.design.indices,
+                     fit_intercept=self.fit_intercept,
+                     factor=self.factor.factor if self.factor is not None else np.empty((0, 0)))
+        print(f'[INFO] Library saved to {path}.')
+
+    @classmethod
+    def load(cls, path: str) -> Optional['GuideLibrary']:
+        """
+        Load a library saved by save(). Returns None for artifacts of another format version.
+        """
+        with np.load(path, allow_pickle=False) as archive:
+            if int(archive['version']) != LIBRARY_FORMAT_VERSION:
+                print(f'[INFO] Library {path} has an outdated format and is ignored.')
+                return None
+            rows, genes = pd.Index(archive['rows'].astype(object)), \
+                          pd.Index(archive['genes'].astype(object))
+            indices = archive['indices']
+            design = sp.csr_matrix((np.ones(len(indices)), indices, archive['indptr']),
+                                   shape=(len(rows), len(genes)))
+            pair_index = PairIndex.from_codes(archive['labels'].astype(object),
+                                              archive['pair_genes'].astype(object),
+                                              archive['pair_codes'], archive['pair_indptr'],
+                                              str(archive['genepair_del']))
+            factor = archive['factor']
+            return cls(str(archive['fingerprint']), pair_index, rows, genes, design,
+                       bool(archive['fit_intercept']),
+                       CholeskyFactor(factor) if factor.size else None)
+
+
+def build_library(args: Namespace) -> GuideLibrary:
+    """
+    Build the library of a read count file (only its index and target-gene column are read) and
+    target gene list, and save it to args.output.
+    """
+    reads = load_readcount_matrix(args.input_filepath, columns=[])
+    if args.no_groupby_targets:
+        labels = reads.index
+    else:
+        labels = pd.Index(pd.unique(reads.iloc[:, 0].values.astype(object))).sort_values()
+
+    target_genes = load_genelist(args.target_gene_file)
+    if args.query_gene_file is not None:
+        target_genes = list(set(target_genes + load_genelist(args.query_gene_file)))
+
+    library = GuideLibrary.build(labels, target_genes, args.genepair_del, args.fit_intercept)
+    library.save(args.output)
+    return library
@@ -2,29 +2,210 @@
 This file handles the reading of input files.
 """
 
-from typing import List
+from typing import Iterator, List, Optional, Tuple
 
 import pandas as pd
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
-def load_readcount_matrix(filepath: str, index_column: int = 0, 
-                          delimiter: str = '\t') -> pd.DataFrame:
+
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+FEATHER_EXTENSIONS = ('.feather', '.arrow', '.ipc')
+
+
+def detect_file_format(filepath: str) -> str:
+    """
+    Detect whether a read count file is text, Parquet or Feather (Arrow IPC), from its extension
+    or, failing that, its magic bytes.
+
+    Parameters:
+        filepath: str
+            The path to the file
+
+    Returns:
+        'parquet', 'feather' or 'text'
+    """
+    lower = str(filepath).lower()
+    if lower.endswith(PARQUET_EXTENSIONS):
+        return 'parquet'
+    if lower.endswith(FEATHER_EXTENSIONS):
+        return 'feather'
+
+    with open(filepath, 'rb') as infile:
+        magic = infile.read(6)
+    if magic[:4] == b'PAR1':
+        return 'parquet'
+    if magic == b'ARROW1':
+        return 'feather'
+    return 'text'
+
+def load_readcount_matrix(filepath: str, index_column: int = 0,
+                          delimiter: str = '\t', columns: Optional[List[str]] = None,
+                          compact_dtypes: bool = False, engine: Optional[str] = None) -> pd.DataFrame:
     """
     Load a read count file
 
-    Parameters: 
+    Parameters:
         filepath: str
-            The path to the file to be loaded
+            The path to the file to be loaded. Tab/comma delimited text, Parquet and Feather
+            (Arrow IPC) files are detected automatically.
         index_column: int
             The column to use as an index (contains target IDs). Default 0.
         delimiter: str
             tab or comma delimited file. Default '\t'
-    
+        columns: List[str], optional
+            Sample columns to load. The index and target-gene columns are always loaded. If None,
+            all columns are loaded.
+        compact_dtypes: bool
+            Store counts in the smallest integer dtype that holds them and the target-gene column
+            as a categorical. Default False.
+        engine: str, optional
+            Parser for text files, 'c' or 'pyarrow'. Default is 'pyarrow' when pyarrow is
+            installed.
+
     Returns:
         reads_df: pd.DataFrame
             A dataframe containing the readcount matrix. Index is unique ID, first column is target.
-    """  
-    reads_df = pd.read_csv(filepath, index_col=index_column, sep = delimiter)
+    """
+    file_format = detect_file_format(filepath)
+    if file_format != 'text' and pyarrow is None:
+        raise ImportError(f'pyarrow is required to read {file_format} files')
+
+    if file_format == 'text':
+        if engine is None:
+            engine = 'c' if pyarrow is None else 'pyarrow'
+        header = pd.read_csv(filepath, sep=delimiter, nrows=0).columns.tolist()
+        index_label = header[index_column]
+        reads_df = pd.read_csv(filepath, sep=delimiter, engine=engine, index_col=index_label,
+                               usecols=_select_columns(header, index_label, columns))
+    else:
+        usecols, index_label, _ = _arrow_columns(filepath, file_format, index_column, columns)
+        if file_format == 'parquet':
+            reads_df = pd.read_parquet(filepath, columns=usecols)
+        else:
+            reads_df = pd.read_feather(filepath, columns=usecols)
+        if index_label is not None:
+            reads_df = reads_df.set_index(index_label)
+
+    if compact_dtypes:
+        reads_df = compact_readcount_dtypes(reads_df)
+    return reads_df
+
+def iter_readcount_matrix(filepath: str, chunksize: int, index_column: int = 0,
+                          delimiter: str = '\t', columns: Optional[List[str]] = None) \
+                          -> Iterator[pd.DataFrame]:
+    """
+    Read a read count file in chunks of rows, each in the layout of load_readcount_matrix(), so
+    that files larger than memory can be processed chunk by chunk.
+
+    Parameters:
+        filepath: str
+            The path to the file. Tab/comma delimited text, Parquet and Feather files are
+            detected automatically.
+        chunksize: int
+            Maximum number of rows per chunk
+        index_column, delimiter, columns:
+            See load_readcount_matrix()
+
+    Returns:
+        Iterator[pd.DataFrame]
+            Chunks of the readcount matrix, in file order
+    """
+    file_format = detect_file_format(filepath)
+    if file_format != 'text' and pyarrow is None:
+        raise ImportError(f'pyarrow is required to read {file_format} files')
+
+    if file_format == 'text':
+        # the pyarrow parser does not read in chunks
+        header = pd.read_csv(filepath, sep=delimiter, nrows=0).columns.tolist()
+        index_label = header[index_column]
+        with pd.read_csv(filepath, sep=delimiter, engine='c', index_col=index_label,
+                         usecols=_select_columns(header, index_label, columns),
+                         chunksize=chunksize) as reader:
+            yield from reader
+        return
+
+    usecols, index_label, stored_index = _arrow_columns(filepath, file_format, index_column,
+                                                        columns)
+    if usecols is not None:
+        usecols = usecols + stored_index
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        batches = pq.ParquetFile(filepath).iter_batches(batch_size=chunksize, columns=usecols)
+    else:
+        from pyarrow import ipc
+        reader = ipc.open_file(pyarrow.memory_map(filepath))
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+
+    for batch in batches:
+        if usecols is not None:
+            batch = batch.select(usecols)
+        for start in range(0, batch.num_rows, chunksize):
+            chunk = batch.slice(start, chunksize).to_pandas()
+            if index_label is not None:
+                chunk = chunk.set_index(index_label)
+            yield chunk
+
+def _arrow_columns(filepath: str, file_format: str, index_column: int,
+                   columns: Optional[List[str]]) -> Tuple[Optional[List[str]], Optional[str],
+                                                          List[str]]:
+    """
+    Columns to read from a Parquet or Feather file, the label of the index column to set (None if
+    pandas stored the index, which is then restored automatically) and the stored index columns.
+    """
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        schema = pq.read_schema(filepath)
+    else:
+        from pyarrow import ipc
+        schema = ipc.open_file(pyarrow.memory_map(filepath)).schema
+
+    metadata = schema.pandas_metadata or {}
+    stored_index = [x for x in metadata.get('index_columns', []) if isinstance(x, str)]
+    header = [x for x in schema.names if x not in stored_index]
+    index_label = None if stored_index else header[index_column]
+    return _select_columns(header, index_label, columns), index_label, stored_index
+
+def _select_columns(header: List[str], index_label: Optional[str],
+                    columns: Optional[List[str]]) -> Optional[List[str]]:
+    """
+    Columns of `header` to materialize: the index, the target-gene column and `columns`.
+    """
+    if columns is None:
+        return None
+
+    missing = [x for x in columns if x not in header]
+    if missing:
+        raise KeyError(f"Columns not found in read count file: {', '.join(map(str, missing))}")
+
+    target_column = [x for x in header if x != index_label][0]
+    wanted = set(columns) | {index_label, target_column}
+    return [x for x in header if x in wanted]
+
+def compact_readcount_dtypes(reads_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Downcast integer count columns to the smallest integer dtype that holds them and store the
+    target-gene (first) column as a categorical.
+
+    Parameters:
+        reads_df: pd.DataFrame
+            A readcount matrix as returned by load_readcount_matrix
+
+    Returns:
+        reads_df: pd.DataFrame
+            The readcount matrix with compact dtypes
+    """
+    reads_df = reads_df.copy()
+    target_column = reads_df.columns[0]
+    reads_df[target_column] = reads_df[target_column].astype('category')
+    for col in reads_df.columns[1:]:
+        if pd.api.types.is_integer_dtype(reads_df[col]):
+            downcast = 'unsigned' if (reads_df[col].min() >= 0) else 'integer'
+            reads_df[col] = pd.to_numeric(reads_df[col], downcast=downcast)
+
     return reads_df
 
 def load_genelist(filepath: str) -> List[str]:
@@ -0,0 +1,118 @@
+"""
+This file parses gene-pair labels once into integer gene codes shared by the regression steps
+"""
+
+
+from typing import Iterable, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class PairIndex:
+	"""
+	Compiled index of target arrays (single genes and gene pairs).
+
+	Every label is split on the gene-pair delimiter exactly once. Genes are encoded as integers
+	(`genes[code]` is the gene name) and each label keeps the codes of the genes it targets, so
+	predictor construction and the single-gene annotations of pairs become array gathers.
+
+	Parameters:
+        labels : Iterable[str]
+            Target array labels, typically the index of the mean fold-change DataFrame
+        genepair_del : str
+            Delimiter used to separate gene pairs in index names. Default is "_"
+
+	Attributes:
+        labels : pd.Index
+            Hashed labels, used to map DataFrame indices onto label positions
+        genes : pd.Index
+            Hashed gene names, in order of first appearance
+        codes : np.ndarray
+            Gene codes of all labels, concatenated; label i owns codes[indptr[i]:indptr[i+1]]
+        indptr : np.ndarray
+            Offsets of each label in `codes`
+        n_genes : np.ndarray
+            Number of genes named by each label
+        g1, g2 : np.ndarray
+            Code of the first and second gene of each label (-1 for single-gene labels)
+        is_pair : np.ndarray
+            True for labels targeting more than one gene
+        is_distinct : np.ndarray
+            False for labels that name the same gene more than once
+	"""
+
+	def __init__(self, labels: Iterable[str], genepair_del: str = '_'):
+		self.labels = pd.Index(labels)
+		self.genepair_del = genepair_del
+
+		genes_in_array = pd.Series(self.labels.astype(str)).str.split(genepair_del,
+																	  regex=False).explode()
+		codes, genes = pd.factorize(genes_in_array.values)
+		self._compile(pd.Index(genes), codes.astype(np.int64), 
+					  np.bincount(genes_in_array.index.values, minlength=len(self.labels)))
+
+	@classmethod
+	def from_codes(cls, labels: Iterable[str], genes: Iterable[str], codes: np.ndarray, 
+				   indptr: np.ndarray, genepair_del: str = '_') -> 'PairIndex':
+		"""
+		Index from the `genes`, `codes` and `indptr` of a compiled index (e.g. a saved guide 
+		library), without splitting the labels again.
+		"""
+		index = object.__new__(cls)
+		index.labels = pd.Index(labels)
+		index.genepair_del = genepair_del
+		index._compile(pd.Index(genes), np.asarray(codes, dtype=np.int64), 
+					   np.diff(np.asarray(indptr, dtype=np.int64)))
+		return index
+
+	def _compile(self, genes: pd.Index, codes: np.ndarray, n_genes: np.ndarray):
+		self.genes = genes
+		self.codes = codes
+		rows = np.repeat(np.arange(len(n_genes)), n_genes)
+
+		self.n_genes = n_genes
+		self.indptr = np.concatenate([[0], np.cumsum(self.n_genes)])
+		self.is_pair = self.n_genes > 1
+		self.g1 = self.codes[self.indptr[:-1]]
+		self.g2 = np.where(self.is_pair, self.codes[np.minimum(self.indptr[:-1] + 1,
+															   len(self.codes) - 1)], -1)
+
+		distinct = pd.DataFrame({'row': rows, 'code': self.codes}).drop_duplicates()['row'].values
+		self.is_distinct = np.bincount(distinct, minlength=len(self.labels)) == self.n_genes
+
+	def __len__(self) -> int:
+		return len(self.labels)
+
+	def positions(self, labels: Iterable[str]) -> np.ndarray:
+		"""
+		Positions of `labels` in the index. Raises KeyError for labels that were not compiled.
+		"""
+		pos = self.labels.get_indexer(labels)
+		if (pos < 0).any():
+			missing = np.asarray(labels, dtype=object)[pos < 0]
+			raise KeyError(f'{len(missing)} labels not in pair index, e.g. {missing[0]}')
+		return pos
+
+	def explode(self, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+		"""
+		Flatten the gene codes of the labels at `positions`.
+
+		Returns:
+            Tuple[np.ndarray, np.ndarray]
+                - for every gene, the index into `positions` of the label it belongs to
+                - the gene codes
+		"""
+		counts = self.n_genes[positions]
+		owner = np.repeat(np.arange(len(positions)), counts)
+		offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+		return owner, self.codes[np.repeat(self.indptr[positions], counts) + offsets]
+
+	def all_genes_in(self, positions: np.ndarray, gene_mask: np.ndarray) -> np.ndarray:
+		"""
+		For the labels at `positions`, whether every gene they name is flagged in `gene_mask`
+		(a boolean array over gene codes) and no gene is named twice.
+		"""
+		owner, codes = self.explode(positions)
+		hits = np.bincount(owner, weights=gene_mask[codes], minlength=len(positions))
+		return (hits == self.n_genes[positions]) & self.is_distinct[positions]
@@ -3,15 +3,25 @@ This file makes predictor matrix, run regression, and filter regression
 """
 
 
-from typing import Tuple, Dict, List
+from typing import Tuple, Dict, List, Optional, Union
 
 import numpy as np
 import pandas as pd
-from sklearn.linear_model import LinearRegression
+import scipy.linalg
+import scipy.sparse as sp
 
+from grape.core.pair_index import PairIndex
+from grape.core.solver import BlockSolver, GramSolver, r_squared
+from grape.utils.defaults import REGRESSION_BACKENDS
+
+
+DIAGNOSTIC_COLUMNS: List[str] = ['leverage', 'loo_resid', 'cooks_d']
+"""Columns of influence_diagnostics()"""
 
 def make_predictor_matrix(fc_df: pd.DataFrame, target_gene_list: List[str], 
-						  genepair_del: str = '_') -> Tuple[pd.DataFrame, pd.DataFrame]:
+						  genepair_del: str = '_', sparse: bool = False, 
+						  pair_index: Optional[PairIndex] = None) -> \
+						  Tuple[pd.DataFrame, pd.DataFrame]:
 	"""
 	Constructs a binary predictor matrix for regression analysis.
     
@@ -22,6 +32,11 @@ def make_predictor_matrix(fc_df: pd.DataFrame, target_gene_list: List[str],
             List of target genes to be included in the regression model
         genepair_del : str
             Delimiter used to separate gene pairs in index names. Default is "_"
+        sparse : bool
+            Whether to build the predictor matrix as a sparse (CSR-backed) DataFrame. Default is 
+            False.
+        pair_index : PairIndex, optional
+            Parsed labels covering the index of `fc_df`. Built from `fc_df` if not provided.
 
     Returns:
         Tuple[pd.DataFrame, pd.DataFrame]
@@ -29,38 +44,84 @@ def make_predictor_matrix(fc_df: pd.DataFrame, target_gene_list: List[str],
 			  knockouts)
             - Response vector (observed fold-change values)
 	"""
-	predictor_matrix = pd.DataFrame(index=fc_df.index.values, columns=target_gene_list, data=0.)
-	for target_array in fc_df.index.values:
-		if genepair_del in target_array:
-			
-            # this target is a gene pair
-			target_genes_in_array = target_array.split(genepair_del)
-			if (len(np.intersect1d(target_genes_in_array, target_gene_list)) == \
-	            len(target_genes_in_array)):
-				# both/all genes in the target array are in the genetic interaction gene list. 
-                # include this genepair.
-				predictor_matrix.loc[target_array, target_genes_in_array] = 1
-		else:
-			# absence of delimiter implies single gene knockout. is the single gene in our 
-            # target_gene_list?
-			if (target_array in target_gene_list):
-				predictor_matrix.loc[target_array, target_array] = 1
-	
-	# Drop rows not targeting a gene in the target list
-	dropme = np.where(predictor_matrix.sum(1)==0)[0]  
-	predictor_matrix.drop(predictor_matrix.index.values[dropme], axis=0, inplace=True)
+	if pair_index is None:
+		pair_index = PairIndex(fc_df.index.values, genepair_del)
+	positions = pair_index.positions(fc_df.index.values)
+
+	# map gene codes onto target gene columns (-1 if not a target gene)
+	target_genes = pd.Index(pd.unique(np.asarray(target_gene_list, dtype=object)))
+	target_column = target_genes.get_indexer(pair_index.genes)
+
+	# target genes need a single-gene array, which may have been removed (e.g. by the min read 
+	# filter); the pairs of genes without one are pruned with them
+	has_single = np.zeros(len(pair_index.genes), dtype=bool)
+	has_single[pair_index.g1[positions[pair_index.n_genes[positions] == 1]]] = True
+	in_model = (target_column >= 0) & has_single
 
-	# Drop columns (genes) with no arrays targeting that gene
-	dropme = np.where(predictor_matrix.sum(0)==0)[0]  
-	predictor_matrix.drop(predictor_matrix.columns.values[dropme], axis=1, inplace=True)
+	# keep arrays whose genes are all (distinct) genes in the target list
+	keep_rows = np.where(pair_index.all_genes_in(positions, in_model))[0]
+	row, codes = pair_index.explode(positions[keep_rows])
+	gene_column = target_column[codes]
 
-	obs_vector = fc_df.loc[predictor_matrix.index.values]
+	# drop columns (genes) with no arrays targeting that gene
+	keep_cols = np.unique(gene_column)
+	col = np.searchsorted(keep_cols, gene_column)
+
+	index = fc_df.index.values[keep_rows]
+	columns = target_genes.values[keep_cols]
+	if sparse:
+		matrix = sp.csr_matrix((np.ones(len(row)), (row, col)), shape=(len(index), len(columns)))
+		predictor_matrix = pd.DataFrame.sparse.from_spmatrix(matrix, index=index, columns=columns)
+	else:
+		matrix = np.zeros((len(index), len(columns)))
+		matrix[row, col] = 1.
+		predictor_matrix = pd.DataFrame(matrix, index=index, columns=columns)
+
+	obs_vector = fc_df.iloc[keep_rows]
 	print('[INFO] regression matrix rows: {:5d}, cols: {:3d}'.format(predictor_matrix.shape[0], 
 															predictor_matrix.shape[1]))
+	if (in_model != (target_column >= 0)).any():
+		n_pruned = (pair_index.all_genes_in(positions, target_column >= 0).sum() - len(keep_rows))
+		print(f'[INFO] {((target_column >= 0) & ~has_single).sum()} target genes have no '
+			  f'single-gene construct; they and {n_pruned} of their arrays are left out of the '
+			  'regression.')
 	return predictor_matrix, obs_vector
 
+def make_solver(predictor_matrix: pd.DataFrame, fit_intercept: bool = False, 
+				block_solve: bool = False, n_jobs: Optional[int] = None) -> GramSolver:
+	"""
+	Factorize a predictor matrix (dense or sparse) for reuse across regressions, e.g. to refit 
+	after the dynamic range filter by downdating instead of refactorizing.
+
+	Parameters:
+        predictor_matrix : pd.DataFrame
+            Binary predictor matrix generated from make_predictor_matrix
+        fit_intercept : bool
+            Whether to fit an intercept in the regression model. Default is False.
+        block_solve : bool
+            Split the predictor matrix into its connected components and solve them 
+            independently (BlockSolver). Default is False.
+        n_jobs : int, optional
+            Number of threads solving blocks with block_solve. Default is the number of CPUs.
+
+	Returns:
+        GramSolver or BlockSolver
+            Least-squares solver whose rows match the rows of `predictor_matrix`
+	"""
+	if hasattr(predictor_matrix, 'sparse'):
+		design = predictor_matrix.sparse.to_coo()
+	else:
+		design = sp.csr_matrix(predictor_matrix.values)
+	if block_solve:
+		return BlockSolver(design, fit_intercept, n_jobs)
+	return GramSolver(design, fit_intercept)
+
 def do_regression(predictor_matrix: pd.DataFrame, obs_vector: pd.DataFrame, 
-				  fit_intercept: bool = False, genepair_del: str = '_') -> \
+				  fit_intercept: bool = False, genepair_del: str = '_', 
+				  pair_index: Optional[PairIndex] = None, 
+				  solver: Optional[GramSolver] = None, backend: str = 'sklearn', 
+				  block_solve: bool = False, n_jobs: Optional[int] = None, 
+				  diagnostics: bool = False) -> \
                   Tuple[pd.DataFrame, pd.DataFrame, Dict[str, float]]:
 	"""
     Calculate the regression and provide the initial GI score.
@@ -74,44 +135,261 @@ def do_regression(predictor_matrix: pd.DataFrame, obs_vector: pd.DataFrame,
             Whether to fit an intercept in the regression model. Default is False.
         genepair_del : str
             Delimiter used to separate gene pairs in index names. Default is "_".
+        pair_index : PairIndex, optional
+            Parsed labels covering the index of `predictor_matrix`. Built from it if not provided.
+        solver : GramSolver, optional
+            Factorized predictor matrix from make_solver() (or its remove_rows()). If provided, it 
+            is used instead of fitting a new model.
+        backend : str
+            Least-squares backend of a dense predictor matrix: 'sklearn' (LinearRegression) or 
+            'numpy' (NumPy/SciPy only). Default is 'sklearn'.
+        block_solve, n_jobs :
+            Solve the connected components of the predictor matrix independently, see 
+            make_solver(). Ignored if `solver` is given.
+        diagnostics : bool
+            Whether to compute the leave-one-out diagnostics of every construct (see 
+            influence_diagnostics()). Default is False.
 
     Returns:
         Tuple[pd.DataFrame, pd.DataFrame, Dict[str, float]]
             - DataFrame containing predicted fold-changes, genetic interaction scores, and LFC
             - DataFrame containing single-gene LFC
-            - Dictionary with regression metadata (R-squared value, intercept, and model parameters)	
+            - Dictionary with regression metadata (R-squared value, intercept, and model parameters,
+              and with diagnostics the influence_diagnostics() of all rows under 'Diagnostics')	
     """
-	model = LinearRegression(fit_intercept=fit_intercept).fit(predictor_matrix.values, obs_vector)
-	pred_fc = model.predict(predictor_matrix.values)
+	if solver is not None or block_solve or hasattr(predictor_matrix, 'sparse'):
+		# sparse predictor matrix from make_predictor_matrix(sparse=True), or a reused solver
+		if solver is None:
+			solver = make_solver(predictor_matrix, fit_intercept, block_solve, n_jobs)
+		elif solver.design.shape[0] != predictor_matrix.shape[0]:
+			raise ValueError('solver rows do not match the predictor matrix')
+		coef, intercept = solver.solve(obs_vector.values)
+		pred_fc = solver.predict(coef, intercept)
+	else:
+		pred_fc, intercept = fit_ols(predictor_matrix.values, obs_vector.values, fit_intercept, 
+									 backend)
+	rsq = r_squared(obs_vector.values, pred_fc)
+	params = _ols_params(fit_intercept)
 	
-	pairs = pd.DataFrame(index=predictor_matrix.index.values, 
-					     columns=['fc_obs','fc_exp','GI_raw','g1_fc','g2_fc','dLFC'], data=0.)
-	pairs['fc_obs']  = obs_vector.values
-	pairs['fc_exp'] = pred_fc.flatten()  # already an array
+	pairs, singles = _pair_annotations(predictor_matrix, obs_vector.values, pred_fc.flatten(), 
+									   genepair_del, pair_index)
+
+	# other data:
+	metadata = {}
+	metadata['Rsq'] = rsq
+	metadata['Intercept'] = intercept
+	metadata['Params']  = params
+	if diagnostics:
+		if solver is None:
+			solver = make_solver(predictor_matrix, fit_intercept)
+		metadata['Diagnostics'] = influence_diagnostics(solver.leverage(), 
+														obs_vector.values.ravel(), 
+														pred_fc.ravel(), predictor_matrix.index)
 	
-    # remove singles: columns of predictor matrix
+	return pairs, singles, metadata
+
+def fit_ols(design: np.ndarray, obs: np.ndarray, fit_intercept: bool = False, 
+			backend: str = 'sklearn') -> Tuple[np.ndarray, Union[np.ndarray, float]]:
+	"""
+	Ordinary least-squares fit of a dense design matrix.
+
+	The 'numpy' backend follows the steps of sklearn's LinearRegression (centering for the 
+	intercept, then a minimum-norm LAPACK gelsd solve) without importing scikit-learn.
+
+	Parameters:
+        design : np.ndarray
+            Predictor matrix (constructs x genes)
+        obs : np.ndarray
+            Response vector, or a matrix with one response per column
+        fit_intercept : bool
+            Whether to fit an intercept. Default is False.
+        backend : str
+            'sklearn' or 'numpy'. Default is 'sklearn'.
+
+	Returns:
+        Tuple[np.ndarray, Union[np.ndarray, float]]
+            - Predicted response, same shape as `obs`
+            - Intercept, one per response (0. when fit_intercept is False)
+	"""
+	if backend not in REGRESSION_BACKENDS:
+		raise ValueError(f"Unknown regression backend '{backend}', expected one of "
+						 f"{', '.join(REGRESSION_BACKENDS)}")
+	if backend == 'sklearn':
+		# imported here: scikit-learn is slow to import and only needed by this backend
+		from sklearn.linear_model import LinearRegression
+		model = LinearRegression(fit_intercept=fit_intercept).fit(design, obs)
+		return model.predict(design), model.intercept_
+
+	design = np.asarray(design, dtype=float)
+	obs = np.asarray(obs, dtype=float)
+	if fit_intercept:
+		design_offset = design.mean(axis=0)
+		obs_offset = obs.mean(axis=0)
+		coef = scipy.linalg.lstsq(design - design_offset, obs - obs_offset)[0]
+		intercept = np.atleast_1d(obs_offset - design_offset @ coef)
+	else:
+		coef = scipy.linalg.lstsq(design, obs)[0]
+		intercept = 0.
+	return design @ coef + intercept, intercept
+
+def _ols_params(fit_intercept: bool) -> Dict:
+	"""
+	Model parameters reported in the regression metadata (those of sklearn's LinearRegression).
+	"""
+	return {'copy_X': True, 'fit_intercept': fit_intercept, 'n_jobs': None, 'positive': False}
+
+def _pair_annotations(predictor_matrix: pd.DataFrame, fc_obs: np.ndarray, fc_exp: np.ndarray,
+					  genepair_del: str = '_', pair_index: Optional[PairIndex] = None) -> \
+					  Tuple[pd.DataFrame, pd.DataFrame]:
+	"""
+	Split observed and expected fold changes of one response into pairs and singles, and annotate
+	the pairs with GI_raw, the single-gene fold changes of their genes and dLFC. Every column is
+	computed as an array and each DataFrame is built once.
+	"""
+	fc_obs = np.asarray(fc_obs, dtype=float).ravel()
+	fc_exp = np.asarray(fc_exp, dtype=float).ravel()
+	labels = predictor_matrix.index
+
+	# singles: the rows of the columns (genes) of the predictor matrix, in column order
 	single_genes = predictor_matrix.columns.values
-	singles = pairs.loc[single_genes,['fc_obs','fc_exp']]
-	pairs.drop( single_genes, axis=0, inplace=True )
+	single_rows = labels.get_indexer(single_genes)
+	if (single_rows < 0).any():
+		raise KeyError(f"{list(single_genes[single_rows < 0])} not in index")
+	singles = pd.DataFrame({'fc_obs': fc_obs[single_rows], 'fc_exp': fc_exp[single_rows]}, 
+						   index=single_genes)
 
-	pairs['GI_raw'] = pairs.fc_obs - pairs.fc_exp
+	is_pair = np.ones(len(labels), dtype=bool)
+	is_pair[single_rows] = False
+	pair_rows = np.flatnonzero(is_pair)
+	pair_obs = fc_obs[pair_rows]
+	pair_exp = fc_exp[pair_rows]
 
 	# now for each pair, get g1, g2, dLFC based on observed FC in singles
-	for genepair in pairs.index.values:
-		g1, g2 = genepair.split(genepair_del)
-		g1_fc = singles.loc[g1,'fc_obs']
-		g2_fc = singles.loc[g2,'fc_obs']
-		dLFC = pairs.loc[genepair, 'fc_obs'] - (g1_fc + g2_fc)
-		pairs.loc[genepair, ['g1_fc','g2_fc','dLFC']] = g1_fc, g2_fc, dLFC
+	if pair_index is None:
+		pair_index = PairIndex(labels.values, genepair_del)
+	pair_labels = labels.values[pair_rows]
+	positions = pair_index.positions(pair_labels)
+	single_fc = singles['fc_obs'].values[pd.Index(single_genes).get_indexer(pair_index.genes)]
+	owner, codes = pair_index.explode(positions)
+
+	pairs = pd.DataFrame({'fc_obs': pair_obs, 'fc_exp': pair_exp, 'GI_raw': pair_obs - pair_exp,
+						  'g1_fc': single_fc[pair_index.g1[positions]],
+						  'g2_fc': single_fc[pair_index.g2[positions]],
+						  'dLFC': pair_obs - np.bincount(owner, weights=single_fc[codes], 
+														 minlength=len(positions))},
+						 index=pair_labels)
+
+	return pairs, singles
+
+def do_multi_regression(predictor_matrix: pd.DataFrame, obs_df: pd.DataFrame, 
+						fit_intercept: bool = False, genepair_del: str = '_', 
+						pair_index: Optional[PairIndex] = None, 
+						solver: Optional[GramSolver] = None, backend: str = 'sklearn', 
+						block_solve: bool = False, n_jobs: Optional[int] = None, 
+						diagnostics: bool = False) -> \
+						Tuple[Dict[str, pd.DataFrame], Dict[str, pd.DataFrame], Dict[str, Dict]]:
+	"""
+	Run the regression for every column of `obs_df` (e.g. replicates or timepoints kept by
+	--no-mean-replicates). The predictor matrix is shared, so it is factorized once and all
+	columns are solved together.
+
+	Parameters:
+        predictor_matrix : pd.DataFrame
+            Binary predictor matrix generated from make_predictor_matrix
+        obs_df : pd.DataFrame
+            Response matrix generated from make_predictor_matrix, one response per column
+        fit_intercept : bool
+            Whether to fit an intercept in the regression model. Default is False.
+        genepair_del : str
+            Delimiter used to separate gene pairs in index names. Default is "_".
+        pair_index : PairIndex, optional
+            Parsed labels covering the index of `predictor_matrix`. Built from it if not provided.
+        solver : GramSolver, optional
+            Factorized predictor matrix from make_solver() (or its remove_rows()). If provided, it 
+            is used instead of fitting a new model.
+        backend : str
+            Least-squares backend of a dense predictor matrix, 'sklearn' or 'numpy'. Default is 
+            'sklearn'.
+        block_solve, n_jobs, diagnostics :
+            See do_regression(). Leverages are shared by all responses.
+
+	Returns:
+        Tuple[Dict[str, pd.DataFrame], Dict[str, pd.DataFrame], Dict[str, Dict]]
+            do_regression() outputs (pairs, singles and metadata) keyed by response column
+	"""
+	obs = obs_df.values.astype(float)
+	if solver is not None or block_solve or hasattr(predictor_matrix, 'sparse'):
+		if solver is None:
+			solver = make_solver(predictor_matrix, fit_intercept, block_solve, n_jobs)
+		elif solver.design.shape[0] != predictor_matrix.shape[0]:
+			raise ValueError('solver rows do not match the predictor matrix')
+		coef, intercept = solver.solve(obs)
+		pred_fc = solver.predict(coef, intercept).reshape(obs.shape)
+	else:
+		pred_fc, intercept = fit_ols(predictor_matrix.values, obs, fit_intercept, backend)
+		pred_fc = pred_fc.reshape(obs.shape)
+	params = _ols_params(fit_intercept)
+	intercept = np.broadcast_to(intercept, obs.shape[1])
+
+	if pair_index is None:
+		pair_index = PairIndex(predictor_matrix.index.values, genepair_del)
+	if diagnostics:
+		if solver is None:
+			solver = make_solver(predictor_matrix, fit_intercept)
+		leverage = solver.leverage()
+
+	pairs, singles, metadata = {}, {}, {}
+	for j, col in enumerate(obs_df.columns):
+		pairs[col], singles[col] = _pair_annotations(predictor_matrix, obs[:, j], pred_fc[:, j],
+													 genepair_del, pair_index)
+		metadata[col] = {'Rsq': r_squared(obs[:, j], pred_fc[:, j]), 
+						 'Intercept': np.array([intercept[j]]) if fit_intercept else 0.,
+						 'Params': params}
+		if diagnostics:
+			metadata[col]['Diagnostics'] = influence_diagnostics(leverage, obs[:, j], 
+																 pred_fc[:, j], 
+																 predictor_matrix.index)
 
-	# other data:
-	metadata = {}
-	metadata['Rsq'] = model.score(predictor_matrix.values, obs_vector.values)
-	metadata['Intercept'] = model.intercept_
-	metadata['Params']  = model.get_params()
-	
 	return pairs, singles, metadata
 
+def influence_diagnostics(leverage: np.ndarray, fc_obs: np.ndarray, fc_exp: np.ndarray, 
+						  index: pd.Index) -> pd.DataFrame:
+	"""
+	Leave-one-out influence of every row (construct) of a fitted regression, in closed form from 
+	the leverages instead of one refit per held-out row.
+
+	Parameters:
+        leverage : np.ndarray
+            Diagonal of the hat matrix, from GramSolver.leverage()
+        fc_obs : np.ndarray
+            Observed fold changes, one per row of the predictor matrix
+        fc_exp : np.ndarray
+            Fitted fold changes
+        index : pd.Index
+            Labels of the rows of the predictor matrix
+
+	Returns:
+        pd.DataFrame
+            - `leverage`: diagonal of the hat matrix
+            - `loo_resid`: leave-one-out (PRESS) residual, (fc_obs - fc_exp) / (1 - leverage), 
+              i.e. fc_obs minus the fit without the row
+            - `cooks_d`: Cook's distance of the row
+            Both are NaN for rows that alone determine a coefficient (leverage 1).
+	"""
+	resid = np.asarray(fc_obs, dtype=float) - np.asarray(fc_exp, dtype=float)
+	# the trace of the hat matrix is the rank of the design
+	n_params = leverage.sum()
+	dof = len(resid) - n_params
+	mse = (resid**2).sum() / dof if dof > 0.5 else np.nan
+
+	one_minus_leverage = 1. - leverage
+	one_minus_leverage[one_minus_leverage < 1e-10] = np.nan
+	loo_resid = resid / one_minus_leverage
+	cooks_d = loo_resid**2 * leverage / (n_params * mse)
+
+	return pd.DataFrame({'leverage': leverage, 'loo_resid': loo_resid, 'cooks_d': cooks_d}, 
+						index=index)
+
 def dynamic_range_filter(regression_pairs: pd.DataFrame) -> pd.DataFrame:
 	"""
 	Identify target list where expected phenotype (fc_exp) is beyond the dynamic range of the assay 
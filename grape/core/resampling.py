@@ -0,0 +1,164 @@
+"""
+This file calculates empirical p-values and FDR of GI Z-scores from resampled regressions
+"""
+
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.stats import norm
+
+from grape.core.pair_index import PairIndex
+from grape.core.solver import GramSolver
+from grape.core.zscore_generator import benjamini_hochberg
+from grape.utils.defaults import RESAMPLE_METHODS
+
+
+RESAMPLE_CHUNK_VALUES: int = 2**24
+"""Maximum number of resampled values (rows x resamples) held in memory per chunk"""
+
+NULL_CORE_Z: float = 2.
+"""Half-width, in robust standard deviations, of the central residuals resampled by the null"""
+
+
+def get_empirical_pvalues(zscore_df: pd.DataFrame, singles: pd.DataFrame,
+						  n_resamples: int = 1000, method: str = 'permutation',
+						  fit_intercept: bool = False, seed: Optional[int] = None,
+						  n_jobs: Optional[int] = None, genepair_del: str = '_',
+						  pair_index: Optional[PairIndex] = None) -> pd.DataFrame:
+	"""
+	Empirical p-values of GI Z-scores under a null of no genetic interactions.
+
+	Null responses are the fitted fold changes plus noise drawn from a robust null fitted to the
+	residuals. Residuals are studentized by the local std of their fc_exp window and their leverage;
+	a normal null N(median, 1.4826 * MAD) is matched to their centre, and noise is drawn from the
+	residuals within NULL_CORE_Z robust stds of the median, or from the tails of the fitted normal
+	with the probability it assigns to them. Residuals of interactions lie in the tails and do not
+	enter the null. Central residuals are shuffled across constructs ('permutation') or drawn with
+	replacement ('bootstrap'). The design matrix is factorized once and each chunk of null
+	responses is solved as one multi-column right-hand side. Null GI scores are scaled by the
+	local std of their pair, and each observed Z-score is compared to the pooled null Z-scores of
+	all pairs.
+
+	Parameters:
+        zscore_df : pd.DataFrame
+            Output of get_zscore()
+        singles : pd.DataFrame
+            Single-gene output of do_regression() for the same regression
+        n_resamples : int
+            Number of resampled responses. Default is 1000.
+        method : str
+            'permutation' or 'bootstrap'. Default is 'permutation'.
+        fit_intercept : bool
+            Whether the regression fits an intercept. Default is False.
+        seed : int, optional
+            Seed of the random number generator. Results do not depend on n_jobs.
+        n_jobs : int, optional
+            Number of threads solving chunks of resamples. Default is the number of CPUs.
+        genepair_del : str
+            Delimiter used to separate gene pairs in index names. Default is "_".
+        pair_index : PairIndex, optional
+            Parsed labels covering the pairs and singles. Built from them if not provided.
+
+	Returns:
+        pd.DataFrame
+            zscore_df with added columns:
+            - `Pval_synth_emp`, `Padj_synth_emp`: empirical p-value and FDR for synthetic
+              interactions
+            - `Pval_supp_emp`, `Padj_supp_emp`: empirical p-value and FDR for suppressing
+              interactions
+	"""
+	if method not in RESAMPLE_METHODS:
+		raise ValueError(f"Unknown resampling method '{method}', expected one of "
+						 f"{', '.join(RESAMPLE_METHODS)}")
+	if n_resamples < 1:
+		raise ValueError('n_resamples must be a positive integer')
+
+	labels = np.concatenate([singles.index.values, zscore_df.index.values])
+	if pair_index is None:
+		pair_index = PairIndex(labels, genepair_del)
+	solver = GramSolver(_design_matrix(pair_index, labels, singles.index), fit_intercept)
+
+	fitted = np.concatenate([singles['fc_exp'].values, zscore_df['fc_exp'].values])
+	residuals = np.concatenate([singles['fc_obs'].values, zscore_df['fc_obs'].values]) - fitted
+	local_std = zscore_df['local_std'].values
+	observed = zscore_df['GI_Zscore'].values
+
+	# noise scale of every construct: the local std of its fc_exp window (interpolated for
+	# singles), inflated by the leverage the regression removes from its residual
+	by_fc = np.argsort(zscore_df['fc_exp'].values)
+	scale = np.concatenate([np.interp(singles['fc_exp'].values, 
+									  zscore_df['fc_exp'].values[by_fc], local_std[by_fc]),
+							local_std])
+	free = 1. - np.clip(solver.leverage(), 0., 1.)
+	studentized = np.full(len(labels), np.nan)
+	valid = (free > 1e-10) & (scale > 0)
+	studentized[valid] = residuals[valid] / (scale[valid] * np.sqrt(free[valid]))
+
+	# robust normal null matched to the centre of the studentized residuals
+	center = np.median(studentized[valid])
+	sigma = 1.4826 * np.median(np.abs(studentized[valid] - center))
+	if not sigma > 0:
+		raise ValueError('Cannot fit an empirical null: the residuals have no spread')
+	core = studentized[valid][np.abs(studentized[valid] - center) <= NULL_CORE_Z * sigma] - center
+	p_tail = 2 * norm.sf(NULL_CORE_Z)
+
+	n_rows = len(labels)
+	chunk_size = max(1, min(n_resamples, RESAMPLE_CHUNK_VALUES // n_rows))
+	chunks = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+	seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+
+	def count_chunk(args: Tuple[int, np.random.SeedSequence]) -> Tuple[np.ndarray, np.ndarray]:
+		size, chunk_seed = args
+		rng = np.random.default_rng(chunk_seed)
+		if method == 'permutation':
+			# every resample shuffles the central residuals, repeated to cover all constructs
+			repeats = -(-n_rows // len(core))
+			noise = rng.permuted(np.tile(core[:, None], (repeats, size)), axis=0)[:n_rows]
+		else:
+			noise = core[rng.integers(0, len(core), size=(n_rows, size))]
+		tail = rng.random((n_rows, size)) < p_tail
+		n_tail = tail.sum()
+		noise[tail] = sigma * norm.isf(rng.random(n_tail) * norm.sf(NULL_CORE_Z)) \
+					  * rng.choice([-1., 1.], size=n_tail)
+		null_obs = fitted[:, None] + scale[:, None] * (center + noise)
+
+		coef, intercept = solver.solve(null_obs)
+		null_pred = solver.predict(coef, intercept).reshape(null_obs.shape)
+		null_z = (null_obs - null_pred)[len(singles):] / local_std[:, None]
+
+		null_z = np.sort(null_z.ravel())
+		n_le = np.searchsorted(null_z, observed, side='right')
+		n_ge = len(null_z) - np.searchsorted(null_z, observed, side='left')
+		return n_le, n_ge
+
+	n_jobs = n_jobs or os.cpu_count() or 1
+	with ThreadPoolExecutor(max_workers=min(n_jobs, len(chunks))) as pool:
+		counts = list(pool.map(count_chunk, zip(chunks, seeds)))
+	n_le = np.sum([x[0] for x in counts], axis=0)
+	n_ge = np.sum([x[1] for x in counts], axis=0)
+	n_null = n_resamples * len(zscore_df)
+
+	zscore_df = zscore_df.copy()
+	zscore_df['Pval_synth_emp'] = (1. + n_le) / (1. + n_null)
+	zscore_df['Padj_synth_emp'] = benjamini_hochberg(zscore_df['Pval_synth_emp'].values)
+	zscore_df['Pval_supp_emp'] = (1. + n_ge) / (1. + n_null)
+	zscore_df['Padj_supp_emp'] = benjamini_hochberg(zscore_df['Pval_supp_emp'].values)
+	print(f'[INFO] Empirical p-values from {n_resamples} {method} resamples.')
+
+	return zscore_df
+
+def _design_matrix(pair_index: PairIndex, labels: np.ndarray, genes: pd.Index) -> sp.csr_matrix:
+	"""
+	Binary predictor matrix of `labels` (rows) over `genes` (columns), as built by
+	make_predictor_matrix() for the same regression.
+	"""
+	owner, codes = pair_index.explode(pair_index.positions(labels))
+	column = pd.Index(genes).get_indexer(pair_index.genes)[codes]
+	if (column < 0).any():
+		raise KeyError('pairs target genes that are not in the singles of the regression')
+	return sp.csr_matrix((np.ones(len(owner)), (owner, column)), shape=(len(labels), len(genes)))
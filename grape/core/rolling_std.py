@@ -0,0 +1,175 @@
+"""
+This file calculates local (windowed) robust standard deviations for GI Z-scores
+"""
+
+
+import math
+from bisect import bisect_left, bisect_right, insort
+from typing import Optional
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+WINDOW_CHUNK_SIZE: int = 2**22
+"""Maximum number of values held in memory at once by the batched engine"""
+
+
+def rolling_robust_std(values: np.ndarray, half_window_size: int, stepsize: Optional[int] = None,
+					   monotone_filter: bool = False, method: Optional[str] = None) -> np.ndarray:
+	"""
+	Local standard deviation of `values` in sliding windows, after removing outliers beyond
+	1.5 IQR of each window (drugz variance window method).
+
+	A window of 2 * half_window_size values starts every `stepsize` values. Its standard deviation
+	is assigned to the `stepsize` values following the window centre; the first and last
+	half_window_size values take the value of the nearest window.
+
+	Parameters:
+        values : np.ndarray
+            Values (GI_raw) ordered by expected fold change
+        half_window_size : int
+            Half-window size for calculating local variance
+        stepsize : int, optional
+            Distance between consecutive windows. Default is ceil(half_window_size / 5); use 1 to
+            give every value its own centred window.
+        monotone_filter : bool, optional
+            If True, ensures a monotonically increasing variance. Default is False.
+        method : str, optional
+            'batch' evaluates windows in vectorized chunks; 'incremental' slides one sorted window
+            over the data and only updates the values that enter and leave it. Default is
+            'incremental' for stepsize 1 and 'batch' otherwise.
+
+    Returns:
+        np.ndarray
+            Local standard deviation for every value
+	"""
+	values = np.asarray(values, dtype=float)
+	n_values = len(values)
+	if stepsize is None:
+		stepsize = int(np.ceil(half_window_size / 5))
+	if method is None:
+		method = 'incremental' if stepsize == 1 else 'batch'
+	if half_window_size < 1 or stepsize < 1:
+		raise ValueError('half_window_size and stepsize must be positive integers')
+	if n_values <= half_window_size:
+		raise ValueError(f'half_window_size ({half_window_size}) must not exceed the number of '
+						 f'pairs ({n_values})')
+
+	# windows are centred on idx in range(half_window_size, n - half_window_size, stepsize)
+	window_size = 2 * half_window_size
+	starts = np.arange(0, n_values - window_size, stepsize)
+	if method == 'batch':
+		window_std = _batch_window_std(values, window_size, starts)
+	elif method == 'incremental':
+		window_std = _incremental_window_std(values, window_size, starts)
+	else:
+		raise ValueError(f'Unknown rolling std method: {method}')
+
+	if monotone_filter:
+		window_std = np.maximum.accumulate(window_std) if len(window_std) else window_std
+
+	local_std = np.zeros(n_values)
+	filled = np.repeat(window_std, stepsize)[:n_values - half_window_size]
+	local_std[half_window_size : half_window_size + len(filled)] = filled
+
+	# now for the first (0..half_window_size) and last segments
+	local_std[:half_window_size] = local_std[half_window_size]
+	local_std[-half_window_size:] = local_std[-half_window_size - 1]
+
+	return local_std
+
+def _batch_window_std(values: np.ndarray, window_size: int, starts: np.ndarray) -> np.ndarray:
+	"""
+	Robust standard deviation of the windows values[s : s + window_size] for s in starts,
+	computed a chunk of windows at a time.
+	"""
+	windows = sliding_window_view(values, window_size)
+	window_std = np.empty(len(starts))
+	chunk = max(1, WINDOW_CHUNK_SIZE // window_size)
+
+	for i in range(0, len(starts), chunk):
+		bins = windows[starts[i : i + chunk]]
+
+		# remove outliers and calculate std
+		Q1, Q3 = np.quantile(bins, [0.25, 0.75], axis=1)
+		IQR = Q3 - Q1
+		lower_bound = (Q1 - 1.5*IQR)[:, None]
+		upper_bound = (Q3 + 1.5*IQR)[:, None]
+		inlier = (bins >= lower_bound) & (bins <= upper_bound)
+
+		count = inlier.sum(axis=1)
+		avg = np.where(inlier, bins, 0.).sum(axis=1) / count
+		sqr = np.where(inlier, (avg[:, None] - bins)**2, 0.).sum(axis=1)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			window_std[i : i + chunk] = np.sqrt(sqr / (count - 1))
+
+	return window_std
+
+def _incremental_window_std(values: np.ndarray, window_size: int, starts: np.ndarray) -> \
+	np.ndarray:
+	"""
+	Robust standard deviation of the windows values[s : s + window_size] for s in starts.
+
+	Keeps one sorted window and running sums of (shifted) values and squares. The quartiles are
+	read off the sorted window, and the outliers, which sit at both ends of it, are subtracted
+	from the running sums, so each step only costs the values entering and leaving the window.
+	"""
+	data = values.tolist()
+	shift = float(np.median(values)) if len(values) else 0.
+	window_std = np.empty(len(starts))
+
+	# linear interpolation positions of the quartiles, as in np.quantile
+	quartiles = []
+	for q in (0.25, 0.75):
+		position = q * (window_size - 1)
+		lower = int(math.floor(position))
+		quartiles.append((lower, min(lower + 1, window_size - 1), position - lower))
+
+	window = []
+	sum1 = sum2 = 0.
+	n_updates = window_size
+	prev_start = None
+	for i, start in enumerate(starts.tolist()):
+		if prev_start is None or start - prev_start >= window_size or n_updates >= window_size:
+			# (re)build the window, also refreshing the running sums against round-off
+			window = sorted(data[start : start + window_size])
+			shifted = [x - shift for x in window]
+			sum1 = math.fsum(shifted)
+			sum2 = math.fsum(x * x for x in shifted)
+			n_updates = 0
+		else:
+			for j in range(prev_start, start):
+				leaving, entering = data[j], data[j + window_size]
+				del window[bisect_left(window, leaving)]
+				insort(window, entering)
+				sum1 += (entering - shift) - (leaving - shift)
+				sum2 += (entering - shift)**2 - (leaving - shift)**2
+			n_updates += start - prev_start
+		prev_start = start
+
+		Q1, Q3 = (_lerp(window[lower], window[upper], t) for lower, upper, t in quartiles)
+		IQR = Q3 - Q1
+		lo = bisect_left(window, Q1 - 1.5*IQR)
+		hi = bisect_right(window, Q3 + 1.5*IQR)
+
+		count = hi - lo
+		outliers = [x - shift for x in window[:lo]] + [x - shift for x in window[hi:]]
+		inlier_sum1 = sum1 - math.fsum(outliers)
+		inlier_sum2 = sum2 - math.fsum(x * x for x in outliers)
+		if count > 1:
+			variance = (inlier_sum2 - inlier_sum1 * inlier_sum1 / count) / (count - 1)
+			window_std[i] = math.sqrt(max(variance, 0.))
+		else:
+			window_std[i] = np.nan
+
+	return window_std
+
+def _lerp(a: float, b: float, t: float) -> float:
+	"""
+	Linear interpolation between a and b, using the same formula as np.quantile.
+	"""
+	diff_b_a = b - a
+	if t >= 0.5:
+		return b - diff_b_a * (1 - t)
+	return a + diff_b_a * t
@@ -4,82 +4,79 @@ This file holds the workflow for the GRAPE package
 
 
 from argparse import Namespace
-
-from grape.core.load_input import load_genelist, load_readcount_matrix
-from grape.core.foldchange_generator import *
-from grape.core.regression import *
-from grape.core.zscore_generator import *
-
-
-def run(args: Namespace) -> None:
-
-    # 01: load input read count file
-    reads = load_readcount_matrix(args.input_filepath)
-
-    # 02: generate fold change input
-    raw_fc = get_foldchange_matrix(reads, args.control_columns, args.min_reads, args.pseudocount)
-    fc = get_mean_foldchange(raw_fc, args.target_columns, args.no_mean_replicates, 
-                             args.no_groupby_targets)
-    if args.nonessential_gene_file is None:
-        modecenter_meanfc = mode_center(fc)
-    else:
-        noness = load_genelist(args.nonessential_gene_file)
-        modecenter_meanfc = mode_center_vs_reference_genes(fc, noness)
-    
-    # 03: load target gene list
-    target_gene_list = load_genelist(args.target_gene_file)
-    if args.query_gene_file is not None:
-        query_genes = load_genelist(args.query_gene_file)
-        target_gene_list = list(set(target_gene_list + query_genes))
-
-    # 04: run regression
-    predictor, obs = make_predictor_matrix(modecenter_meanfc, target_gene_list, args.genepair_del)
-    pairs, singles, model = do_regression(predictor, obs, args.fit_intercept, args.genepair_del)
-
-    # 05: apply dynamic range filter and re-run regression
-    remove_me = dynamic_range_filter(pairs)
-    print(f'[INFO] Dynamic range filter removed {len(remove_me)} gene pairs.')
-
-    fc_filt = fc.drop(remove_me.index.values, axis=0, errors='ignore')
-
-    if args.nonessential_gene_file is None:
-        modecenter_meanfc_filt = mode_center(fc_filt)
-    else:
-        noness = load_genelist(args.nonessential_gene_file)
-        modecenter_meanfc_filt = mode_center_vs_reference_genes(fc_filt, noness)
-
-    predictor, obs = make_predictor_matrix(modecenter_meanfc_filt, target_gene_list, args.genepair_del)
-    pairs, singles, model = do_regression(predictor, obs, args.fit_intercept, args.genepair_del)
-    print(
-        f"[INFO] Regression R²: {model['Rsq']:.3f}, Intercept: {model['Intercept']}")
-    
-    # 06: calculate GI Zscore
-    pairs_localZ = get_zscore(pairs, args.half_window_size, args.monotone_filter)
-    
-    # 07: save outputs
-    output = pairs_localZ.copy()
-    float_format = '{:.3f}'
-    sci_format = '{:.2e}'
-    output.index.name='GENE_PAIR'
-    
-    for col in output.columns[:8]:
-        output[col] = output[col].map(lambda x: float_format.format(x))
-
-    for col in output.columns[8:]:
-        output[col] = output[col].map(lambda x: sci_format.format(x))
-
-    output_path = args.output_directory.rstrip('/') + '/'
-    prefix = f"_{args.output_prefix.rstrip('_')}" if args.output_prefix else ""
-    
-    output.to_csv(output_path + f'grape_pairs{prefix}.txt', sep='\t')
-    
-    singles_fmt = singles.copy()
-    singles_fmt = singles_fmt.map(lambda x: float_format.format(x))
-    singles_fmt.to_csv(output_path + f'grape_singles{prefix}.txt', sep='\t')
-    
-    modecenter_meanfc_fmt = modecenter_meanfc.copy()
-    modecenter_meanfc_fmt = modecenter_meanfc_fmt.map(lambda x: float_format.format(x))
-    modecenter_meanfc_fmt.to_csv(output_path + f"modecenter_meanfc{prefix}.txt", sep="\t")
+from typing import Dict, Optional
+
+from grape.core.analysis import GrapeResult, analyze
+from grape.core.library import GuideLibrary
+from grape.core.load_input import load_genelist
+from grape.utils.cache import StageCache
+from grape.utils.profiler import StageProfiler
+
+
+def run(args: Namespace, shared: Optional[Dict] = None, cache: Optional[StageCache] = None,
+        concurrent: bool = False) -> GrapeResult:
+
+    # parsed gene lists, saved libraries and the pair index of the library are kept in
+    # `shared`, so runs on the same library (e.g. the screens of a batch) only build them once.
+    # The stores may be bounded and shared by concurrent runs (grape serve), so an entry can be
+    # evicted at any time: the loaded object is kept locally rather than read back.
+    shared = {} if shared is None else shared
+    gene_lists = shared.setdefault('gene_lists', {})
+    def genelist(filepath):
+        if filepath is None:
+            return None
+        genes = gene_lists.get(filepath)
+        if genes is None:
+            genes = load_genelist(filepath)
+            gene_lists[filepath] = genes
+        return genes
+
+    libraries = shared.setdefault('libraries', {})
+    library = None
+    if args.library is not None:
+        library = libraries.get(args.library)
+        if library is None:
+            library = GuideLibrary.load(args.library)
+            libraries[args.library] = library
+
+    # stage outputs are cached on disk if --cache-dir is given (or shared by a sweep)
+    if cache is None:
+        cache = StageCache(args.cache_dir, args.cache_size)
+    # other runs in threads of this process (concurrent) share its CPU time and memory, so
+    # their profiles hold wall times only
+    profiler = StageProfiler(enabled=args.profile is not None, concurrent=concurrent)
+
+    try:
+        result = analyze(args.input_filepath, args.control_columns, genelist(args.target_gene_file),
+                         target_columns=args.target_columns, min_reads=args.min_reads,
+                         pseudocount=args.pseudocount, float32=args.float32,
+                         streaming=args.streaming, chunk_size=args.chunk_size,
+                         no_mean_replicates=args.no_mean_replicates,
+                         no_groupby_targets=args.no_groupby_targets,
+                         nonessential_genes=genelist(args.nonessential_gene_file),
+                         query_genes=genelist(args.query_gene_file),
+                         genepair_del=args.genepair_del, sparse=args.sparse,
+                         mode_method=args.mode_method, regression_backend=args.regression_backend,
+                         block_solve=args.block_solve, fit_intercept=args.fit_intercept,
+                         incremental_filter=args.incremental_filter,
+                         iterate_filter=args.iterate_filter,
+                         half_window_size=args.half_window_size, window_step=args.window_step,
+                         monotone_filter=args.monotone_filter, diagnostics=args.diagnostics,
+                         resamples=args.resamples, resample_method=args.resample_method,
+                         seed=args.seed, threads=args.threads, library=library, cache=cache,
+                         shared=shared, profiler=profiler)
+
+        profiler.profile('write', result.save, args.output_directory, args.output_prefix, 
+                         args.output_format, args.gi_matrix)
+        output_path = args.output_directory.rstrip('/') + '/'
+
+        if profiler.enabled:
+            prefix = f"_{args.output_prefix.rstrip('_')}" if args.output_prefix else ""
+            profile_path = args.profile or output_path + f'grape_profile{prefix}.json'
+            profiler.write(profile_path, {k: v for k, v in vars(args).items() if k != 'profile'})
+    finally:
+        # memory tracing slows every later allocation of a long-lived process (grape serve)
+        profiler.stop()
 
     print(f"[INFO] GRAPE analysis complete. Results saved to {output_path}.")
-
+    return result
@@ -0,0 +1,269 @@
+"""
+This file runs GRAPE as a long-lived local service that accepts analysis jobs over a socket
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import time
+import traceback
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, Optional
+
+from grape.core.run import run
+from grape.utils.cache import LRUCache
+from grape.utils.version import __version__
+
+
+REQUIRED_JOB_FIELDS = ('input_filepath', 'output_directory', 'control_columns',
+                       'target_gene_file')
+"""Fields every job must set; all other fields default to the command-line defaults"""
+
+MAX_MESSAGE_BYTES: int = 2**20
+"""Maximum length of one request line"""
+
+
+class GrapeServer:
+    """
+    Local GRAPE service. Clients connect to a Unix socket or a localhost TCP port and send
+    JSON objects, one per line; the server answers with JSON lines.
+
+    A job is an object with the fields of a single run (input_filepath, output_directory,
+    control_columns, target_gene_file and any optional argument, e.g. half_window_size; hyphens
+    may be used instead of underscores) and an optional `id` echoed in every reply. Jobs are
+    queued and run in a pool of `workers` threads. The server replies with the status of each job
+    as it progresses: "queued" (with the number of jobs ahead), "running", then "done" with the
+    paths of the output files and the run time, or "failed" with the error. Requests with a
+    `command` field are answered directly: "ping", "stats" and "shutdown".
+
+    Parsed gene lists, loaded libraries (--library) and the pair indices of the libraries stay
+    in memory across jobs, each bounded to the `max_warm` most recently used entries, so that
+    a job of a known library does not re-read its gene lists or re-parse its constructs.
+
+    Parameters:
+        workers: int, optional
+            Number of jobs run concurrently. Default is the number of CPUs.
+        max_warm: int
+            Number of gene lists, libraries and pair indices kept in memory. Default 8.
+    """
+
+    def __init__(self, workers: Optional[int] = None, max_warm: int = 8):
+        self.workers = workers or os.cpu_count() or 1
+        self.shared = {'gene_lists': LRUCache(max_warm), 'libraries': LRUCache(max_warm),
+                       'pair_indices': LRUCache(max_warm)}
+        self.defaults = _job_defaults()
+        self.stats = {'submitted': 0, 'done': 0, 'failed': 0}
+        self._ids = itertools.count(1)
+        self._queue = None
+        self._stopped = None
+
+    async def serve(self, socket_path: Optional[str] = None, host: str = '127.0.0.1',
+                    port: Optional[int] = None):
+        """
+        Listen on `socket_path` (Unix socket) or on host:port until a shutdown request.
+        """
+        self._queue = asyncio.Queue()
+        self._stopped = asyncio.Event()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        workers = [asyncio.create_task(self._worker(executor)) for _ in range(self.workers)]
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self._handle, path=socket_path,
+                                                     limit=MAX_MESSAGE_BYTES)
+            address = socket_path
+        else:
+            server = await asyncio.start_server(self._handle, host, port,
+                                                limit=MAX_MESSAGE_BYTES)
+            address = '{}:{}'.format(*server.sockets[0].getsockname()[:2])
+        print(f'[INFO] GRAPE {__version__} serving on {address} with {self.workers} workers.',
+              flush=True)
+
+        try:
+            await self._stopped.wait()
+            server.close()
+            # finish the jobs already accepted
+            await self._queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            executor.shutdown(wait=True)
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+        print('[INFO] GRAPE server stopped.', flush=True)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        lock = asyncio.Lock()
+        async def reply(message: Dict[str, Any]):
+            async with lock:
+                if writer.is_closing():
+                    return
+                writer.write((json.dumps(message, default=str) + '\n').encode('utf-8'))
+                await writer.drain()
+
+        jobs = []
+        try:
+            while not self._stopped.is_set():
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    await reply({'status': 'error', 'error': 'request line too long'})
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('request must be a JSON object')
+                except ValueError as e:
+                    await reply({'status': 'error', 'error': f'invalid request: {e}'})
+                    continue
+
+                if 'command' in request:
+                    await reply(self._command(request))
+                    continue
+
+                job_id = request.pop('id', None)
+                if job_id is None:
+                    job_id = next(self._ids)
+                try:
+                    args = self.job_arguments(request)
+                except (ValueError, TypeError) as e:
+                    await reply({'id': job_id, 'status': 'failed', 'error': str(e)})
+                    continue
+
+                done = asyncio.get_running_loop().create_future()
+                self.stats['submitted'] += 1
+                await reply({'id': job_id, 'status': 'queued', 'ahead': self._queue.qsize()})
+                await self._queue.put((job_id, args, reply, done))
+                jobs.append(done)
+
+            # keep the connection open until its jobs are finished
+            await asyncio.gather(*jobs)
+        finally:
+            writer.close()
+
+    def _command(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        command = request['command']
+        if command == 'ping':
+            return {'status': 'ok', 'version': __version__}
+        if command == 'stats':
+            return {'status': 'ok', 'queued': self._queue.qsize(), **self.stats,
+                    'warm': {name: list(map(str, store)) for name, store in self.shared.items()}}
+        if command == 'shutdown':
+            self._stopped.set()
+            return {'status': 'ok', 'queued': self._queue.qsize()}
+        return {'status': 'error', 'error': f"unknown command '{command}'"}
+
+    def job_arguments(self, job: Dict[str, Any]) -> Namespace:
+        """
+        Arguments of run() for a job: the command-line defaults updated with the job fields.
+        """
+        job = {str(k).replace('-', '_'): v for k, v in job.items()}
+        missing = [x for x in REQUIRED_JOB_FIELDS if job.get(x) is None]
+        if missing:
+            raise ValueError(f"job is missing required field(s): {', '.join(missing)}")
+        unknown = set(job) - set(self.defaults) - set(REQUIRED_JOB_FIELDS)
+        if unknown:
+            raise ValueError(f"unknown job field(s): {', '.join(sorted(unknown))}")
+
+        for field in ('control_columns', 'target_columns'):
+            if isinstance(job.get(field), str):
+                job[field] = job[field].replace(',', ' ').split()
+        return Namespace(**{**self.defaults, **job})
+
+    async def _worker(self, executor: ThreadPoolExecutor):
+        loop = asyncio.get_running_loop()
+        while True:
+            job_id, args, reply, done = await self._queue.get()
+            try:
+                await reply({'id': job_id, 'status': 'running'})
+                start = time.time()
+                try:
+                    os.makedirs(args.output_directory, exist_ok=True)
+                    # with several workers, job profiles hold wall times only
+                    result = await loop.run_in_executor(executor, run, args, self.shared, None,
+                                                        self.workers > 1)
+                except Exception as e:
+                    traceback.print_exc()
+                    self.stats['failed'] += 1
+                    await reply({'id': job_id, 'status': 'failed',
+                                 'error': f'{type(e).__name__}: {e}',
+                                 'seconds': round(time.time() - start, 3)})
+                else:
+                    self.stats['done'] += 1
+                    await reply({'id': job_id, 'status': 'done',
+                                 'outputs': result.output_paths(args.output_directory,
+                                                                args.output_prefix,
+                                                                args.output_format,
+                                                                args.gi_matrix),
+                                 'seconds': round(time.time() - start, 3)})
+            except (ConnectionError, OSError):
+                # the client went away; the job itself has finished
+                pass
+            finally:
+                if not done.done():
+                    done.set_result(None)
+                self._queue.task_done()
+
+
+def serve(args: Namespace):
+    """
+    Run the GRAPE service until it is shut down (shutdown command or interrupt).
+
+    Parameters:
+        args: Namespace
+            Arguments of `grape serve`: socket or host and port, workers and max_warm
+    """
+    server = GrapeServer(args.workers, args.max_warm)
+    try:
+        asyncio.run(server.serve(args.socket, args.host, args.port))
+    except KeyboardInterrupt:
+        print('[INFO] GRAPE server interrupted.')
+
+def submit_job(job: Dict[str, Any], socket_path: Optional[str] = None,
+               host: str = '127.0.0.1', port: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Send a job (or a command) to a running GRAPE service and yield its replies until the job is
+    done or failed.
+
+    Parameters:
+        job: Dict[str, Any]
+            Job fields, see GrapeServer, or a {"command": ...} request
+        socket_path: str, optional
+            Unix socket of the service. If None, host and port are used.
+        host, port:
+            TCP address of the service
+
+    Returns:
+        Iterator[Dict[str, Any]]
+            Replies of the service
+    """
+    if socket_path is not None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socket_path)
+    else:
+        connection = socket.create_connection((host, port))
+
+    with connection, connection.makefile('rw', encoding='utf-8') as stream:
+        stream.write(json.dumps(job) + '\n')
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            yield message
+            if 'command' in job or message.get('status') in ('done', 'failed', 'error'):
+                return
+
+def _job_defaults() -> Dict[str, Any]:
+    """Command-line defaults of the options of a single run."""
+    from grape.cli import add_optional_arguments
+    parser = argparse.ArgumentParser()
+    add_optional_arguments(parser)
+    return vars(parser.parse_args([]))
@@ -0,0 +1,375 @@
+"""
+This file holds the sparse least-squares backend used by the regression
+"""
+
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from typing import Callable, List, Optional, Tuple, Union
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.linalg import cho_factor, cho_solve, lu_factor, lu_solve
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import splu, lsqr
+
+
+MAX_DOWNDATE_RANK: float = 0.5
+"""Rows removed by low-rank downdates, as a fraction of the number of coefficients, before the
+Gram matrix is factorized again from scratch"""
+
+LEVERAGE_CHUNK_ELEMENTS: int = 2**22
+"""Size (rows x coefficients) of the dense blocks in which leverages are computed"""
+
+
+class GramSolver:
+	"""
+	Ordinary least-squares solver for a sparse design matrix based on the normal equations.
+
+	The Gram matrix X'X of a GRAPE predictor matrix is only genes x genes, so it is factorized
+	once (sparse LU) and every response vector is solved against that factorization. If the Gram
+	matrix is singular (e.g. two genes that only ever occur together), LSQR is used instead, which
+	converges to the same minimum-norm solution returned by the dense solver.
+
+	Rows can be removed with remove_rows(), which downdates the existing factorization
+	(Sherman-Morrison-Woodbury) instead of factorizing the reduced Gram matrix again.
+
+	Parameters:
+        design : scipy.sparse matrix
+            Binary predictor matrix (constructs x genes)
+        fit_intercept : bool
+            Whether to append an intercept column to the design. Default is False.
+	"""
+
+	def __init__(self, design: sp.spmatrix, fit_intercept: bool = False):
+		design = sp.csr_matrix(design, dtype=float)
+		if fit_intercept:
+			design = sp.hstack([design, np.ones((design.shape[0], 1))], format='csr')
+		self.design = design
+		self.fit_intercept = fit_intercept
+		self._factorize()
+
+	@classmethod
+	def from_factor(cls, design: sp.spmatrix, factor: 'CholeskyFactor', 
+					fit_intercept: bool = False) -> 'GramSolver':
+		"""
+		Solver for `design` from a stored factorization of its Gram matrix (e.g. a saved guide 
+		library), without factorizing it again. `factor` must have been computed from the design 
+		including the intercept column if fit_intercept.
+		"""
+		solver = object.__new__(cls)
+		design = sp.csr_matrix(design, dtype=float)
+		if fit_intercept:
+			design = sp.hstack([design, np.ones((design.shape[0], 1))], format='csr')
+		solver.design = design
+		solver.fit_intercept = fit_intercept
+		solver.gram = None
+		solver._base = None
+		solver._rows = np.arange(design.shape[0])
+		solver._lu = factor
+		return solver
+
+	def _factorize(self):
+		self.gram = (self.design.T @ self.design).tocsc()
+		self._base = None
+		self._rows = np.arange(self.design.shape[0])
+		try:
+			self._lu = splu(self.gram)
+		except RuntimeError:
+			# exactly singular Gram matrix
+			self._lu = None
+
+	@property
+	def is_factorized(self) -> bool:
+		"""
+		Whether solves use a factorization of the Gram matrix (False when LSQR is used).
+		"""
+		return self._base is not None or self._lu is not None
+
+	def solve_gram(self, rhs: np.ndarray) -> np.ndarray:
+		"""
+		Solve X'X b = rhs for one or more right-hand sides (columns of `rhs`).
+		"""
+		if self._base is None:
+			return self._lu.solve(rhs)
+
+		# Woodbury: (G - U'U)^-1 = G^-1 + G^-1 U' (I - U G^-1 U')^-1 U G^-1
+		base_solution = self._base.solve_gram(rhs)
+		return base_solution + self._z @ lu_solve(self._capacitance, self._u @ base_solution)
+
+	def solve(self, obs: np.ndarray) -> Tuple[np.ndarray, Union[np.ndarray, float]]:
+		"""
+		Solve the least-squares problem for one or more response vectors.
+
+		Parameters:
+            obs : np.ndarray
+                Response vector, one value per row of the design matrix, or a matrix with one
+                response per column
+
+		Returns:
+            Tuple[np.ndarray, Union[np.ndarray, float]]
+                - Coefficients, one per gene (genes x responses for several responses)
+                - Intercept, one per response (0. when fit_intercept is False)
+		"""
+		obs = np.asarray(obs, dtype=float)
+		if obs.ndim == 1 or obs.shape[1] == 1:
+			obs = obs.ravel()
+		if self.is_factorized:
+			beta = self.solve_gram(self.design.T @ obs)
+		else:
+			lsqr_solve = lambda y: lsqr(self.design, y, atol=1e-12, btol=1e-12,
+										iter_lim=10*self.design.shape[1])[0]
+			beta = lsqr_solve(obs) if obs.ndim == 1 else \
+				   np.column_stack([lsqr_solve(y) for y in obs.T])
+
+		if self.fit_intercept:
+			return beta[:-1], np.atleast_1d(beta[-1])
+		return beta, 0.
+
+	def predict(self, coef: np.ndarray, intercept: Union[np.ndarray, float] = 0.) -> np.ndarray:
+		"""
+		Predicted response for every row of the design matrix.
+		"""
+		if self.fit_intercept:
+			coef = np.concatenate([coef, np.reshape(intercept, (1,) + coef.shape[1:])])
+		return self.design @ coef
+
+	def leverage(self) -> np.ndarray:
+		"""
+		Diagonal of the hat matrix X (X'X)^-1 X', i.e. the leverage of every row of the design. 
+		The inverse Gram matrix (genes x genes) is solved once from the factorization; if the Gram 
+		matrix is singular, its pseudo-inverse is used. Rows are processed in chunks, so the 
+		n x n hat matrix is never formed.
+		"""
+		n_rows, n_cols = self.design.shape
+		if self.is_factorized:
+			gram_inv = self.solve_gram(np.eye(n_cols))
+		else:
+			gram_inv = np.linalg.pinv((self.design.T @ self.design).toarray(), hermitian=True)
+
+		leverage = np.empty(n_rows)
+		chunksize = max(1, LEVERAGE_CHUNK_ELEMENTS // max(1, n_cols))
+		for start in range(0, n_rows, chunksize):
+			rows = self.design[start : start + chunksize]
+			leverage[start : start + chunksize] = np.asarray(
+				rows.multiply(rows @ gram_inv).sum(axis=1)).ravel()
+		return leverage
+
+	def remove_rows(self, rows: np.ndarray) -> 'GramSolver':
+		"""
+		Solver for the design matrix without `rows` (positions in the current design).
+
+		The factorization of the original Gram matrix is kept and corrected for all rows removed
+		so far by a small dense capacitance matrix. If the downdated Gram matrix is singular or
+		too many rows have been removed, the reduced design is factorized from scratch.
+
+		Parameters:
+            rows : np.ndarray
+                Positions of the rows to remove
+
+		Returns:
+            GramSolver
+                Solver for the reduced design matrix. The current solver is left unchanged.
+		"""
+		keep = np.ones(self.design.shape[0], dtype=bool)
+		keep[rows] = False
+
+		solver = object.__new__(GramSolver)
+		solver.design = self.design[keep]
+		solver.fit_intercept = self.fit_intercept
+		solver.gram = None
+		solver._lu = None
+
+		base = self._base if self._base is not None else self
+		solver._rows = self._rows[keep]
+		removed = np.setdiff1d(np.arange(base.design.shape[0]), solver._rows)
+
+		if len(removed) == 0:
+			solver.gram, solver._lu, solver._base = base.gram, base._lu, None
+			return solver
+		if (not base.is_factorized) or \
+		   len(removed) > MAX_DOWNDATE_RANK * base.design.shape[1]:
+			solver._factorize()
+			return solver
+
+		solver._base = base
+		solver._u = base.design[removed]
+		solver._z = base.solve_gram(solver._u.T.toarray())
+		capacitance = np.eye(len(removed)) - solver._u @ solver._z
+		if np.linalg.matrix_rank(capacitance) < len(removed):
+			# the reduced Gram matrix is singular
+			solver._factorize()
+			return solver
+		solver._capacitance = lu_factor(capacitance)
+		return solver
+
+
+class CholeskyFactor:
+	"""
+	Dense Cholesky factorization of a Gram matrix, usable in place of the sparse LU of GramSolver.
+	Each solve is O(p^2) for p genes.
+
+	Parameters:
+        factor : np.ndarray
+            Upper triangular Cholesky factor, as returned by scipy.linalg.cho_factor()
+	"""
+
+	def __init__(self, factor: np.ndarray):
+		self.factor = factor
+
+	@classmethod
+	def from_gram(cls, gram: Union[np.ndarray, sp.spmatrix]) -> Optional['CholeskyFactor']:
+		"""
+		Factorize a Gram matrix. Returns None if it is not positive definite (singular design).
+		"""
+		gram = gram.toarray() if sp.issparse(gram) else np.asarray(gram, dtype=float)
+		try:
+			return cls(cho_factor(gram, lower=False)[0])
+		except np.linalg.LinAlgError:
+			return None
+
+	def solve(self, rhs: np.ndarray) -> np.ndarray:
+		return cho_solve((self.factor, False), rhs)
+
+
+class BlockSolver:
+	"""
+	Ordinary least-squares solver that splits the design matrix into independent blocks.
+
+	Genes that never occur in the same construct, directly or through other genes, have no
+	coefficients in common: the blocks are the connected components of the gene-construct graph
+	(e.g. separate sub-libraries or query panels). Each block is factorized and solved by its own
+	GramSolver, in a thread pool, and the coefficients are merged. The solution equals that of a
+	GramSolver on the whole design. An intercept connects all constructs, so with fit_intercept
+	the design is solved as one block.
+
+	Parameters:
+        design : scipy.sparse matrix
+            Binary predictor matrix (constructs x genes)
+        fit_intercept : bool
+            Whether to fit an intercept. Default is False.
+        n_jobs : int, optional
+            Number of threads factorizing and solving blocks. Default is the number of CPUs.
+	"""
+
+	def __init__(self, design: sp.spmatrix, fit_intercept: bool = False,
+				 n_jobs: Optional[int] = None):
+		self.design = sp.csr_matrix(design, dtype=float)
+		self.fit_intercept = fit_intercept
+		self.n_jobs = n_jobs
+
+		n_genes = self.design.shape[1]
+		if fit_intercept:
+			n_blocks, gene_block = 1, np.zeros(n_genes, dtype=np.int64)
+		else:
+			n_blocks, gene_block = connected_components(self.design.T @ self.design, 
+														directed=False)
+		# every construct belongs to the block of its (first) gene
+		row_block = np.full(self.design.shape[0], 0 if fit_intercept else -1)
+		has_gene = np.diff(self.design.indptr) > 0
+		row_block[has_gene] = gene_block[self.design.indices[self.design.indptr[:-1][has_gene]]]
+
+		self.gene_blocks = _group_positions(gene_block, n_blocks)
+		self.row_blocks = _group_positions(row_block, n_blocks)
+		# position of every gene within its block
+		local_column = np.empty(n_genes, dtype=np.int64)
+		for genes in self.gene_blocks:
+			local_column[genes] = np.arange(len(genes))
+
+		def block_solver(b: int) -> GramSolver:
+			# the rows of a block only use its genes, so its columns are a relabelling
+			block = self.design[self.row_blocks[b]]
+			block = sp.csr_matrix((block.data, local_column[block.indices], block.indptr),
+								  shape=(block.shape[0], len(self.gene_blocks[b])))
+			return GramSolver(block, fit_intercept)
+
+		self.blocks = self._map(block_solver, range(n_blocks))
+		if n_blocks > 1:
+			print(f'[INFO] Regression split into {n_blocks} independent blocks.')
+
+	def _map(self, func: Callable, items) -> List:
+		items = list(items)
+		n_jobs = min(self.n_jobs or os.cpu_count() or 1, len(items))
+		if n_jobs <= 1:
+			return [func(x) for x in items]
+		with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+			return list(pool.map(func, items))
+
+	@property
+	def is_factorized(self) -> bool:
+		"""
+		Whether all blocks are solved with a factorization of their Gram matrix.
+		"""
+		return all(block.is_factorized for block in self.blocks)
+
+	def solve(self, obs: np.ndarray) -> Tuple[np.ndarray, Union[np.ndarray, float]]:
+		"""
+		Solve the least-squares problem for one or more response vectors, as GramSolver.solve().
+		"""
+		obs = np.asarray(obs, dtype=float)
+		if obs.ndim == 2 and obs.shape[1] == 1:
+			obs = obs.ravel()
+		solutions = self._map(lambda b: self.blocks[b].solve(obs[self.row_blocks[b]]), 
+							  range(len(self.blocks)))
+
+		coef = np.zeros((self.design.shape[1],) + obs.shape[1:])
+		for genes, (beta, _) in zip(self.gene_blocks, solutions):
+			coef[genes] = beta
+		if self.fit_intercept:
+			return coef, solutions[0][1]
+		return coef, 0.
+
+	def predict(self, coef: np.ndarray, intercept: Union[np.ndarray, float] = 0.) -> np.ndarray:
+		"""
+		Predicted response for every row of the design matrix.
+		"""
+		return self.design @ coef + intercept
+
+	def leverage(self) -> np.ndarray:
+		"""
+		Leverage of every row of the design matrix, as GramSolver.leverage(), block by block.
+		"""
+		leverage = np.zeros(self.design.shape[0])
+		for rows, block_leverage in zip(self.row_blocks, 
+										self._map(lambda block: block.leverage(), self.blocks)):
+			leverage[rows] = block_leverage
+		return leverage
+
+	def remove_rows(self, rows: np.ndarray) -> 'BlockSolver':
+		"""
+		Solver for the design matrix without `rows`. Every block is downdated with
+		GramSolver.remove_rows(); the current solver is left unchanged.
+		"""
+		keep = np.ones(self.design.shape[0], dtype=bool)
+		keep[rows] = False
+		new_position = np.cumsum(keep) - 1
+
+		solver = object.__new__(BlockSolver)
+		solver.design = self.design[keep]
+		solver.fit_intercept = self.fit_intercept
+		solver.n_jobs = self.n_jobs
+		solver.gene_blocks = self.gene_blocks
+		solver.row_blocks = [new_position[x[keep[x]]] for x in self.row_blocks]
+		solver.blocks = self._map(lambda b: self.blocks[b].remove_rows(
+			np.where(~keep[self.row_blocks[b]])[0]), range(len(self.blocks)))
+		return solver
+
+
+def _group_positions(group: np.ndarray, n_groups: int) -> List[np.ndarray]:
+	"""
+	Positions of the elements of every group 0..n_groups-1 (negative groups are dropped).
+	"""
+	order = np.argsort(group, kind='stable')
+	bounds = np.searchsorted(group[order], np.arange(n_groups + 1))
+	return [order[bounds[i]:bounds[i + 1]] for i in range(n_groups)]
+
+def r_squared(obs: np.ndarray, pred: np.ndarray) -> float:
+	"""
+	Coefficient of determination of a fit, as returned by sklearn's `score()`.
+	"""
+	obs = np.asarray(obs, dtype=float).ravel()
+	pred = np.asarray(pred, dtype=float).ravel()
+	ss_res = np.sum((obs - pred)**2)
+	ss_tot = np.sum((obs - obs.mean())**2)
+
+	return 1. - ss_res / ss_tot
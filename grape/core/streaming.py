@@ -0,0 +1,185 @@
+"""
+This file calculates mean fold changes from read count files too large to load into memory
+"""
+
+
+import os
+import tempfile
+from typing import List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from grape.core.foldchange_generator import min_reads_mask, report_min_reads
+from grape.core.load_input import iter_readcount_matrix
+
+
+STREAM_CHUNK_SIZE: int = 1000000
+"""Rows of the read count file processed at once by the streaming mode"""
+
+
+def stream_mean_foldchange(filepath: str, control_columns: Union[List[str], List[int]],
+						   target_columns: Optional[List[str]] = None,
+						   no_mean_replicates: bool = False, no_groupby_targets: bool = False,
+						   min_reads: int = 0, pseudocount: int = 1,
+						   dtype: Union[str, np.dtype] = np.float64,
+						   chunksize: int = STREAM_CHUNK_SIZE, columns: Optional[List[str]] = None,
+						   store_dir: Optional[str] = None) -> pd.DataFrame:
+	"""
+	get_mean_foldchange() of get_foldchange_matrix() of a read count file, computed in two passes
+	over the file without loading it.
+
+	The first pass sums the library size of every sample and collects the distinct targets. The
+	second pass computes the fold changes of each chunk and adds them to per-target sums and
+	counts, held in memory-mapped arrays. Peak memory scales with the chunk size and the number
+	of distinct targets, not with the number of constructs (except with no_groupby_targets,
+	where the output has one row per construct).
+
+	Parameters:
+        filepath : str
+            Path to the read count file (text, Parquet or Feather)
+        control_columns : List[str] or List[int]
+            Control sample labels or their column indices, as in get_foldchange_matrix()
+        target_columns, no_mean_replicates, no_groupby_targets :
+            See get_mean_foldchange()
+        min_reads, pseudocount, dtype :
+            See get_foldchange_matrix()
+        chunksize : int
+            Rows read per chunk. Default is STREAM_CHUNK_SIZE.
+        columns : List[str], optional
+            Sample columns to read. If None, all columns are read.
+        store_dir : str, optional
+            Directory of the temporary memory-mapped accumulators. Default is the system
+            temporary directory.
+
+	Returns:
+        pd.DataFrame
+            Mean fold changes, as returned by get_mean_foldchange(). Group means may differ from
+            it in the last bits, as sums are accumulated in file order.
+	"""
+	chunks = lambda: iter_readcount_matrix(filepath, chunksize, columns=columns)
+
+	# pass 1: library sizes, control totals and distinct targets of the constructs passing the
+	# min read filter
+	layout = None
+	targets, all_targets = set(), set()
+	n_rows = n_constructs = 0
+	max_ctrl = 0.
+	for chunk in chunks():
+		if layout is None:
+			layout = _column_layout(chunk.columns, control_columns, target_columns,
+									no_mean_replicates)
+			gene_label, control_labels, sample_labels, average, outcols = layout
+			library_size = np.zeros(len(sample_labels))
+			ctrl_total = 0.
+		ctrl_sum = chunk[control_labels].to_numpy(np.float64).sum(axis=1)
+		samples = chunk[sample_labels].to_numpy(np.float64)
+		genes = chunk[gene_label].values
+		keep = min_reads_mask(ctrl_sum, min_reads)
+		if min_reads > 0:
+			all_targets.update(pd.unique(genes))
+			max_ctrl = max(max_ctrl, ctrl_sum.max(initial=0))
+		if keep is not None:
+			ctrl_sum, samples, genes = ctrl_sum[keep], samples[keep], genes[keep]
+		library_size += samples.sum(axis=0)
+		ctrl_total += ctrl_sum.sum()
+		if not no_groupby_targets or min_reads > 0:
+			targets.update(pd.unique(genes))
+		n_rows += len(ctrl_sum)
+		n_constructs += len(chunk)
+	if layout is None:
+		raise ValueError(f'Read count file {filepath} has no rows')
+	print("[INFO] Using controls: " + ",".join(map(str, control_labels)))
+	if n_rows == 0 and n_constructs > 0:
+		raise ValueError(f'--min-reads {min_reads} removes all constructs (max control count '
+						 f'{max_ctrl:g})')
+	if n_rows < n_constructs:
+		report_min_reads(n_constructs, n_rows, len(all_targets), len(targets), min_reads)
+	del all_targets
+
+	# pass 2: fold changes of every chunk, accumulated per target
+	library_size = library_size.astype(dtype)
+	n_out = len(outcols)
+	with tempfile.TemporaryDirectory(dir=store_dir) as store:
+		values = sums = counts = None
+		if no_groupby_targets:
+			target_index = None
+			values = np.memmap(os.path.join(store, 'values.dat'), dtype=dtype, mode='w+',
+							   shape=(n_rows, n_out))
+			labels, genes = [], []
+		else:
+			target_index = pd.Index(sorted(targets), name=gene_label)
+			del targets
+			sums = np.memmap(os.path.join(store, 'sums.dat'), dtype=np.float64, mode='w+',
+							 shape=(len(target_index), n_out))
+			counts = np.memmap(os.path.join(store, 'counts.dat'), dtype=np.int64, mode='w+',
+							   shape=len(target_index))
+
+		start = 0
+		for chunk in chunks():
+			ctrl_sum = chunk[control_labels].to_numpy(np.float64).sum(axis=1)
+			keep = min_reads_mask(ctrl_sum, min_reads)
+			if keep is not None:
+				chunk, ctrl_sum = chunk[keep], ctrl_sum[keep]
+			ctrl_norm = ((ctrl_sum + pseudocount) / ctrl_total).astype(dtype, copy=False)
+			fc = chunk[sample_labels].to_numpy(dtype, copy=True)
+			fc += pseudocount
+			fc /= library_size
+			fc /= ctrl_norm[:, None]
+			np.log2(fc, out=fc)
+
+			if average is not None:
+				# replicates are added one at a time, as in DataFrame.mean(axis=1)
+				mean_fc = fc[:, average[0]].copy()
+				for j in average[1:]:
+					mean_fc += fc[:, j]
+				fc = (mean_fc / len(average))[:, None]
+
+			if no_groupby_targets:
+				values[start:start + len(chunk)] = fc
+				labels.append(chunk.index.values)
+				genes.append(chunk[gene_label].values)
+			else:
+				codes = target_index.get_indexer(chunk[gene_label])
+				counts += np.bincount(codes, minlength=len(target_index))
+				for j in range(n_out):
+					sums[:, j] += np.bincount(codes, weights=fc[:, j],
+											  minlength=len(target_index))
+			start += len(chunk)
+
+		if no_groupby_targets:
+			mean_fc_df = pd.DataFrame(np.array(values), index=np.concatenate(labels),
+									  columns=outcols)
+			mean_fc_df.insert(0, gene_label, np.concatenate(genes))
+		else:
+			mean_fc_df = pd.DataFrame((sums / counts[:, None]).astype(dtype),
+									  index=target_index, columns=outcols)
+		# release the memory maps before their files are removed
+		values = sums = counts = None
+
+	print(f'[INFO] Streamed {n_rows} rows in chunks of {chunksize}.')
+	return mean_fc_df
+
+def _column_layout(columns: pd.Index, control_columns: Union[List[str], List[int]],
+				   target_columns: Optional[List[str]], no_mean_replicates: bool) -> tuple:
+	"""
+	Target-gene label, control labels, sample labels, positions of the averaged samples (None
+	without averaging) and output columns of a read count table.
+	"""
+	try:
+		column_list = list(map(int, control_columns))
+		control_labels = list(columns.values[column_list])
+	except ValueError:
+		control_labels = list(control_columns)
+
+	target_column_labels = [x for x in columns.values if x not in control_labels]
+	gene_label, sample_labels = target_column_labels[0], target_column_labels[1:]
+	if no_mean_replicates:
+		return gene_label, control_labels, sample_labels, None, sample_labels
+
+	average = target_columns if target_columns else sample_labels
+	missing = [x for x in average if x not in sample_labels]
+	if missing:
+		raise KeyError(f"Target columns not found in read count file: {', '.join(missing)}")
+	return gene_label, control_labels, sample_labels, \
+		   [sample_labels.index(x) for x in average], ['meanFC']
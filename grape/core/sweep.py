@@ -0,0 +1,147 @@
+"""
+This file runs GRAPE over a grid of settings, sharing the stages the settings have in common
+"""
+
+import itertools
+import os
+import time
+import traceback
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import pandas as pd
+
+from grape.core.analysis import GrapeResult
+from grape.core.load_input import load_genelist
+from grape.core.run import run
+from grape.utils.cache import StageCache
+
+
+SWEEP_SUMMARY: str = 'sweep_summary.txt'
+"""File in the sweep output directory summarizing every setting"""
+
+GENE_FILE_FIELDS = ('target_gene_file', 'query_gene_file', 'nonessential_gene_file')
+
+
+def expand_grid(grid: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    """
+    Every combination of the values of the swept parameters, the last parameter varying fastest.
+
+    Parameters:
+        grid: Dict[str, List[Any]]
+            Values of every swept parameter, keyed by the argument name (e.g. half_window_size)
+
+    Returns:
+        List of settings, each a dict of parameter values
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[x] for x in names))]
+
+def run_sweep(args: Namespace, grid: Dict[str, List[Any]]) -> pd.DataFrame:
+    """
+    Run GRAPE for every setting of a parameter grid.
+
+    The pipeline stages (fold change, mean fold change, mode-centering, regression, filtered
+    regression) are keyed by their inputs and parameters and kept in an in-memory StageCache
+    shared by all settings, so each distinct stage is computed once and its output is used by
+    every setting downstream of it; e.g. a grid over --half-window-size and --monotone-filter
+    computes the regression once and only the Z-scores per setting. The in-memory outputs are
+    bounded by args.cache_size megabytes, least recently used first. Settings run in a pool of
+    `args.workers` threads; a setting that needs a stage in progress waits for it.
+
+    With args.profile, every setting writes its own profile, the setting prefix appended to the
+    path. With more than one worker, profiles hold wall times only (see StageProfiler).
+
+    Parameters:
+        args: Namespace
+            Arguments of `grape sweep`: the options of a single run, which the grid overrides,
+            plus workers and fdr
+        grid: Dict[str, List[Any]]
+            Values of every swept parameter, see expand_grid()
+
+    Returns:
+        summary: pd.DataFrame
+            One row per setting (and fold-change column with --no-mean-replicates): its output
+            prefix, parameters, regression R², number of pairs, of synthetic and suppressor pairs
+            at args.fdr, status, run time and error message. Also saved to sweep_summary.txt in
+            the output directory.
+    """
+    settings = expand_grid(grid)
+    os.makedirs(args.output_directory, exist_ok=True)
+    base_prefix = f"{args.output_prefix.rstrip('_')}_" if args.output_prefix else ''
+    width = len(str(len(settings)))
+
+    jobs = []
+    for i, setting in enumerate(settings, 1):
+        job = Namespace(**vars(args))
+        del job.workers, job.fdr
+        for field, value in setting.items():
+            setattr(job, field, value)
+        job.output_prefix = f'{base_prefix}setting{i:0{width}d}'
+        if args.profile:
+            # one profile per setting, named after its output prefix
+            root, ext = os.path.splitext(args.profile)
+            job.profile = f'{root}_{job.output_prefix}{ext or ".json"}'
+        jobs.append((job, setting))
+
+    # gene lists are parsed up front, as the settings share them across threads
+    gene_files = {getattr(job, field) for job, _ in jobs for field in GENE_FILE_FIELDS}
+    shared = {'gene_lists': {path: load_genelist(path) for path in gene_files if path is not None}}
+    cache = StageCache(args.cache_dir, args.cache_size, in_memory=True)
+
+    workers = min(args.workers or os.cpu_count() or 1, len(jobs))
+    print(f'[INFO] Sweeping {len(jobs)} settings of {", ".join(grid)} with {workers} workers.')
+    # concurrent settings share the process, so their profiles hold wall times only
+    concurrent = workers > 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        rows = pool.map(lambda job: _run_setting(job[0], job[1], shared, cache, args.fdr,
+                                                 concurrent), jobs)
+        rows = [row for setting_rows in rows for row in setting_rows]
+
+    per_column = any('column' in row for row in rows)
+    columns = ['output_prefix'] + list(grid) + (['column'] if per_column else []) + \
+              ['Rsq', 'n_pairs', 'n_synth', 'n_supp', 'status', 'seconds', 'error']
+    summary = pd.DataFrame(rows, columns=columns)
+    summary_path = os.path.join(args.output_directory, SWEEP_SUMMARY)
+    summary.to_csv(summary_path, sep='\t', index=False)
+
+    n_ok = (summary.groupby('output_prefix')['status'].first() == 'ok').sum()
+    print(f'[INFO] Sweep complete: {n_ok} of {len(jobs)} settings succeeded, '
+          f'{cache.n_stored} stages computed. Summary saved to {summary_path}.')
+    return summary
+
+def summarize_result(result: GrapeResult, fdr: float = 0.05) -> List[Dict[str, Any]]:
+    """
+    Regression R² and the number of pairs, synthetic pairs (Padj_synth < fdr) and suppressor
+    pairs (Padj_supp < fdr) of a result, one row per fold-change column.
+    """
+    if result.columns is None:
+        outputs = [(None, result.pairs, result.model)]
+    else:
+        outputs = [(col, result.pairs[col], result.model[col]) for col in result.columns]
+
+    rows = []
+    for col, pairs, model in outputs:
+        row = {} if col is None else {'column': col}
+        row.update({'Rsq': model['Rsq'], 'n_pairs': len(pairs),
+                    'n_synth': int((pairs['Padj_synth'] < fdr).sum()),
+                    'n_supp': int((pairs['Padj_supp'] < fdr).sum())})
+        rows.append(row)
+    return rows
+
+def _run_setting(args: Namespace, setting: Dict[str, Any], shared: Dict, cache: StageCache,
+                 fdr: float, concurrent: bool = False) -> List[Dict[str, Any]]:
+    row = {'output_prefix': args.output_prefix, **setting}
+    start = time.time()
+    try:
+        result = run(args, shared, cache, concurrent)
+    except Exception as e:
+        traceback.print_exc()
+        print(f'[ERROR] Setting {args.output_prefix} failed: {type(e).__name__}: {e}')
+        return [{**row, 'status': 'failed', 'seconds': round(time.time() - start, 3),
+                 'error': f'{type(e).__name__}: {e}'}]
+
+    seconds = round(time.time() - start, 3)
+    return [{**row, **stats, 'status': 'ok', 'seconds': seconds, 'error': ''}
+            for stats in summarize_result(result, fdr)]
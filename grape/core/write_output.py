@@ -0,0 +1,146 @@
+"""
+This file writes the GRAPE result tables
+"""
+
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from grape.utils.defaults import OUTPUT_FORMATS
+
+
+WRITE_CHUNK_SIZE: int = 50000
+"""Number of rows formatted at once by the text writer"""
+
+FLOAT_FORMAT: str = '%.3f'
+SCI_FORMAT: str = '%.2e'
+
+SCI_COLUMNS = ('Pval', 'Padj', 'cooks_d')
+"""Prefixes of the columns written in scientific notation"""
+
+
+def write_text_table(df: pd.DataFrame, path: str, column_formats: List[str],
+                     index_label: Optional[str] = None, sep: str = '\t'):
+    """
+    Write a DataFrame as delimited text, formatting every numeric column with a printf-style
+    format. The output matches `df.map(format).to_csv(path, sep=sep)`, but each chunk of rows is
+    rendered by a single string-formatting call instead of one Python call per cell.
+
+    Parameters:
+        df: pd.DataFrame
+            Table to write
+        path: str
+            Output file path
+        column_formats: List[str]
+            printf-style format of each column, e.g. '%.3f'. Non-numeric columns are written as is.
+        index_label: str, optional
+            Header of the index column. Default is the index name.
+    """
+    if index_label is None:
+        index_label = df.index.name if df.index.name is not None else ''
+
+    formats = ['%s']
+    columns = [_quote(df.index.values, sep)]
+    for col, fmt in zip(df.columns, column_formats):
+        values = df[col].values
+        if pd.api.types.is_numeric_dtype(values.dtype):
+            formats.append(fmt)
+            columns.append(values.astype(float))
+        else:
+            formats.append('%s')
+            columns.append(_quote(values, sep))
+    row_format = sep.join(formats) + '\n'
+
+    with open(path, 'w', encoding='utf-8', newline='') as outfile:
+        header = _quote(np.asarray([index_label] + list(df.columns), dtype=object), sep)
+        outfile.write(sep.join(map(str, header)) + '\n')
+        for start in range(0, len(df), WRITE_CHUNK_SIZE):
+            block = np.empty((min(WRITE_CHUNK_SIZE, len(df) - start), len(columns)), dtype=object)
+            for j, values in enumerate(columns):
+                block[:, j] = values[start : start + WRITE_CHUNK_SIZE]
+            outfile.write((row_format * len(block)) % tuple(block.ravel().tolist()))
+
+def _quote(values: np.ndarray, sep: str = '\t') -> np.ndarray:
+    """
+    Quote text fields the way csv.QUOTE_MINIMAL does (only fields that contain the delimiter,
+    a quote or a line break).
+    """
+    values = np.asarray(values, dtype=object)
+    special = (sep, '"', '\n', '\r')
+    # scanning one joined string is much faster than testing every field
+    joined = '\x00'.join(map(str, values))
+    if not any(char in joined for char in special):
+        return values
+
+    quoted = ['"' + str(x).replace('"', '""') + '"' if any(char in str(x) for char in special)
+              else x for x in values]
+    return np.asarray(quoted, dtype=object)
+
+def _column_formats(df: pd.DataFrame) -> List[str]:
+    """
+    Text format of every column: p-values, FDRs and Cook's distances in scientific notation,
+    everything else with 3 decimals.
+    """
+    return [SCI_FORMAT if str(col).startswith(SCI_COLUMNS) else FLOAT_FORMAT
+            for col in df.columns]
+
+def output_paths(output_directory: str, output_prefix: Optional[str] = None,
+                 output_format: str = 'txt') -> List[str]:
+    """
+    Paths of the grape_pairs, grape_singles and modecenter_meanfc files written by
+    write_outputs().
+    """
+    output_path = output_directory.rstrip('/') + '/'
+    prefix = f"_{output_prefix.rstrip('_')}" if output_prefix else ""
+    return [output_path + f'{name}{prefix}.{output_format}'
+            for name in ('grape_pairs', 'grape_singles', 'modecenter_meanfc')]
+
+def write_outputs(pairs: pd.DataFrame, singles: pd.DataFrame, modecenter_fc: pd.DataFrame,
+                  output_directory: str, output_prefix: Optional[str] = None,
+                  output_format: str = 'txt'):
+    """
+    Save the GRAPE result tables: grape_pairs, grape_singles and modecenter_meanfc.
+
+    Parameters:
+        pairs: pd.DataFrame
+            Output of get_zscore()
+        singles: pd.DataFrame
+            Single-gene output of do_regression()
+        modecenter_fc: pd.DataFrame
+            Mode-centered fold changes used as regression input
+        output_directory: str
+            Output directory path
+        output_prefix: str, optional
+            Prefix appended to the output file names
+        output_format: str
+            'txt' writes tab-delimited text rounded for reading (3 decimals, p-values in
+            scientific notation). 'parquet', 'feather' and 'npz' keep full float precision.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}', expected one of "
+                         f"{', '.join(OUTPUT_FORMATS)}")
+
+    pairs = pairs.rename_axis('GENE_PAIR')
+    pairs_path, singles_path, modecenter_path = output_paths(output_directory, output_prefix,
+                                                             output_format)
+
+    if output_format == 'txt':
+        write_text_table(pairs, pairs_path, _column_formats(pairs))
+        write_text_table(singles, singles_path, _column_formats(singles))
+        write_text_table(modecenter_fc, modecenter_path,
+                         [FLOAT_FORMAT] * len(modecenter_fc.columns))
+        return
+
+    for path, table in [(pairs_path, pairs), (singles_path, singles),
+                        (modecenter_path, modecenter_fc)]:
+        if output_format == 'parquet':
+            table.to_parquet(path)
+        elif output_format == 'feather':
+            # feather does not store an index
+            table.rename_axis(table.index.name or 'GENE').reset_index().to_feather(path)
+        else:
+            numeric = table.select_dtypes('number')
+            np.savez(path, index=table.index.values.astype(str),
+                     columns=numeric.columns.values.astype(str),
+                     values=numeric.to_numpy(dtype=float))
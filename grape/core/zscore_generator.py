@@ -4,14 +4,17 @@ interactions.
 """
 
 
+from typing import Dict, Optional
+
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
-from statsmodels.stats.multitest import fdrcorrection
+
+from grape.core.rolling_std import rolling_robust_std
 
 
 def get_zscore(regression_df: pd.DataFrame, half_window_size: int = 500, 
-			   monotone_filter: bool = False):
+			   monotone_filter: bool = False, stepsize: Optional[int] = None):
 	"""
 	Calculate zscore of genetic interactions through drugz variance window method
 
@@ -22,6 +25,9 @@ def get_zscore(regression_df: pd.DataFrame, half_window_size: int = 500,
             Half-window size for calculating local variance. If set to 0, calculates global variance
         monotone_filter : bool, optional, default=False
             If True, ensures a monotonically increasing variance.
+        stepsize : int, optional
+            Distance between consecutive variance windows. Default is ceil(half_window_size / 5). 
+            A stepsize of 1 gives every pair its own centred window.
 	
 	Returns:
         pd.DataFrame
@@ -33,56 +39,121 @@ def get_zscore(regression_df: pd.DataFrame, half_window_size: int = 500,
             - `Pval_supp`: P-value for suppressing interactions.
             - `Padj_supp`: Adjusted p-value (FDR) for suppressing interactions.
 	"""
-	# sort the regression DF by expected fold change:
-	zscore_df = regression_df.sort_values('fc_exp', ascending=False).copy()
-
-	# Intialize output columns
-	zscore_df[['local_std','GI_Zscore']] = 0.
+	# order by expected fold change (the row order of sort_values('fc_exp', ascending=False)). 
+	# The new columns are computed as arrays in that order and the output frame is gathered once, 
+	# by a single permutation of the input rows.
+	order = pd.Series(regression_df['fc_exp'].values).sort_values(ascending=False).index.values
+	gi_raw = regression_df['GI_raw'].values[order]
 
 	if (half_window_size==0):
 		# if half_window_size = 0, use global instead of local Z score
-		zscore_df['local_std'] = zscore_df['GI_raw'].std()
-		zscore_df['GI_Zscore'] = stats.zscore( zscore_df.GI_raw.values)
+		local_std = np.full(len(gi_raw), pd.Series(gi_raw).std())
+		zscore = stats.zscore(gi_raw)
 	else:
 		# otherwise step through the data and calculate local std
-		stepsize = int( np.ceil(half_window_size / 5))
-		for idx in range(half_window_size, len(zscore_df) - half_window_size, stepsize):
-			
-			# select the window slice
-			bin_ = zscore_df.iloc[idx - half_window_size : idx + half_window_size ].copy()
-
-			# remove outliers and calculate std
-			Q1,Q3 = bin_['GI_raw'].quantile([0.25,0.75])
-			IQR = Q3 - Q1
-			lower_bound = Q1 - 1.5*IQR
-			upper_bound = Q3 + 1.5*IQR
-			bin_ = bin_[(bin_['GI_raw'] >= lower_bound) & (bin_['GI_raw'] <= upper_bound)]
-			local_std = bin_['GI_raw'].std()
-
-			# assigne value in df, 
-			if (monotone_filter):
-				prev_std = zscore_df.iloc[idx-1, zscore_df.columns.get_loc('local_std')]
-				zscore_df.iloc[idx:idx+stepsize, zscore_df.columns.get_loc('local_std')]= \
-				                                                max(local_std, prev_std)
-			else:
-				zscore_df.iloc[idx:idx+stepsize, zscore_df.columns.get_loc('local_std')]=local_std
-
-		# now for the first (0..half_window_size) and last segments of the df
-		zscore_df.iloc[:half_window_size, zscore_df.columns.get_loc('local_std')] = \
-		                zscore_df.iloc[half_window_size, zscore_df.columns.get_loc('local_std')]
-		zscore_df.iloc[-half_window_size:, zscore_df.columns.get_loc('local_std')]= \
-		                zscore_df.iloc[-half_window_size-1, zscore_df.columns.get_loc('local_std')]
+		local_std = rolling_robust_std(gi_raw, half_window_size, stepsize, monotone_filter)
 		
 		# and calculate z score
-		zscore_df['GI_Zscore'] = zscore_df['GI_raw'] / zscore_df['local_std']  # mean had better be zero
+		zscore = gi_raw / local_std  # mean had better be zero
 		
-	# calculate synthetic and suppressing interaction p-value and FDR
-	zscore_df.sort_values('GI_Zscore', ascending=True, inplace=True)
-	zscore_df['Pval_synth'] = stats.norm.cdf(zscore_df.GI_Zscore)
-	zscore_df['Padj_synth'] = fdrcorrection(zscore_df.Pval_synth)[1] 
-    
-	zscore_df.sort_values('GI_Zscore', ascending=False, inplace=True)
-	zscore_df['Pval_supp'] = stats.norm.sf(zscore_df.GI_Zscore)
-	zscore_df['Padj_supp'] = fdrcorrection(zscore_df.Pval_supp)[1]
-    
-	return zscore_df.sort_values('GI_Zscore', ascending=True)
\ No newline at end of file
+	# calculate synthetic and suppressing interaction p-value and FDR. The FDR does not depend on 
+	# the row order, so the rows are only sorted once, by z-score.
+	columns = {'local_std': local_std, 'GI_Zscore': zscore}
+	columns['Pval_synth'] = stats.norm.cdf(zscore)
+	columns['Padj_synth'] = benjamini_hochberg(columns['Pval_synth'])
+	columns['Pval_supp'] = stats.norm.sf(zscore)
+	columns['Padj_supp'] = benjamini_hochberg(columns['Pval_supp'])
+
+	rank = np.argsort(zscore, kind='stable')
+	rows = order[rank]
+	zscore_df = {col: regression_df[col].values[rows] for col in regression_df.columns}
+	zscore_df.update({col: values[rank] for col, values in columns.items()})
+	return pd.DataFrame(zscore_df, index=regression_df.index.values[rows])
+
+def get_multi_zscore(regression_dfs: Dict[str, pd.DataFrame], half_window_size: int = 500, 
+					 monotone_filter: bool = False, stepsize: Optional[int] = None) -> \
+					 Dict[str, pd.DataFrame]:
+	"""
+	get_zscore() for the pairs of several responses (do_multi_regression() output) at once. The
+	responses are stacked into matrices, so sorting, z-scores, p-values and FDRs are computed for
+	all columns together; only the local std is computed one column at a time.
+
+	Parameters:
+        regression_dfs : Dict[str, pd.DataFrame]
+            Pairs DataFrames keyed by response column, all with the same index
+        half_window_size : int, optional, default=500
+            Half-window size for calculating local variance. If set to 0, calculates global variance
+        monotone_filter : bool, optional, default=False
+            If True, ensures a monotonically increasing variance.
+        stepsize : int, optional
+            Distance between consecutive variance windows. Default is ceil(half_window_size / 5).
+
+	Returns:
+        Dict[str, pd.DataFrame]
+            get_zscore() output keyed by response column
+	"""
+	columns = list(regression_dfs)
+	index = regression_dfs[columns[0]].index
+	fields = regression_dfs[columns[0]].columns
+	stacked = {field: np.column_stack([regression_dfs[col][field].values for col in columns])
+			   for field in fields}
+
+	# sort every column by expected fold change
+	order = np.argsort(-stacked['fc_exp'], axis=0, kind='stable')
+	stacked = {field: np.take_along_axis(values, order, axis=0) 
+			   for field, values in stacked.items()}
+	gi_raw = stacked['GI_raw']
+
+	if (half_window_size==0):
+		local_std = np.broadcast_to(np.std(gi_raw, axis=0, ddof=1), gi_raw.shape)
+		zscore = stats.zscore(gi_raw, axis=0)
+	else:
+		local_std = np.column_stack([rolling_robust_std(gi_raw[:, j], half_window_size, stepsize, 
+														monotone_filter) 
+									 for j in range(len(columns))])
+		zscore = gi_raw / local_std
+
+	stacked['local_std'] = local_std
+	stacked['GI_Zscore'] = zscore
+	stacked['Pval_synth'] = stats.norm.cdf(zscore)
+	stacked['Padj_synth'] = benjamini_hochberg(stacked['Pval_synth'])
+	stacked['Pval_supp'] = stats.norm.sf(zscore)
+	stacked['Padj_supp'] = benjamini_hochberg(stacked['Pval_supp'])
+
+	# sort every column by z-score
+	rank = np.argsort(zscore, axis=0, kind='stable')
+	labels = np.take_along_axis(order, rank, axis=0)
+	zscore_dfs = {}
+	for j, col in enumerate(columns):
+		zscore_dfs[col] = pd.DataFrame({field: values[rank[:, j], j] 
+										for field, values in stacked.items()},
+									   index=index.values[labels[:, j]])
+	return zscore_dfs
+
+def benjamini_hochberg(pvals: np.ndarray) -> np.ndarray:
+	"""
+	Benjamini-Hochberg adjusted p-values (FDR) of every column of `pvals`, equal to those of 
+	statsmodels' fdrcorrection(). The p-values do not need to be sorted.
+
+	Parameters:
+        pvals : np.ndarray
+            P-values, one test per row (one set of tests per column for 2D input)
+
+	Returns:
+        np.ndarray
+            Adjusted p-values, same shape as `pvals`
+	"""
+	pvals = np.asarray(pvals, dtype=float)
+	order = np.argsort(pvals, axis=0)
+	pvals_sorted = np.take_along_axis(pvals, order, axis=0)
+
+	n_tests = pvals.shape[0]
+	ecdffactor = np.arange(1, n_tests + 1) / float(n_tests)
+	if pvals.ndim > 1:
+		ecdffactor = ecdffactor[:, None]
+	adjusted = np.minimum.accumulate((pvals_sorted / ecdffactor)[::-1], axis=0)[::-1]
+	adjusted[adjusted > 1] = 1
+
+	padj = np.empty_like(adjusted)
+	np.put_along_axis(padj, order, adjusted, axis=0)
+	return padj
@@ -0,0 +1,317 @@
+"""
+This file holds the on-disk cache of pipeline stage outputs
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Callable, Iterator, Optional
+
+
+_MISSING = object()
+
+CACHE_SUFFIX: str = '.pkl'
+"""File suffix of cache entries"""
+
+DIGEST_INDEX: str = 'digests.json'
+"""File in the cache directory that maps file paths and stat signatures to content digests"""
+
+
+class StageCache:
+    """
+    Content-addressed cache of pipeline stage outputs.
+
+    Each stage output is stored as a pickle named after a hash of everything the stage depends
+    on: the content of the input files and the parameters of this and all upstream stages.
+    Entries are evicted least-recently-used first once the cache exceeds `max_size_mb`.
+
+    With `in_memory`, stage outputs are also kept in memory, so that analyses sharing the cache
+    (e.g. the settings of a parameter sweep) compute every distinct stage once and share its
+    output. Stages are computed under a per-key lock, so concurrent analyses wait for a stage in
+    progress instead of computing it again. Shared outputs must not be modified in place. The
+    in-memory entries are bounded by `max_size_mb` too, least recently used first; an evicted
+    stage is computed again if it is needed later.
+
+    Parameters:
+        cache_dir: str, optional
+            Directory holding cache entries. If None, nothing is stored on disk.
+        max_size_mb: int
+            Maximum total size of the cache entries in megabytes, on disk and in memory.
+            Default 4096.
+        in_memory: bool
+            Keep stage outputs in memory. Default False. Without cache_dir and in_memory, the
+            cache is disabled and every stage is computed.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_size_mb: int = 4096,
+                 in_memory: bool = False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_size_mb * 1024**2
+        self.memory = LRUCache(max_bytes=self.max_bytes) if in_memory else None
+        self.n_stored = 0
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # enforce the size bound on every run, also when every stage is a cache hit
+            self.evict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.cache_dir is not None or self.memory is not None
+
+    def lock(self, key: str) -> threading.Lock:
+        """
+        Lock held while the stage `key` is computed.
+        """
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        """
+        Hash of the stage name, parameters and upstream keys.
+        """
+        encoded = json.dumps(parts, sort_keys=True, default=str).encode('utf-8')
+        return hashlib.sha256(encoded).hexdigest()
+
+    def file_digest(self, filepath: Optional[str]) -> Optional[str]:
+        """
+        Hash of a file's content. Digests are remembered per path, size and modification time,
+        so unchanged files are only read once.
+        """
+        if filepath is None or not self.enabled:
+            return None
+
+        stat = os.stat(filepath)
+        signature = f'{os.path.abspath(filepath)}|{stat.st_size}|{stat.st_mtime_ns}'
+        if self.cache_dir is None:
+            # in-memory entries do not outlive the process, in which the signature is unique
+            return signature
+        index_path = os.path.join(self.cache_dir, DIGEST_INDEX)
+        try:
+            with open(index_path, 'r', encoding='utf-8') as infile:
+                digests = json.load(infile)
+        except (OSError, ValueError):
+            digests = {}
+
+        if signature not in digests:
+            digest = hashlib.blake2b()
+            with open(filepath, 'rb') as infile:
+                for block in iter(lambda: infile.read(2**24), b''):
+                    digest.update(block)
+            digests[signature] = digest.hexdigest()
+            self._write_atomic(index_path, json.dumps(digests).encode('utf-8'))
+
+        return digests[signature]
+
+    def frame_digest(self, df: Any) -> Optional[str]:
+        """
+        Hash of a DataFrame's content: index, column labels, dtypes and values.
+        """
+        if not self.enabled:
+            return None
+
+        import pandas as pd
+        digest = hashlib.blake2b()
+        digest.update(json.dumps([list(map(str, df.columns)), list(map(str, df.dtypes))]).encode())
+        digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+        return digest.hexdigest()
+
+    def stage(self, name: str, key_parts: list, compute: Callable[[], Any]) -> 'Stage':
+        """
+        Lazily evaluated, cached stage output.
+
+        Parameters:
+            name: str
+                Stage name
+            key_parts: list
+                Everything the output depends on: parameters, file digests, upstream stage keys
+            compute: Callable
+                Computes the stage output on a cache miss
+
+        Returns:
+            Stage
+                Call it to get the output
+        """
+        return Stage(self, self.key(name, *key_parts), compute)
+
+    def load(self, key: str) -> Any:
+        if self.memory is not None:
+            value = self.memory.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        if self.cache_dir is None:
+            return _MISSING
+        path = os.path.join(self.cache_dir, key + CACHE_SUFFIX)
+        try:
+            with open(path, 'rb') as infile:
+                value = pickle.load(infile)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return _MISSING
+        # mark as recently used
+        os.utime(path)
+        if self.memory is not None:
+            self.memory[key] = value
+        return value
+
+    def store(self, key: str, value: Any):
+        with self._locks_guard:
+            self.n_stored += 1
+        if self.memory is not None:
+            self.memory[key] = value
+        if self.cache_dir is None:
+            return
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        self._write_atomic(os.path.join(self.cache_dir, key + CACHE_SUFFIX), data)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in its size bound.
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(CACHE_SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def _write_atomic(self, path: str, data: bytes):
+        handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as outfile:
+                outfile.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+class Stage:
+    """
+    Output of one pipeline stage: loaded from the cache or computed on first call, then kept.
+    """
+
+    def __init__(self, cache: StageCache, key: str, compute: Callable[[], Any]):
+        self.cache = cache
+        self.key = key
+        self._compute = compute
+        self._value = _MISSING
+
+    def __call__(self) -> Any:
+        if self._value is _MISSING:
+            with self.cache.lock(self.key):
+                value = self.cache.load(self.key)
+                if value is _MISSING:
+                    value = self._compute()
+                    self.cache.store(self.key, value)
+            self._value = value
+        return self._value
+
+
+class LRUCache(MutableMapping):
+    """
+    Thread-safe dict holding at most `maxsize` entries, or entries of at most `max_bytes` in
+    total (see object_size()); the least recently used entries are dropped when a new one is
+    added. Used for state kept warm across analyses (gene lists, libraries, pair indices) and
+    for the in-memory stage outputs of a StageCache.
+
+    Parameters:
+        maxsize: int, optional
+            Maximum number of entries. Default is no limit.
+        max_bytes: int, optional
+            Maximum total size of the entries in bytes. An entry larger than that is not kept.
+            Default is no limit.
+    """
+
+    def __init__(self, maxsize: Optional[int] = None, max_bytes: Optional[int] = None):
+        self.maxsize = max(1, maxsize) if maxsize is not None else None
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key: Any) -> Any:
+        with self._lock:
+            value = self._data[key]
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key: Any, value: Any):
+        size = object_size(value) if self.max_bytes is not None else 0
+        with self._lock:
+            self.nbytes += size - self._sizes.get(key, 0)
+            self._data[key] = value
+            self._sizes[key] = size
+            self._data.move_to_end(key)
+            while self._data and ((self.maxsize is not None and len(self._data) > self.maxsize)
+                                  or (self.max_bytes is not None and
+                                      self.nbytes > self.max_bytes)):
+                oldest, _ = self._data.popitem(last=False)
+                self.nbytes -= self._sizes.pop(oldest)
+
+    def __delitem__(self, key: Any):
+        with self._lock:
+            del self._data[key]
+            self.nbytes -= self._sizes.pop(key)
+
+    def __contains__(self, key: Any) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __iter__(self) -> Iterator:
+        with self._lock:
+            return iter(list(self._data))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def object_size(value: Any) -> int:
+    """
+    Approximate memory size of a stage output in bytes: the buffers of DataFrames, arrays and
+    sparse matrices, summed over containers and object attributes.
+    """
+    seen = set()
+    def size(x):
+        if id(x) in seen:
+            return 0
+        seen.add(id(x))
+        if hasattr(x, 'memory_usage') and callable(x.memory_usage):
+            # pandas DataFrame, Series or Index
+            usage = x.memory_usage(deep=True)
+            return int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+        if hasattr(x, 'nbytes') and isinstance(x.nbytes, int):
+            # NumPy array
+            return x.nbytes
+        if hasattr(x, 'indptr') and hasattr(x, 'indices'):
+            # SciPy sparse matrix
+            return x.data.nbytes + x.indices.nbytes + x.indptr.nbytes
+        if isinstance(x, dict):
+            return sum(size(k) + size(v) for k, v in x.items())
+        if isinstance(x, (list, tuple, set, frozenset)):
+            return sum(size(v) for v in x)
+        if hasattr(x, '__dict__') and not isinstance(x, type):
+            return sys.getsizeof(x) + size(vars(x))
+        return sys.getsizeof(x)
+    return size(value)
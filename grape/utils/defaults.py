@@ -4,15 +4,40 @@ This file contains definitions to run the tool
 
 from typing import Optional, List
 
+MODE_METHODS = ('kde', 'fft')
+"""Mode estimators of mode_center()"""
+
+REGRESSION_BACKENDS = ('sklearn', 'numpy')
+"""Least-squares backends of the dense regression"""
+
+RESAMPLE_METHODS = ('permutation', 'bootstrap')
+"""Ways of resampling the regression residuals"""
+
+OUTPUT_FORMATS = ('txt', 'parquet', 'feather', 'npz')
+"""Supported output formats"""
+
+GI_MATRIX_LAYOUTS = ('sparse', 'dense')
+"""Layouts of the gene x gene GI matrix export"""
+
 DEFAULT_OUTPUT_PREFIX: str = None
 """Prefix for output files"""
 
 DEFAULT_MIN_READS: int = 0
-"""Minimum read count threshold for filtering samples"""
+"""Minimum read count of a construct summed over the control columns; constructs below it are
+removed before fold changes are computed"""
 
 DEFAULT_PSEUDOCOUNT: int = 1
 """Pseudocount added to avoid division by zero when computing fold changes"""
 
+DEFAULT_FLOAT32: bool = False
+"""If True, fold changes are computed and averaged in float32"""
+
+DEFAULT_STREAMING: bool = False
+"""If True, mean fold changes are computed in two passes over the read count file"""
+
+DEFAULT_CHUNK_SIZE: int = 1000000
+"""Rows of the read count file processed at once in streaming mode"""
+
 DEFAULT_TARGET_COLUMNS: Optional[List[str]] = None
 """Space-delimited list of target column names to average"""
 
@@ -31,11 +56,87 @@ DEFAULT_QUERY_GENE_FILE: str = None
 DEFAULT_GENEPAIR_DEL: str = '_'
 """Default delimiter for separating gene pairs in index names"""
 
+DEFAULT_SPARSE: bool = False
+"""If True, builds a sparse predictor matrix and solves the regression with the sparse backend"""
+
+DEFAULT_INCREMENTAL_FILTER: bool = False
+"""If True, refits after the dynamic range filter by downdating the first factorization"""
+
+DEFAULT_ITERATE_FILTER: bool = False
+"""If True, repeats the dynamic range filter until no more pairs are removed"""
+
+DEFAULT_MODE_METHOD: str = 'kde'
+"""Mode estimator used for mode-centering: kde or fft"""
+
 DEFAULT_FIT_INTERCEPT: bool = False
 """If True, fits intercept in regression models"""
 
+DEFAULT_REGRESSION_BACKEND: str = 'sklearn'
+"""Least-squares backend of the dense regression: sklearn or numpy (NumPy/SciPy only)"""
+
+DEFAULT_BLOCK_SOLVE: bool = False
+"""If True, solves the connected components of the regression independently"""
+
 DEFAULT_HALF_WINDOW_SIZE: int = 500
 """Half-window size used when computing local variance for GI Z-scores"""
 
+DEFAULT_WINDOW_STEP: Optional[int] = None
+"""Distance between local variance windows. If None, ceil(half_window_size / 5) is used"""
+
 DEFAULT_MONOTONE_FILTER: bool = False
 """If True, applies monotonic filtering to GI Z-score computation"""
+
+DEFAULT_DIAGNOSTICS: bool = False
+"""If True, adds leave-one-out influence diagnostics to the pairs and singles outputs"""
+
+DEFAULT_RESAMPLES: int = 0
+"""Number of resampled regressions for empirical p-values. If 0, no resampling is done"""
+
+DEFAULT_RESAMPLE_METHOD: str = 'permutation'
+"""Resampling of regression residuals: permutation or bootstrap"""
+
+DEFAULT_SEED: Optional[int] = None
+"""Random seed for resampling"""
+
+DEFAULT_THREADS: Optional[int] = None
+"""Number of threads for resampling and block solves. If None, the number of CPUs is used"""
+
+DEFAULT_LIBRARY: Optional[str] = None
+"""Path to a guide library built by grape build-library. If None, the regression is built"""
+
+DEFAULT_CACHE_DIR: Optional[str] = None
+"""Directory for cached pipeline stage outputs. If None, caching is disabled"""
+
+DEFAULT_CACHE_SIZE: int = 4096
+"""Maximum size of the stage cache in megabytes"""
+
+DEFAULT_OUTPUT_FORMAT: str = 'txt'
+"""Format of the output tables: txt, parquet, feather or npz"""
+
+DEFAULT_GI_MATRIX: Optional[str] = None
+"""Layout of the gene x gene GI matrix export: sparse or dense. If None, no matrix is written"""
+
+DEFAULT_CONTROL_COLUMNS: Optional[List[str]] = None
+"""Control columns of batch screens that do not list their own"""
+
+DEFAULT_WORKERS: Optional[int] = None
+"""Number of worker processes of a batch run (threads of a sweep). If None, the number of CPUs is
+used"""
+
+DEFAULT_FDR: float = 0.05
+"""FDR threshold at which pairs are counted as synthetic or suppressor in a sweep summary"""
+
+DEFAULT_PROFILE: Optional[str] = None
+"""Path of the JSON stage profile. If None, the run is not profiled"""
+
+DEFAULT_SERVE_SOCKET: Optional[str] = None
+"""Unix socket of grape serve. If None, the service listens on DEFAULT_SERVE_HOST:port"""
+
+DEFAULT_SERVE_HOST: str = '127.0.0.1'
+"""Host of grape serve without a Unix socket"""
+
+DEFAULT_SERVE_PORT: int = 8765
+"""TCP port of grape serve without a Unix socket"""
+
+DEFAULT_MAX_WARM: int = 8
+"""Number of gene lists, libraries and pair indices grape serve keeps in memory"""
@@ -0,0 +1,168 @@
+"""
+This file holds the per-stage profiler of the GRAPE workflow
+"""
+
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from grape.utils.version import __version__
+
+
+class StageProfiler:
+    """
+    Records wall time, CPU time, peak traced memory, peak RSS and the size of the output of each
+    pipeline stage. Repeated stages (e.g. an iterated filter) are accumulated under one name.
+
+    Times are exclusive: a stage that calls another profiled stage does not count the time spent
+    in it. Memory peaks are inclusive.
+
+    CPU time, traced memory and RSS are process-wide. When analyses run concurrently in threads
+    of one process (a sweep or grape serve with several workers), they cannot be attributed to
+    one analysis: with `concurrent`, only wall times and output sizes are recorded, and memory
+    tracing is neither started nor reset.
+
+    Parameters:
+        enabled: bool
+            If False, stages run without any instrumentation. Default True.
+        concurrent: bool
+            Other analyses run in threads of the same process. Default False.
+    """
+
+    def __init__(self, enabled: bool = True, concurrent: bool = False):
+        self.enabled = enabled
+        self.concurrent = concurrent
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self._stack: List[Dict[str, float]] = []
+        self._start = (time.perf_counter(), time.process_time())
+        # tracing slows every allocation, so it is stopped by stop() if started here
+        self._tracing = enabled and not concurrent and not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start()
+
+    def profile(self, name: str, func: Callable, *args, **kwargs) -> Any:
+        """
+        Call func(*args, **kwargs) as stage `name` and return its output. The row and column
+        counts of the output (its first DataFrame or array for tuple or dict outputs) are recorded.
+        """
+        if not self.enabled:
+            return func(*args, **kwargs)
+
+        frame = self._enter()
+        try:
+            output = func(*args, **kwargs)
+        finally:
+            record = self._exit(name, frame)
+        shape = _output_shape(output)
+        if shape is not None:
+            record['rows'] = int(shape[0])
+            record['columns'] = int(shape[1]) if len(shape) > 1 else 1
+        return output
+
+    def _enter(self) -> Dict[str, float]:
+        if self.concurrent:
+            frame = {'wall': time.perf_counter(), 'child_wall': 0.}
+            self._stack.append(frame)
+            return frame
+
+        current, peak = tracemalloc.get_traced_memory()
+        if self._stack:
+            # keep the parent's peak before resetting it
+            self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        frame = {'wall': time.perf_counter(), 'cpu': time.process_time(), 'memory': current,
+                 'peak': current, 'child_wall': 0., 'child_cpu': 0.}
+        self._stack.append(frame)
+        return frame
+
+    def _exit(self, name: str, frame: Dict[str, float]) -> Dict[str, Any]:
+        if self.concurrent:
+            wall = time.perf_counter() - frame['wall']
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1]['child_wall'] += wall
+            record = self.stages.setdefault(name, {'calls': 0, 'wall_s': 0.})
+            record['calls'] += 1
+            record['wall_s'] += wall - frame['child_wall']
+            return record
+
+        wall = time.perf_counter() - frame['wall']
+        cpu = time.process_time() - frame['cpu']
+        peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+        self._stack.pop()
+        if self._stack:
+            # the parent excludes this stage's time, but its memory peak includes it
+            parent = self._stack[-1]
+            parent['child_wall'] += wall
+            parent['child_cpu'] += cpu
+            parent['peak'] = max(parent['peak'], peak)
+
+        record = self.stages.setdefault(name, {'calls': 0, 'wall_s': 0., 'cpu_s': 0.,
+                                               'peak_traced_mb': 0.})
+        record['calls'] += 1
+        record['wall_s'] += wall - frame['child_wall']
+        record['cpu_s'] += cpu - frame['child_cpu']
+        record['peak_traced_mb'] = max(record['peak_traced_mb'],
+                                       (peak - frame['memory']) / 1024**2)
+        record['max_rss_mb'] = _max_rss_mb()
+        return record
+
+    def report(self, parameters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Profile of all stages run so far, as a JSON-serializable dict.
+        """
+        total = {'wall_s': time.perf_counter() - self._start[0]}
+        if not self.concurrent:
+            total.update({'cpu_s': time.process_time() - self._start[1],
+                          'max_rss_mb': _max_rss_mb()})
+        report = {'grape_version': __version__, 'python': sys.version.split()[0],
+                  'platform': platform.platform(), 'total': total,
+                  'stages': [{'stage': name, **record} for name, record in self.stages.items()]}
+        if self.concurrent:
+            report['concurrent'] = True
+        if parameters is not None:
+            report['parameters'] = parameters
+        return report
+
+    def write(self, path: str, parameters: Optional[Dict[str, Any]] = None):
+        """
+        Write report() to `path` as JSON.
+        """
+        report = self.report(parameters)
+        self.stop()
+        with open(path, 'w', encoding='utf-8') as outfile:
+            json.dump(report, outfile, indent=2, default=str)
+        print(f'[INFO] Profile saved to {path}.')
+
+    def stop(self):
+        """
+        Stop memory tracing if this profiler started it.
+        """
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+
+def _output_shape(output: Any) -> Optional[tuple]:
+    if isinstance(output, dict):
+        output = next(iter(output.values()), None)
+    elif isinstance(output, tuple):
+        output = next((x for x in output if hasattr(x, 'shape') or isinstance(x, dict)), None)
+        if isinstance(output, dict):
+            output = next(iter(output.values()), None)
+    return getattr(output, 'shape', None)
+
+def _max_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss / (1024**2 if sys.platform == 'darwin' else 1024)
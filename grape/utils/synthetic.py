@@ -0,0 +1,154 @@
+"""
+This file generates synthetic dual-gene screens with planted genetic interactions
+"""
+
+import os
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+class SyntheticScreen:
+    """
+    A simulated dual-gene knockout screen.
+
+    Attributes:
+        reads : pd.DataFrame
+            Read count matrix in the GRAPE input layout: index is the construct ID, the first
+            column ('GENE') the target gene(s), followed by the control (T0_R*) and end-point
+            (T_R*) replicate columns
+        target_genes : List[str]
+            Target genes (control constructs excluded)
+        nonessential_genes : List[str]
+            Target genes without a fitness effect, usable as reference genes
+        control_columns, target_columns : List[str]
+            Control (T0) and end-point sample columns
+        single_effects : pd.Series
+            Planted log2 fold change of every target gene
+        interactions : pd.Series
+            Planted genetic interaction (log2 scale) of every gene pair that has one
+    """
+
+    def __init__(self, reads: pd.DataFrame, target_genes: List[str],
+                 nonessential_genes: List[str], control_columns: List[str],
+                 target_columns: List[str], single_effects: pd.Series,
+                 interactions: pd.Series):
+        self.reads = reads
+        self.target_genes = target_genes
+        self.nonessential_genes = nonessential_genes
+        self.control_columns = control_columns
+        self.target_columns = target_columns
+        self.single_effects = single_effects
+        self.interactions = interactions
+
+    def write(self, directory: str, prefix: str = '') -> dict:
+        """
+        Write the read counts, target gene list and nonessential gene list as GRAPE input files.
+
+        Returns:
+            dict
+                Paths of the 'reads', 'targets' and 'nonessential' files
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = {'reads': os.path.join(directory, f'{prefix}reads.txt'),
+                 'targets': os.path.join(directory, f'{prefix}targets.txt'),
+                 'nonessential': os.path.join(directory, f'{prefix}nonessential.txt')}
+        self.reads.to_csv(paths['reads'], sep='\t')
+        for key, genes in (('targets', self.target_genes),
+                           ('nonessential', self.nonessential_genes)):
+            with open(paths[key], 'w', encoding='utf-8') as outfile:
+                outfile.write('\n'.join(genes) + '\n')
+        return paths
+
+
+def make_synthetic_screen(n_genes: int = 100, guides_per_gene: int = 2,
+                          pair_coverage: float = 1.0, n_replicates: int = 2,
+                          n_interactions: int = 20, interaction_size: float = 2.0,
+                          essential_fraction: float = 0.3, depth: float = 500.,
+                          noise: float = 0.3, n_controls: int = 10, genepair_del: str = '_',
+                          seed: Optional[int] = None) -> SyntheticScreen:
+    """
+    Simulate a dual-gene screen.
+
+    Every target gene is targeted alone by `guides_per_gene` constructs, and a random
+    `pair_coverage` fraction of all gene pairs by `guides_per_gene` constructs each. The log2 fold
+    change of a construct is the sum of the effects of its genes plus, for planted pairs, an
+    interaction of +/- interaction_size. T0 counts are Poisson around a log-normal library
+    distribution with mean `depth`; end-point counts are Poisson around the T0 abundance scaled by
+    2**(log2 fold change + replicate noise).
+
+    Parameters:
+        n_genes: int
+            Number of target genes. Default 100.
+        guides_per_gene: int
+            Constructs per gene and per gene pair. Default 2.
+        pair_coverage: float
+            Fraction of all gene pairs in the library. Default 1.0.
+        n_replicates: int
+            Number of T0 and end-point replicates. Default 2.
+        n_interactions: int
+            Number of gene pairs with a planted interaction. Default 20.
+        interaction_size: float
+            Absolute planted interaction, log2 scale. Half are synthetic (negative) and half
+            suppressing (positive). Default 2.0.
+        essential_fraction: float
+            Fraction of genes with a negative fitness effect. Default 0.3.
+        depth: float
+            Mean T0 reads per construct. Default 500.
+        noise: float
+            Standard deviation of the per-replicate log2 noise. Default 0.3.
+        n_controls: int
+            Number of control constructs (not in the target gene list). Default 10.
+        genepair_del: str
+            Delimiter used to separate gene pairs in labels. Default "_".
+        seed: int, optional
+            Random seed
+
+    Returns:
+        SyntheticScreen
+    """
+    rng = np.random.default_rng(seed)
+    genes = np.array([f'G{i}' for i in range(n_genes)], dtype=object)
+
+    effects = np.zeros(n_genes)
+    essential = rng.random(n_genes) < essential_fraction
+    effects[essential] = rng.normal(-1.5, 0.5, essential.sum())
+
+    # gene pairs in the library
+    first, second = np.triu_indices(n_genes, k=1)
+    in_library = rng.random(len(first)) < pair_coverage
+    first, second = first[in_library], second[in_library]
+    pair_labels = genes[first] + genepair_del + genes[second]
+
+    interaction = np.zeros(len(first))
+    planted = rng.choice(len(first), size=min(n_interactions, len(first)), replace=False)
+    signs = np.where(np.arange(len(planted)) % 2 == 0, -1., 1.)
+    interaction[planted] = signs * interaction_size
+
+    # constructs: singles, pairs and controls
+    targets = np.concatenate([np.repeat(genes, guides_per_gene),
+                              np.repeat(pair_labels, guides_per_gene),
+                              np.array([f'CTRL{i}' for i in range(n_controls)], dtype=object)])
+    lfc = np.concatenate([np.repeat(effects, guides_per_gene),
+                          np.repeat(effects[first] + effects[second] + interaction,
+                                    guides_per_gene),
+                          np.zeros(n_controls)])
+    guide = np.concatenate([np.tile(np.arange(guides_per_gene), n_genes + len(first)),
+                            np.zeros(n_controls, dtype=int)])
+    construct_ids = pd.Index(targets + '_g' + guide.astype(str).astype(object), name='gRNA')
+
+    abundance = depth * rng.lognormal(0., 0.5, len(targets))
+    abundance /= abundance.mean() / depth
+    reads = pd.DataFrame({'GENE': targets}, index=construct_ids)
+    control_columns = [f'T0_R{r + 1}' for r in range(n_replicates)]
+    target_columns = [f'T_R{r + 1}' for r in range(n_replicates)]
+    for col in control_columns:
+        reads[col] = rng.poisson(abundance)
+    for col in target_columns:
+        reads[col] = rng.poisson(abundance * 2**(lfc + rng.normal(0., noise, len(lfc))))
+
+    return SyntheticScreen(reads, list(genes), list(genes[~essential]), control_columns,
+                           target_columns, pd.Series(effects, index=genes, name='effect'),
+                           pd.Series(interaction[planted], index=pair_labels[planted],
+                                     name='interaction'))